@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import struct
+import stat
+import zlib
+import hashlib
+
+HEADER_FORMAT = "IIII16sIIII16s"
+HEADER_SIZE = struct.calcsize("<" + HEADER_FORMAT)
+HEADER_MAGIC = 0x28cd3d45
+HEADER_SIGNATURE = b"Compressed ROMFS"
+
+HEADER_KEYS = ["magic", "size", "flags", "future", "signature", "crc", "edition", "blocks", "files", "name"]
+### Location of fsid.crc in the superblock
+CRC_OFFSET = 32
+### Volume name mkcramfs uses without -n
+DEFAULT_NAME = "Compressed"
+
+INODE_FORMAT = "III"
+INODE_SIZE = struct.calcsize("<" + INODE_FORMAT)
+
+# Images may start with this much padding for boot code (mkcramfs -p)
+PAD_SIZE = 512
+PAGE_SIZE = 4096
+
+# Filesystem flags
+CRAMFS_FLAG_FSID_VERSION_2			= 0x00000001
+CRAMFS_FLAG_SORTED_DIRS				= 0x00000002
+CRAMFS_FLAG_HOLES					= 0x00000100
+CRAMFS_FLAG_WRONG_SIGNATURE			= 0x00000200
+CRAMFS_FLAG_SHIFTED_ROOT_OFFSET		= 0x00000400
+CRAMFS_FLAG_EXT_BLOCK_POINTERS		= 0x00000800
+
+################################################################################
+###
+### parseHeader(fh, offset=0) - Parse CramFS header located at offset in file
+###
+### Parameters:   fh:      file handle
+###               offset:  Optional location of image within file
+###
+### Returns:      Dictionary of header information, "endian" is "<" or ">" and
+###               "start" the location of the superblock relative to offset.
+###
+def parseHeader(fh, offset=0):
+	### Save current position and seek to start position
+	startpos = fh.tell()
+	hd = None
+	magic = 0
+
+	### The superblock is either at the start or after the boot code padding
+	for start in (0, PAD_SIZE):
+		fh.seek(offset + start)
+		block = fh.read(HEADER_SIZE)
+		if len(block) < HEADER_SIZE:
+			break
+
+		for endian in ("<", ">"):
+			values = struct.unpack(endian + HEADER_FORMAT, block)
+			if values[0] == HEADER_MAGIC:
+				hd = dict(zip(HEADER_KEYS, values))
+				hd["endian"] = endian
+				hd["start"] = start
+				break
+
+		if hd:
+			break
+		if start == 0:
+			magic = struct.unpack("<I", block[:4])[0]
+
+	### Restore saved file position
+	fh.seek(startpos)
+	if not hd:
+		return dict({"magic": magic})
+	return hd
+
+################################################################################
+###
+### buildConOpts(hd) - Build mkcramfs console options from parsed header
+###
+### Parameters:   hd:      Dictionary of header information
+###
+### Only options which differ from what mkcramfs does by default are added,
+### -N (byte order) needs a mkcramfs which supports it (util-linux).
+###
+### Returns:      List of console options
+###
+def buildConOpts(hd):
+	args = []
+	if hd["endian"] == ">":
+		args.extend(("-N", "big"))
+	if hd["start"] == PAD_SIZE:
+		args.append("-p")
+	if hd["edition"]:
+		args.extend(("-e", str(hd["edition"])))
+	name = hd["name"].rstrip(b"\0").decode("latin-1")
+	if name and name != DEFAULT_NAME:
+		args.extend(("-n", name))
+	if hd["flags"] & CRAMFS_FLAG_HOLES:
+		args.append("-z")
+	return args
+
+################################################################################
+###
+### checkCrc(data, offset=0) - Check the CRC32 of a CramFS image
+###
+### Parameters:   data:    bytes-like object (bytes, mmap) holding the image
+###               offset:  Optional location of the image within data
+###
+### The CRC covers the image from the superblock to its end with the CRC field
+### itself zeroed, only images with a version 2 fsid (flag 1) have one.
+###
+### Returns:      (stored CRC, computed CRC), None if the image has no CRC
+###
+def checkCrc(data, offset=0):
+	view = memoryview(data)[offset:]
+	try:
+		hd = None
+		for start in (0, PAD_SIZE):
+			for endian in ("<", ">"):
+				if len(view) >= start + HEADER_SIZE and struct.unpack_from(endian + "I", view, start)[0] == HEADER_MAGIC:
+					hd = dict(zip(HEADER_KEYS, struct.unpack_from(endian + HEADER_FORMAT, view, start)))
+					hd["endian"] = endian
+					hd["start"] = start
+					break
+			if hd:
+				break
+		if not hd:
+			raise Exception("Invalid CramFS magic number!")
+		if not hd["flags"] & CRAMFS_FLAG_FSID_VERSION_2:
+			return None
+		if hd["size"] > len(view):
+			raise Exception("CramFS size %d exceeds image size %d!" % (hd["size"], len(view)))
+
+		start = hd["start"]
+		crc = zlib.crc32(view[start:start + CRC_OFFSET])
+		crc = zlib.crc32(b"\0\0\0\0", crc)
+		crc = zlib.crc32(view[start + CRC_OFFSET + 4:hd["size"]], crc)
+		return hd["crc"], crc
+	finally:
+		view.release()
+
+################################################################################
+###
+### Image(data, offset=0) - Read-only access to a CramFS image
+###
+### Parameters:   data:    bytes-like object (bytes, mmap) holding the image
+###               offset:  Optional location of the image within data
+###
+class Image():
+	def __init__(self, data, offset=0):
+		self.data = memoryview(data)[offset:]
+		self.header = None
+		for start in (0, PAD_SIZE):
+			for endian in ("<", ">"):
+				if len(self.data) >= start + HEADER_SIZE and struct.unpack_from(endian + "I", self.data, start)[0] == HEADER_MAGIC:
+					values = struct.unpack_from(endian + HEADER_FORMAT, self.data, start)
+					self.header = dict(zip(HEADER_KEYS, values))
+					self.header["endian"] = endian
+					self.header["start"] = start
+					break
+			if self.header:
+				break
+		if not self.header:
+			raise Exception("Invalid CramFS magic number!")
+		if self.header["flags"] & CRAMFS_FLAG_EXT_BLOCK_POINTERS:
+			raise Exception("CramFS images with extended block pointers are not supported!")
+		self.endian = self.header["endian"]
+
+	def close(self):
+		self.data.release()
+
+	def readInode(self, pos):
+		### Returns inode at pos and position of the following inode
+		words = struct.unpack_from(self.endian + INODE_FORMAT, self.data, pos)
+		if self.endian == "<":
+			mode, uid = words[0] & 0xffff, words[0] >> 16
+			size, gid = words[1] & 0xffffff, words[1] >> 24
+			namelen, offset = words[2] & 0x3f, words[2] >> 6
+		else:
+			mode, uid = words[0] >> 16, words[0] & 0xffff
+			size, gid = words[1] >> 8, words[1] & 0xff
+			namelen, offset = words[2] >> 26, words[2] & 0x3ffffff
+
+		name = bytes(self.data[pos + INODE_SIZE:pos + INODE_SIZE + namelen * 4]).rstrip(b"\0")
+		inode = {
+			"mode": stat.S_IMODE(mode), "uid": uid, "gid": gid, "size": size,
+			"offset": offset * 4, "name": name.decode("utf-8", errors="surrogateescape"),
+			"type": stat.filemode(mode)[0].replace("-", "f")
+		}
+		if stat.S_ISBLK(mode) or stat.S_ISCHR(mode):
+			inode["rdev"] = size
+		elif stat.S_ISREG(mode):
+			inode["file_size"] = size
+		elif stat.S_ISLNK(mode):
+			inode["target"] = self.readLink(inode)
+		return inode, pos + INODE_SIZE + namelen * 4
+
+	def rootInode(self):
+		return self.readInode(self.header["start"] + HEADER_SIZE)[0]
+
+	def listDir(self, inode):
+		pos = inode["offset"]
+		end = pos + inode["size"]
+		while pos < end:
+			child, pos = self.readInode(pos)
+			yield child["name"], child
+
+	################################################################################
+	###
+	### walk() - Yields (path, inode) of every inode, root directory is "."
+	###
+	def walk(self, path=".", inode=None):
+		if inode is None:
+			inode = self.rootInode()
+		yield path, inode
+		if inode["type"] == "d":
+			for name, child in self.listDir(inode):
+				childPath = name if path == "." else path + "/" + name
+				yield from self.walk(childPath, child)
+
+	def rawBlocks(self, inode):
+		### Yields stored (compressed) data of every block, holes are empty
+		blocks = (inode["size"] + PAGE_SIZE - 1) // PAGE_SIZE
+		if not blocks or not inode["offset"]:
+			return
+		pointers = struct.unpack_from(self.endian + "%dI" % blocks, self.data, inode["offset"])
+		start = inode["offset"] + 4 * blocks
+		for end in pointers:
+			yield self.data[start:end]
+			start = end
+
+	################################################################################
+	###
+	### readFile(inode) - Yields the uncompressed content of a file or symlink
+	###
+	def readFile(self, inode):
+		remaining = inode["size"]
+		for block in self.rawBlocks(inode):
+			data = zlib.decompress(block) if len(block) else bytes(min(PAGE_SIZE, remaining))
+			remaining -= len(data)
+			yield data
+
+	def readLink(self, inode):
+		return b"".join(self.readFile(inode)).decode("utf-8", errors="surrogateescape")
+
+	################################################################################
+	###
+	### blockDigest(inode) - SHA-256 of the stored (compressed) blocks of a file
+	###
+	def blockDigest(self, inode):
+		digest = hashlib.sha256()
+		for block in self.rawBlocks(inode):
+			digest.update(struct.pack("<I", len(block)))
+			digest.update(block)
+		return digest.hexdigest()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import struct
+
+HEADER_MAGIC = b"\x7fELF"
+
+IDENT_FORMAT = "4sBBBBB7s"
+IDENT_SIZE = struct.calcsize(IDENT_FORMAT)
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+### Everything after e_ident, (32 bit, 64 bit)
+HEADER_FORMAT = ("HHIIIIIHHHHHH", "HHIQQQIHHHHHH")
+HEADER_KEYS = ["e_type", "e_machine", "e_version", "e_entry", "e_phoff", "e_shoff", "e_flags",
+			   "e_ehsize", "e_phentsize", "e_phnum", "e_shentsize", "e_shnum", "e_shstrndx"]
+
+PHDR_FORMAT = ("IIIIIIII", "IIQQQQQQ")
+PHDR_KEYS = (["p_type", "p_offset", "p_vaddr", "p_paddr", "p_filesz", "p_memsz", "p_flags", "p_align"],
+			 ["p_type", "p_flags", "p_offset", "p_vaddr", "p_paddr", "p_filesz", "p_memsz", "p_align"])
+
+SHDR_FORMAT = ("IIIIIIIIII", "IIQQQQIIQQ")
+SHDR_KEYS = ["sh_name", "sh_type", "sh_flags", "sh_addr", "sh_offset", "sh_size", "sh_link", "sh_info",
+			 "sh_addralign", "sh_entsize"]
+
+PT_LOAD		= 1
+PT_DYNAMIC	= 2
+PT_INTERP	= 3
+
+SHT_SYMTAB	= 2
+SHT_STRTAB	= 3
+SHT_RELA	= 4
+SHT_DYNAMIC	= 6
+SHT_NOBITS	= 8
+SHT_REL		= 9
+SHT_DYNSYM	= 11
+SHT_GROUP	= 17
+SHT_SYMTAB_SHNDX = 18
+
+SHF_ALLOC	= 0x2
+SHF_INFO_LINK = 0x40
+
+SHN_LORESERVE = 0xff00
+
+### st_shndx offset and symbol size, (32 bit, 64 bit)
+SYM_SHNDX = ((14, 16), (6, 24))
+
+### Sections strip(1) removes, besides the symbol table
+STRIP_NAMES = (".comment",)
+STRIP_PREFIXES = (".debug", ".zdebug", ".stab", ".line")
+
+DT_NULL		= 0
+DT_NEEDED	= 1
+DT_STRTAB	= 5
+DT_SONAME	= 14
+
+ELF_TYPES = {0: "none", 1: "rel", 2: "exec", 3: "dyn", 4: "core"}
+ELF_MACHINES = {2: "sparc", 3: "x86", 8: "mips", 20: "powerpc", 21: "powerpc64", 40: "arm", 42: "sh",
+				62: "x86_64", 183: "aarch64", 243: "riscv"}
+
+################################################################################
+###
+### parseHeader(data) - Parse ELF header of a file held in memory
+###
+### Parameters:   data:    bytes-like object holding the whole file
+###
+### Returns:      Dictionary of header information, "class" (32 or 64),
+###               "endian" ("<" or ">"), "type" and "machine" names, or None
+###               if data is not an ELF file
+###
+def parseHeader(data):
+	if len(data) < IDENT_SIZE or bytes(data[:4]) != HEADER_MAGIC:
+		return None
+	magic, elfClass, elfData, version, osabi, abiversion, pad = struct.unpack_from(IDENT_FORMAT, data)
+	if elfClass not in (ELFCLASS32, ELFCLASS64) or elfData not in (ELFDATA2LSB, ELFDATA2MSB):
+		return None
+
+	bits = elfClass - 1
+	endian = "<" if elfData == ELFDATA2LSB else ">"
+	fmt = endian + HEADER_FORMAT[bits]
+	if len(data) < IDENT_SIZE + struct.calcsize(fmt):
+		return None
+
+	hd = dict(zip(HEADER_KEYS, struct.unpack_from(fmt, data, IDENT_SIZE)))
+	hd["class"] = 32 * elfClass
+	hd["endian"] = endian
+	hd["osabi"] = osabi
+	hd["type"] = ELF_TYPES.get(hd["e_type"], str(hd["e_type"]))
+	hd["machine"] = ELF_MACHINES.get(hd["e_machine"], str(hd["e_machine"]))
+	return hd
+
+def parseTable(data, hd, offset, count, size, formats, keys):
+	### Returns list of dictionaries of a program or section header table
+	bits = hd["class"] // 32 - 1
+	fmt = hd["endian"] + formats[bits]
+	keys = keys[bits] if isinstance(keys, tuple) else keys
+	if not offset or size < struct.calcsize(fmt) or offset + count * size > len(data):
+		return []
+	return [dict(zip(keys, struct.unpack_from(fmt, data, offset + i * size))) for i in range(count)]
+
+def programHeaders(data, hd):
+	return parseTable(data, hd, hd["e_phoff"], hd["e_phnum"], hd["e_phentsize"], PHDR_FORMAT, PHDR_KEYS)
+
+def sectionHeaders(data, hd):
+	return parseTable(data, hd, hd["e_shoff"], hd["e_shnum"], hd["e_shentsize"], SHDR_FORMAT, SHDR_KEYS)
+
+def readString(data, offset):
+	end = bytes(data[offset:offset + 4096]).find(b"\0")
+	return bytes(data[offset:offset + end if end >= 0 else offset]).decode("utf-8", errors="surrogateescape")
+
+################################################################################
+###
+### parseInfo(data) - Collect the ELF metadata of a file held in memory
+###
+### Returns:      Dictionary of parseHeader() plus "interp", "soname",
+###               "needed" (list) and "stripped", or None for non ELF files
+###
+def parseInfo(data):
+	hd = parseHeader(data)
+	if not hd:
+		return None
+	hd["interp"] = None
+	hd["soname"] = None
+	hd["needed"] = []
+
+	phdrs = programHeaders(data, hd)
+	loads = [ph for ph in phdrs if ph["p_type"] == PT_LOAD]
+	dynamic = None
+	for ph in phdrs:
+		if ph["p_type"] == PT_INTERP:
+			hd["interp"] = readString(data, ph["p_offset"])
+		elif ph["p_type"] == PT_DYNAMIC:
+			dynamic = ph
+
+	shdrs = sectionHeaders(data, hd)
+	hd["stripped"] = not any(sh["sh_type"] == SHT_SYMTAB for sh in shdrs)
+
+	if dynamic:
+		fmt = hd["endian"] + ("iI" if hd["class"] == 32 else "qQ")
+		size = struct.calcsize(fmt)
+		entries = []
+		for pos in range(dynamic["p_offset"], min(dynamic["p_offset"] + dynamic["p_filesz"], len(data) - size + 1), size):
+			tag, value = struct.unpack_from(fmt, data, pos)
+			if tag == DT_NULL:
+				break
+			entries.append((tag, value))
+
+		### DT_STRTAB is a virtual address, map it back to a file offset
+		strtab = None
+		for tag, value in entries:
+			if tag == DT_STRTAB:
+				for ph in loads:
+					if ph["p_vaddr"] <= value < ph["p_vaddr"] + ph["p_filesz"]:
+						strtab = value - ph["p_vaddr"] + ph["p_offset"]
+		if strtab is not None:
+			for tag, value in entries:
+				if tag == DT_NEEDED:
+					hd["needed"].append(readString(data, strtab + value))
+				elif tag == DT_SONAME:
+					hd["soname"] = readString(data, strtab + value)
+	return hd
+
+################################################################################
+###
+### strip(data) - Remove symbol table, comments and debug sections
+###
+### Parameters:   data:    bytes-like object holding the whole file
+###
+### Everything covered by the program headers stays byte for byte at its
+### offset, the kept sections behind it are moved up and a new section header
+### table is appended. Relocatable objects (kernel modules) are not touched,
+### nor are files with data that no section or segment accounts for.
+###
+### Returns:      stripped file, None if there is nothing to remove
+###
+def strip(data):
+	hd = parseHeader(data)
+	if not hd or hd["type"] not in ("exec", "dyn") or not hd["e_shoff"]:
+		return None
+	bits = hd["class"] // 32 - 1
+	shdrs = sectionHeaders(data, hd)
+	phdrs = programHeaders(data, hd)
+	if not shdrs or hd["e_shstrndx"] >= len(shdrs):
+		return None
+	if any(sh["sh_type"] in (SHT_GROUP, SHT_SYMTAB_SHNDX) for sh in shdrs):
+		return None
+
+	shstrtab = shdrs[hd["e_shstrndx"]]["sh_offset"]
+	remove = set()
+	for i, sh in enumerate(shdrs):
+		if i == 0 or sh["sh_flags"] & SHF_ALLOC:
+			continue
+		name = readString(data, shstrtab + sh["sh_name"])
+		if sh["sh_type"] == SHT_SYMTAB or name in STRIP_NAMES or name.startswith(STRIP_PREFIXES):
+			remove.add(i)
+			### and its string table
+			link = sh["sh_link"]
+			if 0 < link < len(shdrs) and link != hd["e_shstrndx"] and not shdrs[link]["sh_flags"] & SHF_ALLOC:
+				remove.add(link)
+
+	### Keep whatever a kept section still refers to
+	changed = True
+	while changed:
+		changed = False
+		for i, sh in enumerate(shdrs):
+			if i in remove:
+				continue
+			for ref in (sh["sh_link"], infoLink(sh)):
+				if ref in remove:
+					remove.discard(ref)
+					changed = True
+	if not remove:
+		return None
+
+	segEnd = max([hd["e_ehsize"], hd["e_phoff"] + hd["e_phnum"] * hd["e_phentsize"]] +
+				 [ph["p_offset"] + ph["p_filesz"] for ph in phdrs])
+	if not coveredTail(data, hd, shdrs, segEnd):
+		return None
+
+	kept = [i for i in range(len(shdrs)) if i not in remove]
+	index = {old: new for new, old in enumerate(kept)}
+	out = bytearray(data[:segEnd])
+	newShdrs = []
+	for i in kept:
+		sh = dict(shdrs[i])
+		if i and sh["sh_type"] != SHT_NOBITS and sh["sh_size"] and sh["sh_offset"] + sh["sh_size"] > segEnd:
+			if sh["sh_flags"] & SHF_ALLOC:
+				return None
+			out += b"\0" * (-len(out) % max(sh["sh_addralign"], 1))
+			newOffset = len(out)
+			out += data[sh["sh_offset"]:sh["sh_offset"] + sh["sh_size"]]
+			sh["sh_offset"] = newOffset
+		if sh["sh_link"]:
+			sh["sh_link"] = index.get(sh["sh_link"], 0)
+		if infoLink(sh):
+			sh["sh_info"] = index.get(sh["sh_info"], 0)
+		newShdrs.append(sh)
+
+	### Symbols name their section by index
+	if any(old != new for new, old in enumerate(kept)):
+		shndxOffset, symSize = SYM_SHNDX[bits]
+		fmt = hd["endian"] + "H"
+		for sh in newShdrs:
+			if sh["sh_type"] not in (SHT_SYMTAB, SHT_DYNSYM):
+				continue
+			for pos in range(sh["sh_offset"], sh["sh_offset"] + sh["sh_size"] - symSize + 1, symSize):
+				shndx, = struct.unpack_from(fmt, out, pos + shndxOffset)
+				if 0 < shndx < SHN_LORESERVE:
+					struct.pack_into(fmt, out, pos + shndxOffset, index.get(shndx, 0))
+
+	out += b"\0" * (-len(out) % (4 * (bits + 1)))
+	hd["e_shoff"] = len(out)
+	hd["e_shnum"] = len(newShdrs)
+	hd["e_shentsize"] = struct.calcsize(hd["endian"] + SHDR_FORMAT[bits])
+	hd["e_shstrndx"] = index[hd["e_shstrndx"]]
+	shdrFormat = hd["endian"] + SHDR_FORMAT[bits]
+	for sh in newShdrs:
+		out += struct.pack(shdrFormat, *[sh[key] for key in SHDR_KEYS])
+	struct.pack_into(hd["endian"] + HEADER_FORMAT[bits], out, IDENT_SIZE, *[hd[key] for key in HEADER_KEYS])
+
+	if len(out) >= len(data):
+		return None
+	return bytes(out)
+
+def infoLink(sh):
+	### sh_info is a section index for relocations and SHF_INFO_LINK sections
+	if sh["sh_type"] in (SHT_REL, SHT_RELA) or sh["sh_flags"] & SHF_INFO_LINK:
+		return sh["sh_info"]
+	return 0
+
+def coveredTail(data, hd, shdrs, start):
+	### True if every non-zero byte after start belongs to a section or the
+	### section header table
+	ranges = [(sh["sh_offset"], sh["sh_offset"] + sh["sh_size"]) for sh in shdrs if sh["sh_type"] != SHT_NOBITS]
+	ranges.append((hd["e_shoff"], hd["e_shoff"] + hd["e_shnum"] * hd["e_shentsize"]))
+	pos = start
+	for begin, end in sorted(ranges):
+		if end <= pos:
+			continue
+		if begin > pos and bytes(data[pos:begin]).strip(b"\0"):
+			return False
+		pos = max(pos, end)
+	return not bytes(data[pos:]).strip(b"\0")
+
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import io
+import copy
+import mmap
+import zlib
+import struct
+import shutil
+import zipfile
+import tempfile
+import uImage
+import SquashFS
+import CramFS
+
+HEADER_MAGIC = b"DH"
+ZIP_MAGIC = b"PK"
+
+def isWebKey(key):
+	### The web interface partitions, web-x.squashfs.img and the like
+	return key.startswith("web")
+
+################################################################################
+###
+### PatchedFile - Read-only file wrapper which presents a 'DH' header as 'PK'
+###
+### Allows opening a Dahua firmware image with zipfile without writing to it.
+###
+class PatchedFile():
+	def __init__(self, fh):
+		self.fh = fh
+
+	def read(self, size=-1):
+		pos = self.fh.tell()
+		data = self.fh.read(size)
+		if pos < len(ZIP_MAGIC) and data:
+			patch = ZIP_MAGIC[pos:pos + len(data)]
+			data = patch + data[len(patch):]
+		return data
+
+	def seek(self, offset, whence=0):
+		return self.fh.seek(offset, whence)
+
+	def tell(self):
+		return self.fh.tell()
+
+	def seekable(self):
+		return True
+
+	def close(self):
+		self.fh.close()
+
+################################################################################
+###
+### FirmwareZip(path) - Open a Dahua firmware image as read-only ZipFile
+###
+### Raises Exception on unknown header, closes the image file on close().
+###
+class FirmwareZip(zipfile.ZipFile):
+	def __init__(self, path):
+		fh = open(path, "rb")
+		header = fh.read(2)
+		fh.seek(0)
+		if header not in (HEADER_MAGIC, ZIP_MAGIC):
+			fh.close()
+			raise Exception("Unknown source header!")
+		self.SourceFile = fh
+		try:
+			super().__init__(PatchedFile(fh))
+		except:
+			fh.close()
+			raise
+
+	def close(self):
+		super().close()
+		self.SourceFile.close()
+
+################################################################################
+###
+### mapMember(zf, info) - Decompress a zip member and map it into memory
+###
+### The member is decompressed to an anonymous temporary file, so only the
+### pages that are actually read are held in memory.
+###
+### Returns:      mmap (or empty bytes for empty members)
+###
+def mapMember(zf, info):
+	if not info.file_size:
+		return b""
+	with tempfile.TemporaryFile() as fh:
+		with zf.open(info) as src:
+			shutil.copyfileobj(src, fh, uImage.BLOCKSIZE)
+		fh.flush()
+		return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+################################################################################
+###
+### openPartition(data) - Identify uImage header and filesystem of a partition
+###
+### Parameters:   data:    bytes-like object (bytes, mmap) holding the partition
+###
+### Returns:      Dictionary with "uImage" (header or None), "offset" (of the
+###               payload), "fstype" ("SquashFS", "CramFS" or None),
+###               "superblock" (header or None) and "fs" (Image or None)
+###
+def openPartition(data):
+	part = {"uImage": None, "offset": 0, "fstype": None, "superblock": None, "fs": None}
+	if len(data) >= uImage.HEADER_SIZE and struct.unpack_from("!L", data)[0] == uImage.HEADER_MAGIC:
+		part["uImage"] = uImage.parseHeader(io.BytesIO(data[:uImage.HEADER_SIZE + 4096]))
+		part["offset"] = uImage.HEADER_SIZE
+		### Images of multi-file images are not looked into
+		if part["uImage"]["imageType"] == uImage.searchTable(uImage.imageType, "multi"):
+			return part
+
+	offset = part["offset"]
+	head = io.BytesIO(data[offset:offset + 4096])
+	if len(data) >= offset + SquashFS.HEADER_SIZE and struct.unpack_from("<I", data, offset)[0] == SquashFS.HEADER_MAGIC:
+		part["fstype"] = "SquashFS"
+		part["superblock"] = SquashFS.parseHeader(head)
+		if part["superblock"]["s_major"] == 4:
+			part["fs"] = SquashFS.Image(data, offset)
+	else:
+		superblock = CramFS.parseHeader(head)
+		if superblock["magic"] == CramFS.HEADER_MAGIC:
+			part["fstype"] = "CramFS"
+			part["superblock"] = superblock
+			part["fs"] = CramFS.Image(data, offset)
+	return part
+
+################################################################################
+###
+### openMember(zf, key) - Open the partition of a key as named by extract.py
+###
+### Parameters:   zf:      FirmwareZip
+###               key:     member name or <member>.<n> for image n of a
+###                        multi-file uImage
+###
+### Returns:      openPartition() dictionary plus "data", None if there is no
+###               such member; release it with closePartition()
+###
+def openMember(zf, key):
+	names = zf.namelist()
+	index = None
+	if key not in names:
+		key, dot, index = key.rpartition(".")
+		if key not in names or not index.isdigit():
+			return None
+		index = int(index)
+
+	data = mapMember(zf, zf.getinfo(key))
+	part = openPartition(data)
+	part["data"] = data
+	if index is None:
+		return part
+
+	header = part["uImage"]
+	if not header or "files" not in header or index >= len(header["files"]):
+		closePartition(part)
+		return None
+	offset, length = uImage.getMultiFileOffsets(header)[index]
+	view = memoryview(data)[offset:offset + length]
+	part = openPartition(view)
+	part["data"] = data
+	part["view"] = view
+	return part
+
+def closePartition(part):
+	if part["fs"]:
+		part["fs"].close()
+	if part.get("view") is not None:
+		part["view"].release()
+	if isinstance(part.get("data"), mmap.mmap):
+		part["data"].close()
+
+################################################################################
+###
+### copyMember(dest, source, name) - Copy a member without recompressing it
+###
+### Parameters:   dest:    ZipFile opened for writing
+###               source:  ZipFile to copy the compressed member from
+###               name:    member name
+###
+def copyMember(dest, source, name):
+	info = source.getinfo(name)
+	source.fp.seek(info.header_offset)
+	header = source.fp.read(zipfile.sizeFileHeader)
+	nameLength, extraLength = struct.unpack("<HH", header[26:30])
+	source.fp.seek(info.header_offset + zipfile.sizeFileHeader + nameLength + extraLength)
+
+	new = copy.copy(info)
+	### Sizes and CRC go into the local header, not a data descriptor
+	new.flag_bits &= ~0x08
+	new.header_offset = dest.fp.tell()
+	dest.fp.write(new.FileHeader())
+	remaining = info.compress_size
+	while remaining:
+		block = source.fp.read(min(remaining, uImage.BLOCKSIZE))
+		if not block:
+			raise zipfile.BadZipFile("Truncated member '%s'" % name)
+		dest.fp.write(block)
+		remaining -= len(block)
+
+	dest.filelist.append(new)
+	dest.NameToInfo[name] = new
+	dest.start_dir = dest.fp.tell()
+	dest._didModify = True
+
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<4sHHHHHHIIIHHHHHII")
+LOCAL_MAGIC = b"\x03\x04"
+CENTRAL_MAGIC = ZIP_MAGIC + b"\x01\x02"
+DESCRIPTOR_MAGIC = ZIP_MAGIC + b"\x07\x08"
+FLAG_DESCRIPTOR = 0x08
+
+################################################################################
+###
+### StreamMember - File-like reader of one member of a FirmwareStream
+###
+### Decompresses while reading and raises zipfile.BadZipFile at the end of the
+### member if its CRC or size does not match.
+###
+class StreamMember(io.RawIOBase):
+	def __init__(self, stream, info):
+		self.Stream = stream
+		self.Info = info
+		if info.compress_type == zipfile.ZIP_DEFLATED:
+			self.Decompressor = zlib.decompressobj(-15)
+		elif info.compress_type == zipfile.ZIP_STORED:
+			self.Decompressor = None
+			if info.flag_bits & FLAG_DESCRIPTOR:
+				raise zipfile.BadZipFile("Stored member '%s' without size can not be streamed" % info.filename)
+		else:
+			raise zipfile.BadZipFile("Compression method %d of '%s' is not supported" % (info.compress_type, info.filename))
+		self.Remaining = None if info.flag_bits & FLAG_DESCRIPTOR else info.compress_size
+		self.Pending = memoryview(b"")
+		self.Crc = 0
+		self.Size = 0
+		self.Done = False
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		while not self.Pending and not self.Done:
+			self.Fill()
+		Length = min(len(b), len(self.Pending))
+		b[:Length] = self.Pending[:Length]
+		self.Pending = self.Pending[Length:]
+		return Length
+
+	def Fill(self):
+		Data = self.Stream.Read(uImage.BLOCKSIZE if self.Remaining is None else min(uImage.BLOCKSIZE, self.Remaining))
+		if self.Remaining is not None:
+			self.Remaining -= len(Data)
+		if not Data and self.Remaining != 0:
+			raise zipfile.BadZipFile("Truncated member '%s'" % self.Info.filename)
+
+		if self.Decompressor:
+			try:
+				Output = self.Decompressor.decompress(Data)
+			except zlib.error as e:
+				raise zipfile.BadZipFile("Corrupt deflate stream of '%s': %s" % (self.Info.filename, e))
+			if self.Decompressor.eof:
+				if self.Remaining:
+					raise zipfile.BadZipFile("Deflate stream of '%s' ends early" % self.Info.filename)
+				self.Stream.Unread(self.Decompressor.unused_data)
+				self.Done = True
+			elif self.Remaining == 0:
+				raise zipfile.BadZipFile("Truncated deflate stream of '%s'" % self.Info.filename)
+		else:
+			Output = Data
+			self.Done = self.Remaining == 0
+
+		self.Crc = zlib.crc32(Output, self.Crc)
+		self.Size += len(Output)
+		self.Pending = memoryview(Output)
+		if self.Done:
+			self.Finish()
+
+	def Finish(self):
+		Info = self.Info
+		if Info.flag_bits & FLAG_DESCRIPTOR:
+			Descriptor = self.Stream.ReadExact(12)
+			# The signature is optional
+			if Descriptor[:4] == DESCRIPTOR_MAGIC:
+				Descriptor = Descriptor[4:] + self.Stream.ReadExact(4)
+			Info.CRC, Info.compress_size, Info.file_size = struct.unpack("<III", Descriptor)
+		if self.Crc != Info.CRC:
+			raise zipfile.BadZipFile("Bad CRC-32 for member '%s'" % Info.filename)
+		if self.Size != Info.file_size:
+			raise zipfile.BadZipFile("Size mismatch for member '%s'" % Info.filename)
+
+################################################################################
+###
+### FirmwareStream(fh) - Read a Dahua firmware image sequentially
+###
+### Parses the local file headers one after another without seeking, so fh can
+### be a pipe or a download in progress. The central directory at the end is
+### compared with the members read.
+###
+class FirmwareStream():
+	def __init__(self, fh):
+		self.File = fh
+		self.Buffer = b""
+		self.Position = 0
+
+	def Read(self, size):
+		if self.Buffer:
+			Data = self.Buffer[:size]
+			self.Buffer = self.Buffer[size:]
+		else:
+			Data = self.File.read(size)
+		self.Position += len(Data)
+		return Data
+
+	def ReadExact(self, size):
+		Data = b""
+		while len(Data) < size:
+			Block = self.Read(size - len(Data))
+			if not Block:
+				raise zipfile.BadZipFile("Unexpected end of stream")
+			Data += Block
+		return Data
+
+	def Unread(self, data):
+		self.Buffer = data + self.Buffer
+		self.Position -= len(data)
+
+	################################################################################
+	###
+	### Members() - Iterate over the members of the stream
+	###
+	### Yields (ZipInfo, StreamMember) in stream order, a member not read to its
+	### end is skipped. Raises zipfile.BadZipFile if the stream is corrupt.
+	###
+	def Members(self):
+		Members = []
+		Magic = (HEADER_MAGIC, ZIP_MAGIC)
+		while True:
+			Offset = self.Position
+			Signature = self.ReadExact(4)
+			if Signature[:2] in Magic and Signature[2:] == LOCAL_MAGIC:
+				pass
+			elif Members and Signature == CENTRAL_MAGIC:
+				self.Unread(Signature)
+				break
+			else:
+				raise zipfile.BadZipFile("Bad local file header at offset %d" % Offset)
+			Magic = (ZIP_MAGIC,)
+
+			Header = LOCAL_HEADER.unpack(Signature + self.ReadExact(LOCAL_HEADER.size - 4))
+			Name = self.ReadExact(Header[9])
+			Extra = self.ReadExact(Header[10])
+
+			Info = zipfile.ZipInfo(Name.decode("utf-8" if Header[2] & 0x800 else "cp437"),
+				((Header[5] >> 9) + 1980, (Header[5] >> 5) & 0xf, Header[5] & 0x1f,
+				Header[4] >> 11, (Header[4] >> 5) & 0x3f, (Header[4] & 0x1f) * 2))
+			Info.flag_bits = Header[2]
+			Info.compress_type = Header[3]
+			Info.CRC, Info.compress_size, Info.file_size = Header[6:9]
+			Info.extra = Extra
+			Info.header_offset = Offset
+
+			Member = StreamMember(self, Info)
+			yield Info, Member
+			# Skip what the caller did not read
+			while Member.read(uImage.BLOCKSIZE):
+				pass
+			Members.append(Info)
+
+		self.CheckCentralDirectory(Members)
+
+	def CheckCentralDirectory(self, members):
+		for Info in members:
+			Header = CENTRAL_HEADER.unpack(self.ReadExact(CENTRAL_HEADER.size))
+			if Header[0] != CENTRAL_MAGIC:
+				raise zipfile.BadZipFile("Central directory has fewer entries than the stream")
+			Name = self.ReadExact(Header[10])
+			self.ReadExact(Header[11] + Header[12])
+			Name = Name.decode("utf-8" if Header[3] & 0x800 else "cp437")
+			if (Name, Header[7], Header[8], Header[9], Header[16]) != (Info.filename, Info.CRC, Info.compress_size, Info.file_size, Info.header_offset):
+				raise zipfile.BadZipFile("Central directory entry of '%s' does not match the stream" % Name)
+
+		# End of central directory record
+		Signature = self.ReadExact(4)
+		if Signature == CENTRAL_MAGIC:
+			raise zipfile.BadZipFile("Central directory has more entries than the stream")
+		while self.Read(uImage.BLOCKSIZE):
+			pass
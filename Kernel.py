@@ -0,0 +1,610 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import io
+import sys
+import bz2
+import json
+import mmap
+import lzma
+import zlib
+import struct
+import logging
+import argparse
+import uImage
+
+### Optional decompressor for LZO compressed kernels
+try:
+	import lzo
+except ImportError:
+	lzo = None
+
+### Signatures of the compressed payload of a zImage (and of a compressed initramfs)
+SIGNATURES = [
+	("gzip", b"\x1f\x8b\x08"),
+	("xz", b"\xfd7zXZ\x00"),
+	("lzma", b"\x5d\x00\x00"),
+	("bzip2", b"BZh"),
+	("lzo", b"\x89LZO\x00\r\n\x1a\n")
+]
+
+BANNER = b"Linux version "
+BANNER_MAX = 1024
+IKCFG_START = b"IKCFG_ST"
+CONFIG_MAX = 1024*1024*4
+
+### ARM zImage header: magic, start and end address at 0x24
+ZIMAGE_FORMAT = "<III"
+ZIMAGE_OFFSET = 0x24
+ZIMAGE_MAGIC = 0x016f2818
+
+CPIO_HEADER_SIZE = 110
+CPIO_MAGICS = [b"070701", b"070702"]
+CPIO_TRAILER = b"TRAILER!!!"
+
+DTB_FORMAT = ">7I"
+DTB_SIZE = struct.calcsize(DTB_FORMAT)
+DTB_MAGIC = 0xd00dfeed
+
+CHUNK_SIZE = 1024*512
+### Input bytes tried when telling a compressed stream from a false match
+PROBE_SIZE = 1024*64
+### Bytes of vmlinux kept between chunks so a match can look ahead
+MARGIN = 4096
+
+# lzop header and block flags
+F_ADLER32_D		= 0x00000001
+F_ADLER32_C		= 0x00000002
+F_H_EXTRA_FIELD	= 0x00000040
+F_CRC32_D		= 0x00000100
+F_CRC32_C		= 0x00000200
+F_H_FILTER		= 0x00000800
+
+################################################################################
+###
+### LzopDecompressor - lzop container decompressor with the interface of
+###                    lzma.LZMADecompressor (decompress, eof, needs_input,
+###                    unused_data)
+###
+class LzopDecompressor():
+	def __init__(self):
+		self.Buffer = b""
+		self.Output = b""
+		self.Flags = None
+		self.eof = False
+		self.needs_input = True
+		self.unused_data = b""
+
+	def decompress(self, data, max_length=-1):
+		if self.eof:
+			raise EOFError("End of stream already reached")
+		self.Buffer += data
+		if self.Flags is None:
+			self.ParseHeader()
+		while self.Flags is not None and not self.eof and (max_length < 0 or len(self.Output) < max_length):
+			if not self.ParseBlock():
+				break
+		if max_length < 0:
+			max_length = len(self.Output)
+		Output, self.Output = self.Output[:max_length], self.Output[max_length:]
+		self.needs_input = not self.eof and not self.Output
+		return Output
+
+	def ParseHeader(self):
+		Data = self.Buffer
+		if len(Data) < 9 + 6:
+			return
+		if Data[:9] != SIGNATURES[-1][1]:
+			raise lzma.LZMAError("Invalid lzop magic")
+		Version, = struct.unpack_from(">H", Data, 9)
+		Pos = 13 if Version < 0x0940 else 15
+		Pos += 1 if Version < 0x0940 else 2
+		if len(Data) < Pos + 4:
+			return
+		Flags, = struct.unpack_from(">I", Data, Pos)
+		Pos += 4
+		if Flags & F_H_FILTER:
+			Pos += 4
+		Pos += 8 if Version < 0x0940 else 12
+		if len(Data) < Pos + 1:
+			return
+		Pos += 1 + Data[Pos] + 4
+		if Flags & F_H_EXTRA_FIELD:
+			if len(Data) < Pos + 4:
+				return
+			Pos += 4 + struct.unpack_from(">I", Data, Pos)[0] + 4
+		if len(Data) < Pos:
+			return
+		self.Flags = Flags
+		self.Buffer = Data[Pos:]
+
+	def ParseBlock(self):
+		Data = self.Buffer
+		if len(Data) < 4:
+			return False
+		DstLen, = struct.unpack_from(">I", Data)
+		if DstLen == 0:
+			self.eof = True
+			self.unused_data = Data[4:]
+			self.Buffer = b""
+			return False
+		if len(Data) < 8:
+			return False
+		SrcLen, = struct.unpack_from(">I", Data, 4)
+		Pos = 8
+		Pos += 4 * bool(self.Flags & F_ADLER32_D) + 4 * bool(self.Flags & F_CRC32_D)
+		if SrcLen < DstLen:
+			Pos += 4 * bool(self.Flags & F_ADLER32_C) + 4 * bool(self.Flags & F_CRC32_C)
+		if SrcLen > DstLen or DstLen > 64*1024*1024:
+			raise lzma.LZMAError("Invalid lzop block")
+		if len(Data) < Pos + SrcLen:
+			return False
+		Block = Data[Pos:Pos + SrcLen]
+		if SrcLen < DstLen:
+			Block = lzo.decompress(Block, False, DstLen)
+		self.Output += Block
+		self.Buffer = Data[Pos + SrcLen:]
+		return True
+
+def decompressor(name):
+	if name == "gzip":
+		return zlib.decompressobj(16 + zlib.MAX_WBITS)
+	if name == "xz":
+		return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+	if name == "lzma":
+		return lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+	if name == "bzip2":
+		return bz2.BZ2Decompressor()
+	if name == "lzo" and lzo:
+		return LzopDecompressor()
+	return None
+
+################################################################################
+###
+### Stream - Incremental decompression of one stream
+###
+### Feed() yields the output in pieces of at most CHUNK_SIZE bytes, so a
+### highly compressed input never has to be held in memory as a whole.
+###
+class Stream():
+	def __init__(self, name):
+		self.Name = name
+		self.Decompressor = decompressor(name)
+		self.Size = 0
+
+	@property
+	def eof(self):
+		return self.Decompressor.eof
+
+	def Feed(self, data):
+		Decompressor = self.Decompressor
+		if hasattr(Decompressor, "unconsumed_tail"):
+			Output = Decompressor.decompress(data, CHUNK_SIZE)
+			while True:
+				self.Size += len(Output)
+				if Output:
+					yield Output
+				if Decompressor.eof or not Decompressor.unconsumed_tail:
+					break
+				Output = Decompressor.decompress(Decompressor.unconsumed_tail, CHUNK_SIZE)
+		else:
+			Output = Decompressor.decompress(data, CHUNK_SIZE)
+			while True:
+				self.Size += len(Output)
+				if Output:
+					yield Output
+				if Decompressor.eof or Decompressor.needs_input:
+					break
+				Output = Decompressor.decompress(b"", CHUNK_SIZE)
+
+	### Input bytes of data following the end of the stream
+	def Unused(self):
+		return len(self.Decompressor.unused_data)
+
+################################################################################
+###
+### matches(data, start, end, names) - Offsets of compression signatures
+###
+### Returns:      sorted list of (offset, name) within [start, end)
+###
+def matches(data, start, end, names=None):
+	found = []
+	for name, magic in SIGNATURES:
+		if names and name not in names:
+			continue
+		pos = data.find(magic, start, end + len(magic) - 1)
+		while pos >= 0:
+			if name != "lzma" or plausibleLzma(data, pos):
+				found.append((pos, name))
+			pos = data.find(magic, pos + 1, end + len(magic) - 1)
+	found.sort()
+	return found
+
+def plausibleLzma(data, offset):
+	### "5d 00 00" is common, check dictionary and uncompressed size of the header
+	if len(data) < offset + 13:
+		return False
+	dictSize, size = struct.unpack_from("<IQ", data, offset + 1)
+	return dictSize & (dictSize - 1) == 0 and 1 << 12 <= dictSize <= 1 << 27 and (size == 2**64 - 1 or size < 1 << 32)
+
+################################################################################
+###
+### Cpio - Track a newc cpio archive fed in pieces until its trailer
+###
+### Feed() writes the bytes belonging to the archive to out and returns how
+### many bytes of data it used. Raises ValueError on an invalid header.
+###
+class Cpio():
+	def __init__(self, out=None):
+		self.Out = out
+		self.Header = b""
+		self.HeaderSize = None
+		self.NameSize = 0
+		self.FileSize = 0
+		self.Skip = 0
+		self.Files = 0
+		self.Size = 0
+		self.Done = False
+
+	def Feed(self, data):
+		Used = 0
+		while Used < len(data) and not self.Done:
+			if self.Skip:
+				Count = min(self.Skip, len(data) - Used)
+				self.Skip -= Count
+				Used += Count
+				continue
+			Want = CPIO_HEADER_SIZE if self.HeaderSize is None else self.HeaderSize
+			Count = min(Want - len(self.Header), len(data) - Used)
+			self.Header += data[Used:Used + Count]
+			Used += Count
+			if self.HeaderSize is None and len(self.Header) == CPIO_HEADER_SIZE:
+				Fields = parseCpioHeader(self.Header)
+				if not Fields:
+					raise ValueError("Invalid cpio header")
+				self.NameSize = Fields[11]
+				self.FileSize = Fields[6]
+				self.HeaderSize = (CPIO_HEADER_SIZE + self.NameSize + 3) & ~3
+			elif self.HeaderSize is not None and len(self.Header) == self.HeaderSize:
+				Name = self.Header[CPIO_HEADER_SIZE:CPIO_HEADER_SIZE + self.NameSize].rstrip(b"\0")
+				if Name == CPIO_TRAILER:
+					self.Done = True
+				else:
+					self.Files += 1
+					self.Skip = (self.FileSize + 3) & ~3
+				self.Header = b""
+				self.HeaderSize = None
+
+		if self.Out:
+			self.Out.write(data[:Used])
+		self.Size += Used
+		return Used
+
+def parseCpioHeader(header):
+	### Returns the 13 header fields (ino, mode, uid, gid, nlink, mtime, filesize,
+	### devmajor, devminor, rdevmajor, rdevminor, namesize, check) or None
+	if len(header) < CPIO_HEADER_SIZE or bytes(header[:6]) not in CPIO_MAGICS:
+		return None
+	try:
+		fields = [int(header[6 + i * 8:14 + i * 8], 16) for i in range(13)]
+	except ValueError:
+		return None
+	if not 1 < fields[11] < 4096:
+		return None
+	return fields
+
+################################################################################
+###
+### Scanner - Look for the banner, IKCONFIG and initramfs in a vmlinux
+###
+### The vmlinux is fed in pieces as it is decompressed, only the last MARGIN
+### bytes are kept. The config and a compressed initramfs are decompressed by
+### streams of their own which are fed alongside.
+###
+### Parameters:   initramfs:  file object the initramfs is written to, or None
+###
+class Scanner():
+	def __init__(self, initramfs=None):
+		self.Version = None
+		self.Config = None
+		self.Initramfs = None
+		self.Out = initramfs
+		self.Window = b""
+		self.Base = 0
+		self.Size = 0
+		self.ConfigStream = None
+		self.ConfigData = bytearray()
+		self.InitramfsStream = None
+		self.Cpio = None
+
+	def Feed(self, data, final=False):
+		Buffer = self.Window + data
+		New = self.Size - self.Base
+		self.Size = self.Base + len(Buffer)
+		self.Advance(Buffer[New:])
+
+		Limit = len(Buffer) if final else max(len(Buffer) - MARGIN, 0)
+		if Limit:
+			self.Scan(Buffer, Limit)
+		self.Window = Buffer[Limit:]
+		self.Base += Limit
+
+	def Finish(self):
+		self.Feed(b"", True)
+		if self.ConfigStream:
+			logging.getLogger(__name__).warning("IKCONFIG is truncated.")
+			self.ConfigStream = None
+		if self.Initramfs and not self.Cpio.Done:
+			logging.getLogger(__name__).warning("Initramfs is truncated.")
+
+	def Advance(self, data):
+		if not data:
+			return
+		if self.ConfigStream:
+			self.FeedConfig(data)
+		if self.Cpio and not self.Cpio.Done:
+			self.FeedInitramfs(data)
+
+	def FeedInitramfs(self, data):
+		try:
+			if self.InitramfsStream:
+				for Output in self.InitramfsStream.Feed(data):
+					self.Cpio.Feed(Output)
+			else:
+				self.Cpio.Feed(data)
+		except (zlib.error, lzma.LZMAError, OSError, EOFError, ValueError) as e:
+			logging.getLogger(__name__).warning("Initramfs is corrupt: %s", e)
+			self.Initramfs["error"] = str(e)
+			self.Cpio.Done = True
+		self.Initramfs["size"] = self.Cpio.Size
+		self.Initramfs["files"] = self.Cpio.Files
+		self.Initramfs["complete"] = self.Cpio.Done and "error" not in self.Initramfs
+
+	def Scan(self, data, limit):
+		if self.Version is None:
+			Pos = data.find(BANNER, 0, limit)
+			while Pos >= 0:
+				if data[Pos + len(BANNER):Pos + len(BANNER) + 1].isdigit():
+					End = min([x for x in (data.find(b"\n", Pos, Pos + BANNER_MAX), data.find(b"\0", Pos, Pos + BANNER_MAX)) if x >= 0],
+							  default=min(len(data), Pos + BANNER_MAX))
+					self.Version = bytes(data[Pos:End]).decode("ascii", errors="replace")
+					break
+				Pos = data.find(BANNER, Pos + 1, limit)
+
+		if self.Config is None and self.ConfigStream is None:
+			Pos = data.find(IKCFG_START, 0, limit)
+			if Pos >= 0:
+				self.ConfigStream = Stream("gzip")
+				self.FeedConfig(data[Pos + len(IKCFG_START):])
+
+		if self.Initramfs is None:
+			Candidates = matches(data, 0, limit, ["gzip", "xz", "lzma", "bzip2", "lzo"])
+			Pos = data.find(CPIO_MAGICS[0], 0, limit)
+			while Pos >= 0:
+				Candidates.append((Pos, None))
+				Pos = data.find(CPIO_MAGICS[0], Pos + 1, limit)
+			for Pos, Name in sorted(Candidates, key=lambda x: x[0]):
+				if self.StartInitramfs(data, Pos, Name):
+					break
+
+	def FeedConfig(self, data):
+		try:
+			for Output in self.ConfigStream.Feed(data):
+				self.ConfigData += Output
+				if len(self.ConfigData) > CONFIG_MAX:
+					raise ValueError("too large")
+		except (zlib.error, ValueError) as e:
+			logging.getLogger(__name__).warning("IKCONFIG is corrupt: %s", e)
+			self.ConfigStream = None
+			self.Config = b""
+			return
+		if self.ConfigStream.eof:
+			self.Config = bytes(self.ConfigData)
+			self.ConfigStream = None
+
+	def StartInitramfs(self, data, pos, name):
+		if name is None:
+			if not parseCpioHeader(data[pos:pos + CPIO_HEADER_SIZE]):
+				return False
+			self.Cpio = Cpio(self.Out)
+			self.Initramfs = {"offset": self.Base + pos, "compression": None, "size": 0, "files": 0, "complete": False}
+			self.FeedInitramfs(data[pos:])
+			return True
+
+		if name == "lzo" and not lzo:
+			return False
+		### The first output must be a cpio header
+		Probe = Stream(name)
+		Head = b""
+		try:
+			for Output in Probe.Feed(data[pos:pos + PROBE_SIZE]):
+				Head += Output
+				if len(Head) >= CPIO_HEADER_SIZE:
+					break
+		except (zlib.error, lzma.LZMAError, OSError, EOFError, ValueError):
+			return False
+		if not parseCpioHeader(Head):
+			return False
+
+		self.InitramfsStream = Stream(name)
+		self.Cpio = Cpio(self.Out)
+		self.Initramfs = {"offset": self.Base + pos, "compression": name, "size": 0, "files": 0, "complete": False}
+		self.FeedInitramfs(data[pos:])
+		return True
+
+################################################################################
+###
+### findDtbs(data, start) - Flattened device trees appended to a zImage
+###
+### Returns:      list of (offset, size)
+###
+def findDtbs(data, start=0):
+	dtbs = []
+	magic = struct.pack(">I", DTB_MAGIC)
+	pos = data.find(magic, start)
+	while pos >= 0:
+		if len(data) >= pos + DTB_SIZE:
+			magic_, size, offStruct, offStrings, offRsvmap, version, lastComp = struct.unpack_from(DTB_FORMAT, data, pos)
+			if 16 <= version <= 17 and lastComp <= 17 and DTB_SIZE <= size <= len(data) - pos and \
+					offStruct < size and offStrings <= size and offRsvmap < size:
+				dtbs.append((pos, size))
+				pos = data.find(magic, pos + size)
+				continue
+		pos = data.find(magic, pos + 1)
+	return dtbs
+
+################################################################################
+###
+### inspect(data, dest) - Inspect a kernel image
+###
+### Parameters:   data:    bytes-like object (bytes, mmap) holding kernel.img
+###                        (uImage, zImage, compressed or plain Image)
+###               dest:    directory for "version", "config", "initramfs.cpio",
+###                        "<n>.dtb" and "kernel.json", or None
+###
+### Returns:      summary dictionary as written to kernel.json
+###
+def inspect(data, dest=None):
+	Logger = logging.getLogger(__name__)
+	Summary = {"uImage": None, "zImage": None, "compression": None, "offset": None, "compressed_size": None,
+			   "size": None, "version": None, "config": False, "initramfs": None, "dtbs": []}
+
+	Start = 0
+	End = len(data)
+	if len(data) >= uImage.HEADER_SIZE and struct.unpack_from("!L", data)[0] == uImage.HEADER_MAGIC:
+		hd = uImage.parseHeader(io.BytesIO(data[:uImage.HEADER_SIZE]))
+		Summary["uImage"] = {
+			"name": hd["name"].rstrip(b"\0").decode("ascii", errors="replace"),
+			"arch": uImage.fromTable(uImage.archType, hd["arch"]),
+			"os": uImage.fromTable(uImage.osType, hd["osType"]),
+			"type": uImage.fromTable(uImage.imageType, hd["imageType"]),
+			"compression": uImage.fromTable(uImage.compressType, hd["compression"]),
+			"load": hd["loadAddr"], "entry": hd["entryAddr"], "size": hd["size"]
+		}
+		Start = uImage.HEADER_SIZE
+		End = min(End, Start + hd["size"])
+
+	if len(data) >= Start + ZIMAGE_OFFSET + 12:
+		Magic, ZStart, ZEnd = struct.unpack_from(ZIMAGE_FORMAT, data, Start + ZIMAGE_OFFSET)
+		if Magic == ZIMAGE_MAGIC and ZStart < ZEnd:
+			Summary["zImage"] = {"start": ZStart, "end": ZEnd}
+
+	if dest:
+		os.makedirs(dest, exist_ok=True)
+	InitramfsPath = os.path.join(dest, "initramfs.cpio") if dest else None
+
+	Found = None
+	for Offset, Name in matches(data, Start, End):
+		if Name == "lzo" and not lzo:
+			Logger.warning("Possible LZO compressed kernel at %#x, install python-lzo to read it.", Offset)
+			continue
+		Result = scanStream(data, Offset, End, Name, InitramfsPath)
+		if Result:
+			Found = Result
+			Summary["compression"] = Name
+			Summary["offset"] = Offset
+			Summary["compressed_size"] = Result[1] - Offset
+			break
+
+	if not Found:
+		### Uncompressed Image
+		Found = scanStream(data, Start, End, None, InitramfsPath)
+	if Found:
+		Vmlinux, StreamEnd, Size = Found
+		Summary["size"] = Size
+		Summary["version"] = Vmlinux.Version
+		Summary["config"] = bool(Vmlinux.Config)
+		Summary["initramfs"] = Vmlinux.Initramfs
+		if dest and Vmlinux.Version:
+			with open(os.path.join(dest, "version"), "w") as fh:
+				fh.write(Vmlinux.Version + "\n")
+		if dest and Vmlinux.Config:
+			with open(os.path.join(dest, "config"), "wb") as fh:
+				fh.write(Vmlinux.Config)
+		DtbStart = StreamEnd
+		if Summary["zImage"]:
+			DtbStart = max(DtbStart, Start + Summary["zImage"]["end"] - Summary["zImage"]["start"])
+	else:
+		DtbStart = Start
+
+	if InitramfsPath and not Summary["initramfs"] and os.path.exists(InitramfsPath):
+		os.remove(InitramfsPath)
+
+	for Index, (Offset, Size) in enumerate(findDtbs(data, DtbStart)):
+		Entry = {"offset": Offset, "size": Size}
+		if dest:
+			Entry["file"] = "%d.dtb" % Index
+			with open(os.path.join(dest, Entry["file"]), "wb") as fh:
+				fh.write(data[Offset:Offset + Size])
+		Summary["dtbs"].append(Entry)
+
+	if dest:
+		with open(os.path.join(dest, "kernel.json"), "w") as fh:
+			json.dump(Summary, fh, indent="\t")
+	return Summary
+
+################################################################################
+###
+### scanStream(data, offset, end, name, initramfs) - Decompress a candidate
+###                                                   payload through a Scanner
+###
+### Parameters:   name:       compression, None for an uncompressed Image
+###               initramfs:  path the initramfs is written to, or None
+###
+### Returns:      (Scanner, end offset of the stream, vmlinux size), None if
+###               it is not a complete stream holding a kernel banner
+###
+def scanStream(data, offset, end, name, initramfs=None):
+	Out = open(initramfs, "wb") if initramfs else None
+	try:
+		Vmlinux = Scanner(Out)
+		if name is None:
+			for Pos in range(offset, end, CHUNK_SIZE):
+				Vmlinux.Feed(data[Pos:min(Pos + CHUNK_SIZE, end)])
+			Vmlinux.Finish()
+			return (Vmlinux, end, end - offset) if Vmlinux.Version else None
+
+		Payload = Stream(name)
+		Pos = offset
+		try:
+			while not Payload.eof:
+				Input = data[Pos:min(Pos + CHUNK_SIZE, end)]
+				if not Input:
+					return None
+				Pos += len(Input)
+				for Output in Payload.Feed(Input):
+					Vmlinux.Feed(Output)
+				### A false match fails early, don't decompress megabytes of garbage
+				if Vmlinux.Size == 0 and Pos - offset >= PROBE_SIZE:
+					return None
+		except (zlib.error, lzma.LZMAError, OSError, EOFError, ValueError):
+			return None
+		Vmlinux.Finish()
+		if not Vmlinux.Version:
+			return None
+		return Vmlinux, Pos - Payload.Unused(), Payload.Size
+	finally:
+		if Out:
+			Out.close()
+
+
+def main():
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+
+	parser = argparse.ArgumentParser(description="Show version, config, initramfs and DTBs of a kernel image.")
+	parser.add_argument("-o", "--output", help="Directory to write version, config, initramfs.cpio and DTBs to")
+	parser.add_argument("kernel", help="kernel.img (uImage, zImage or Image)")
+	args = parser.parse_args()
+
+	with open(args.kernel, "rb") as fh:
+		data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		summary = inspect(data, args.output)
+	finally:
+		data.close()
+	json.dump(summary, sys.stdout, indent="\t")
+	print()
+	return 0 if summary["version"] else 1
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import stat
+import json
+import mmap
+import hashlib
+import logging
+import threading
+import concurrent.futures
+import Staging
+
+### Manifests of an extracted firmware: <dir>/manifest.sha256 for everything,
+### <dir>/manifest/<Key>.sha256 per partition
+MANIFEST_FILE = "manifest.sha256"
+MANIFEST_DIR = "manifest"
+
+################################################################################
+###
+### hashFile(path) - SHA-256 of a file, read through mmap
+###
+### hashlib releases the GIL while hashing the mapping, several files hash in
+### parallel on a thread pool.
+###
+def hashFile(path):
+	digest = hashlib.sha256()
+	with open(path, "rb") as fh:
+		if os.fstat(fh.fileno()).st_size:
+			data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				digest.update(data)
+			finally:
+				data.close()
+	return digest.hexdigest()
+
+def formatLine(digest, path):
+	### Same as sha256sum, names with a backslash or newline are escaped
+	if "\\" in path or "\n" in path:
+		return "\\%s  %s\n" % (digest, path.replace("\\", "\\\\").replace("\n", "\\n"))
+	return "%s  %s\n" % (digest, path)
+
+class Manifest():
+	################################################################################
+	###
+	### Manifest(cachePath, jobs) - Hash the files of extracted partitions
+	###
+	### Parameters:   cachePath: JSON file remembering the hash of every file by
+	###                          (device, inode, mtime, size), None for no cache
+	###               jobs:      number of hashing threads (Default: CPUs)
+	###
+	def __init__(self, cachePath=None, jobs=None, debug=False):
+		self.CachePath = cachePath
+		self.Jobs = jobs if jobs else os.cpu_count()
+		self.Logger = logging.getLogger(__class__.__name__)
+		if debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+		self.Lock = threading.Lock()
+		self.Used = {}
+		self.Cache = {}
+		if self.CachePath:
+			try:
+				with open(self.CachePath, "r") as fp:
+					self.Cache = json.load(fp)
+			except (FileNotFoundError, ValueError):
+				self.Cache = {}
+
+	def SaveCache(self):
+		if not self.CachePath:
+			return
+		fp, TmpPath = Staging.tempFile(self.CachePath)
+		with fp:
+			fp.write(json.dumps(self.Cache, separators=(",", ":")).encode("utf-8"))
+		os.replace(TmpPath, self.CachePath)
+
+	def HashCached(self, path, st):
+		CacheKey = "%d:%d:%d:%d" % (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+		Digest = self.Cache.get(CacheKey)
+		Cached = Digest is not None
+		if not Cached:
+			Digest = hashFile(path)
+		with self.Lock:
+			self.Used[CacheKey] = Digest
+		return Digest, Cached
+
+	################################################################################
+	###
+	### Hash(trees) - Hash every regular file below the given directories
+	###
+	### Parameters:   trees:   dictionary name -> directory
+	###
+	### Returns:      (dictionary name -> sorted list of (relative path, sha256),
+	###               number of files and directories which could not be read),
+	###               those are logged and left out
+	###
+	def Hash(self, trees):
+		Jobs = []
+		Errors = []
+		for Name, Tree in trees.items():
+			### A directory which can not be listed would be left out silently
+			for Root, Dirs, Files in os.walk(Tree, onerror=lambda e, Name=Name: Errors.append((Name, e))):
+				for File in Files:
+					Path = os.path.join(Root, File)
+					st = os.lstat(Path)
+					if stat.S_ISREG(st.st_mode):
+						Jobs.append((Name, os.path.relpath(Path, Tree), Path, st))
+
+		for Name, e in Errors:
+			self.Logger.error("'%s': can not read '%s': %s", Name, e.filename, e.strerror)
+		Errors = len(Errors)
+
+		Result = {Name: [] for Name in trees}
+		Hashed = 0
+		self.Used = {}
+		with concurrent.futures.ThreadPoolExecutor(self.Jobs) as Executor:
+			Futures = [(Name, RelPath, Executor.submit(self.HashCached, Path, st)) for Name, RelPath, Path, st in Jobs]
+			for Name, RelPath, Future in Futures:
+				try:
+					Digest, Cached = Future.result()
+				except OSError as e:
+					self.Logger.error("'%s': can not hash '%s': %s", Name, RelPath, e.strerror)
+					Errors += 1
+					continue
+				Hashed += not Cached
+				Result[Name].append((RelPath, Digest))
+
+		for Entries in Result.values():
+			Entries.sort(key=lambda Entry: Entry[0].encode("utf-8", errors="surrogateescape"))
+		self.Logger.debug("Hashed %d of %d file(s), the others were cached.", Hashed, len(Jobs))
+		### Forget files which are gone
+		self.Cache = self.Used
+		self.SaveCache()
+		return Result, Errors
+
+	################################################################################
+	###
+	### Write(source, dest, keys) - Write the manifests of an extracted firmware
+	###
+	### Parameters:   source:  <firmware.bin>.extracted
+	###               dest:    directory for manifest.sha256 and manifest/
+	###                        (Default: source)
+	###               keys:    partitions (Default: every <Key>.extracted)
+	###
+	### Paths in <Key>.sha256 are relative to <Key>.extracted, those of
+	### manifest.sha256 to source, both are sorted and can be checked with
+	### sha256sum -c.
+	###
+	### Returns:      digest of manifest.sha256, e.g. to sign it, None if a file
+	###               could not be hashed, no manifest is written then
+	###
+	def Write(self, source, dest=None, keys=None):
+		Dest = dest if dest else source
+		if keys is None:
+			keys = [Name[:-len(".extracted")] for Name in sorted(os.listdir(source)) if Name.endswith(".extracted")]
+		Trees = {Key: os.path.join(source, Key + ".extracted") for Key in keys if os.path.isdir(os.path.join(source, Key + ".extracted"))}
+		Result, Errors = self.Hash(Trees)
+		if Errors:
+			self.Logger.error("Could not read %d file(s)/directories, not writing an incomplete manifest.", Errors)
+			return None
+
+		os.makedirs(os.path.join(Dest, MANIFEST_DIR), exist_ok=True)
+		Lines = []
+		for Key in sorted(Result):
+			Partition = [formatLine(Digest, RelPath) for RelPath, Digest in Result[Key]]
+			self.WriteFile(os.path.join(Dest, MANIFEST_DIR, Key + ".sha256"), "".join(Partition))
+			Lines.extend(formatLine(Digest, os.path.join(Key + ".extracted", RelPath)) for RelPath, Digest in Result[Key])
+
+		Data = "".join(Lines)
+		self.WriteFile(os.path.join(Dest, MANIFEST_FILE), Data)
+		Digest = hashlib.sha256(Data.encode("utf-8", errors="surrogateescape")).hexdigest()
+		self.Logger.info("Wrote manifest of %d file(s) in %d partition(s), SHA-256 %s.", len(Lines), len(Result), Digest)
+		return Digest
+
+	def WriteFile(self, path, text):
+		fp, TmpPath = Staging.tempFile(path)
+		with fp:
+			fp.write(text.encode("utf-8", errors="surrogateescape"))
+		os.replace(TmpPath, path)
+
+
+def main():
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+
+	parser = argparse.ArgumentParser(description="Write sorted SHA-256 manifests of the files of an extracted firmware.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-o", "--output", metavar="DIR", help="Where to write manifest.sha256 and manifest/. (Default: the extracted firmware)")
+	parser.add_argument("-c", "--cache", metavar="FILE", help="Remember file hashes by inode/mtime/size in FILE")
+	parser.add_argument("-j", "--jobs", type=int, help="Number of hashing threads. (Default: number of CPUs)")
+	parser.add_argument("-k", "--key", action="append", help="Partition to include, may be repeated (Default: all extracted partitions)")
+	parser.add_argument("source", help="Extracted firmware")
+	args = parser.parse_args()
+
+	if not os.path.isdir(args.source):
+		print("No such directory: '%s'" % args.source, file=sys.stderr)
+		return 1
+	# Need root to read all files.
+	if os.geteuid() != 0:
+		print("Writing manifests needs root to read every extracted file, please run with sudo.", file=sys.stderr)
+		return 1
+	manifest = Manifest(args.cache, args.jobs, args.verbose)
+	Digest = manifest.Write(args.source, args.output, args.key)
+	if not Digest:
+		return 1
+	print(Digest)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
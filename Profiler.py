@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import time
+import json
+import resource
+import threading
+from contextlib import contextmanager
+
+### CPU time of the calling thread, stages run on several threads at once
+THREAD_USAGE = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+################################################################################
+###
+### Profiler - Collects timing, throughput and resource usage of build/extract stages
+###
+### Every stage is wrapped in a Span() context manager which records wall time,
+### CPU time of the calling thread, CPU time of waited-for subprocesses
+### (RUSAGE_CHILDREN) and the number of bytes the stage processed.
+###
+### The kernel only counts subprocesses for the whole process: the child CPU
+### of a span running at the same time as a span of another thread includes
+### the tools of both, such spans are marked "shared".
+###
+class Profiler():
+	def __init__(self):
+		self.Spans = []
+		self.Lock = threading.Lock()
+		self.Origin = time.perf_counter()
+		self.Pid = os.getpid()
+
+	@contextmanager
+	def Span(self, name, **args):
+		Span = {"name": name, "args": args, "bytes": 0}
+		SelfStart = resource.getrusage(THREAD_USAGE)
+		ChildStart = resource.getrusage(resource.RUSAGE_CHILDREN)
+		Start = time.perf_counter()
+		try:
+			yield Span
+		finally:
+			End = time.perf_counter()
+			SelfEnd = resource.getrusage(THREAD_USAGE)
+			ChildEnd = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+			Span["start"] = Start - self.Origin
+			Span["wall"] = End - Start
+			Span["cpu_user"] = SelfEnd.ru_utime - SelfStart.ru_utime
+			Span["cpu_system"] = SelfEnd.ru_stime - SelfStart.ru_stime
+			Span["child_cpu_user"] = ChildEnd.ru_utime - ChildStart.ru_utime
+			Span["child_cpu_system"] = ChildEnd.ru_stime - ChildStart.ru_stime
+			Span["tid"] = threading.get_ident()
+			with self.Lock:
+				self.Spans.append(Span)
+
+	def MarkShared(self):
+		### Spans of other threads overlapping in time, nested spans of the
+		### same thread are not
+		Spans = sorted(self.Spans, key=lambda Span: Span["start"])
+		for Span in Spans:
+			Span["shared"] = False
+		for i, Span in enumerate(Spans):
+			End = Span["start"] + Span["wall"]
+			for Other in Spans[i + 1:]:
+				if Other["start"] >= End:
+					break
+				if Other["tid"] != Span["tid"]:
+					Span["shared"] = Other["shared"] = True
+
+	################################################################################
+	###
+	### Totals() - Sum up the spans of every stage
+	###
+	### Returns:      dictionary name -> "count", "wall" (time any span of the
+	###               stage ran, overlapping spans counted once), "busy" (sum of
+	###               the span wall times), "cpu", "child_cpu", "child_cpu_shared"
+	###               (child_cpu includes tools of other stages), "bytes" and
+	###               "throughput" (bytes per second of wall)
+	###
+	def Totals(self):
+		with self.Lock:
+			self.MarkShared()
+			Spans = list(self.Spans)
+		Totals = {}
+		Intervals = {}
+		for Span in Spans:
+			Total = Totals.setdefault(Span["name"], {"count": 0, "wall": 0.0, "busy": 0.0, "cpu": 0.0, "child_cpu": 0.0,
+													 "child_cpu_shared": False, "bytes": 0})
+			Total["count"] += 1
+			Total["busy"] += Span["wall"]
+			Total["cpu"] += Span["cpu_user"] + Span["cpu_system"]
+			Total["child_cpu"] += Span["child_cpu_user"] + Span["child_cpu_system"]
+			Total["child_cpu_shared"] |= Span["shared"]
+			Total["bytes"] += Span["bytes"]
+			Intervals.setdefault(Span["name"], []).append((Span["start"], Span["start"] + Span["wall"]))
+
+		for Name, Total in Totals.items():
+			End = None
+			for Start, Stop in sorted(Intervals[Name]):
+				if End is None or Start > End:
+					Total["wall"] += Stop - Start
+					End = Stop
+				elif Stop > End:
+					Total["wall"] += Stop - End
+					End = Stop
+			Total["throughput"] = Total["bytes"] / Total["wall"] if Total["wall"] else 0.0
+		return Totals
+
+	def Report(self):
+		SelfUsage = resource.getrusage(resource.RUSAGE_SELF)
+		ChildUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+		return {
+			"wall": time.perf_counter() - self.Origin,
+			# ru_maxrss is in kilobytes on Linux
+			"peak_rss": SelfUsage.ru_maxrss * 1024,
+			"child_peak_rss": ChildUsage.ru_maxrss * 1024,
+			"stages": self.Totals(),
+			"spans": self.Spans
+		}
+
+	################################################################################
+	###
+	### Write(path) - Write report as Chrome trace (chrome://tracing, Perfetto)
+	###
+	### The summary is stored in "otherData", so the file is a plain JSON report as well.
+	###
+	def Write(self, path):
+		Report = self.Report()
+		del Report["spans"]
+
+		Events = []
+		for Span in self.Spans:
+			Args = dict(Span["args"])
+			Args["bytes"] = Span["bytes"]
+			Args["cpu"] = Span["cpu_user"] + Span["cpu_system"]
+			Args["child_cpu"] = Span["child_cpu_user"] + Span["child_cpu_system"]
+			Args["child_cpu_shared"] = Span.get("shared", False)
+			Events.append({
+				"name": Span["name"],
+				"cat": "stage",
+				"ph": "X",
+				"ts": int(Span["start"] * 1000000),
+				"dur": int(Span["wall"] * 1000000),
+				"pid": self.Pid,
+				"tid": Span["tid"],
+				"args": Args
+			})
+
+		with open(path, "w") as fp:
+			json.dump({"traceEvents": Events, "displayTimeUnit": "ms", "otherData": Report}, fp, indent=1, default=str)
+
+	def Dump(self, logger):
+		Report = self.Report()
+		logger.info("Total %.2fs, peak RSS %.1f MiB (children %.1f MiB)",
+			Report["wall"], Report["peak_rss"] / 1048576, Report["child_peak_rss"] / 1048576)
+		for Name, Total in sorted(Report["stages"].items(), key=lambda x: -x[1]["wall"]):
+			# ~ marks child CPU shared with stages running at the same time
+			logger.info("%-12s %3dx %8.2fs cpu %6.2fs child %s%6.2fs %10d bytes %8.1f MiB/s", Name, Total["count"],
+				Total["wall"], Total["cpu"], "~" if Total["child_cpu_shared"] else " ", Total["child_cpu"], Total["bytes"],
+				Total["throughput"] / 1048576)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import signal
+import shutil
+import asyncio
+import logging
+import threading
+import subprocess
+import concurrent.futures
+
+### Seconds a tool may run before it is killed, missing tools have no limit
+TIMEOUTS = {
+	"sudo": 120,
+	"unsquashfs": 1800,
+	"cramfsck": 1800,
+	"mksquashfs": 3600,
+	"mkcramfs": 1800,
+	"mkimage": 300
+}
+
+### Concurrent runs per tool, on top of the overall job limit
+### (unsquashfs/mksquashfs use all CPUs on their own)
+LIMITS = {
+	"unsquashfs": 1,
+	"mksquashfs": 1
+}
+
+### Seconds between SIGTERM and SIGKILL
+KILL_GRACE = 5
+
+### unsquashfs/mksquashfs progress bar: "[=====    ] 123/456  27%"
+PROGRESS_RE = re.compile(rb"(\d+)/(\d+)\s+(\d+)%")
+
+################################################################################
+###
+### Runner - Runs external tools from an asyncio event loop in its own thread
+###
+### Every tool runs in its own process group with a timeout, its output is
+### parsed for progress. On timeout, Cancel() or SIGINT the whole group is
+### terminated and the partial outputs are removed.
+###
+### Parameters:   debug:     log the commands and their output
+###               jobs:      overall number of concurrently running tools
+###               timeouts:  tool name -> seconds, updates TIMEOUTS
+###               limits:    tool name -> concurrent runs, updates LIMITS
+###
+class Runner():
+	def __init__(self, debug, jobs=None, timeouts=None, limits=None):
+		self.Debug = debug
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+		self.Jobs = jobs if jobs else os.cpu_count()
+		self.Timeouts = dict(TIMEOUTS)
+		if timeouts:
+			self.Timeouts.update(timeouts)
+		self.Limits = dict(LIMITS)
+		if limits:
+			self.Limits.update(limits)
+		self.Semaphores = None
+		self.Tasks = set()
+		self.Lock = threading.Lock()
+		self.Authenticated = False
+
+		self.Loop = asyncio.new_event_loop()
+		self.Thread = threading.Thread(target=self.Loop.run_forever, name=__class__.__name__, daemon=True)
+		self.Thread.start()
+
+		self.PreviousHandler = None
+		if threading.current_thread() is threading.main_thread():
+			self.PreviousHandler = signal.signal(signal.SIGINT, self.Interrupt)
+
+	def Close(self):
+		if self.PreviousHandler is not None:
+			signal.signal(signal.SIGINT, self.PreviousHandler)
+			self.PreviousHandler = None
+		if self.Loop.is_running():
+			self.Loop.call_soon_threadsafe(self.Loop.stop)
+			self.Thread.join()
+			self.Loop.close()
+
+	def Interrupt(self, signum, frame):
+		self.Cancel()
+		if callable(self.PreviousHandler):
+			self.PreviousHandler(signum, frame)
+		else:
+			raise KeyboardInterrupt
+
+	################################################################################
+	###
+	### Cancel() - Kill all running tools (thread safe)
+	###
+	def Cancel(self):
+		def cancelTasks():
+			for Task in self.Tasks:
+				Task.cancel()
+		self.Loop.call_soon_threadsafe(cancelTasks)
+
+	################################################################################
+	###
+	### Run(Args, Key, Outputs) - Run a tool and wait for it
+	###
+	### Parameters:   Args:     command line, a leading "sudo" runs it non-interactive
+	###               Key:      name for progress and error messages
+	###               Outputs:  files/directories the tool creates, removed if it
+	###                         fails, times out or is cancelled
+	###
+	### Returns:      exit status of the tool (negative signal number if killed)
+	###
+	### Raises KeyboardInterrupt if the run was cancelled.
+	###
+	def Run(self, Args, Key=None, Outputs=()):
+		if Args[0] == "sudo":
+			self.Authenticate()
+			# The tools have no terminal to ask for a password
+			Args = ["sudo", "-n"] + Args[1:]
+
+		Future = asyncio.run_coroutine_threadsafe(self.Execute(Args, Key, Outputs), self.Loop)
+		try:
+			return Future.result()
+		except KeyboardInterrupt:
+			# Let the runs finish their cleanup
+			concurrent.futures.wait([Future])
+			raise
+		except concurrent.futures.CancelledError:
+			raise KeyboardInterrupt
+
+	################################################################################
+	###
+	### Authenticate() - Ask for the sudo password once in the foreground
+	###
+	def Authenticate(self):
+		with self.Lock:
+			if self.Authenticated:
+				return
+			self.Authenticated = True
+
+			Args = ["sudo", "-v"] if sys.stdin.isatty() else ["sudo", "-n", "-v"]
+			try:
+				Result = subprocess.call(Args, timeout=self.Timeouts.get("sudo"))
+			except subprocess.TimeoutExpired:
+				Result = None
+			# sudo may still allow just the tools (NOPASSWD), they fail fast if not
+			if Result != 0:
+				self.Logger.warning("Could not validate sudo credentials.")
+
+	async def Execute(self, Args, Key, Outputs):
+		Task = asyncio.current_task()
+		self.Tasks.add(Task)
+		Binary = os.path.basename(Args[2] if Args[0] == "sudo" else Args[0])
+		Name = Key if Key else Binary
+
+		# Created here to belong to the loop
+		if self.Semaphores is None:
+			self.Semaphores = {None: asyncio.Semaphore(self.Jobs)}
+		if Binary not in self.Semaphores:
+			self.Semaphores[Binary] = asyncio.Semaphore(self.Limits.get(Binary, self.Jobs))
+
+		Result = None
+		try:
+			async with self.Semaphores[Binary], self.Semaphores[None]:
+				self.Logger.debug(' '.join(Args))
+				Process = await asyncio.create_subprocess_exec(*Args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+															   start_new_session=True)
+				try:
+					Result = await asyncio.wait_for(self.Follow(Process, Name), self.Timeouts.get(Binary))
+				except asyncio.TimeoutError:
+					self.Logger.error("'%s' for '%s' timed out after %ds.", Binary, Name, self.Timeouts.get(Binary))
+					Result = await self.Kill(Process)
+				except asyncio.CancelledError:
+					self.Logger.warning("Stopping '%s' for '%s'.", Binary, Name)
+					await self.Kill(Process)
+					self.Cleanup(Outputs)
+					raise
+		finally:
+			self.Tasks.discard(Task)
+
+		if Result != 0:
+			self.Cleanup(Outputs)
+		return Result
+
+	async def Follow(self, Process, Name):
+		Reported = -1
+		Buffer = b""
+		while True:
+			Data = await Process.stdout.read(4096)
+			if not Data:
+				break
+			Lines = re.split(rb"[\r\n]", Buffer + Data)
+			Buffer = Lines.pop()
+			for Line in Lines:
+				Match = PROGRESS_RE.search(Line)
+				if Match:
+					# Report every 10%
+					Step = int(Match.group(3)) // 10
+					if Step > Reported:
+						Reported = Step
+						self.Logger.info("'%s': %d%%", Name, int(Match.group(3)))
+				elif Line.strip():
+					self.Logger.debug("%s: %s", Name, Line.decode("utf-8", errors="replace").rstrip())
+		return await Process.wait()
+
+	async def Kill(self, Process):
+		# sudo relays the signals to the tool running as root
+		for Signal in (signal.SIGTERM, signal.SIGKILL):
+			try:
+				os.killpg(Process.pid, Signal)
+			except (ProcessLookupError, PermissionError):
+				pass
+			try:
+				return await asyncio.wait_for(Process.wait(), KILL_GRACE)
+			except asyncio.TimeoutError:
+				continue
+		return await Process.wait()
+
+	def Cleanup(self, Outputs):
+		for Path in Outputs:
+			if not os.path.lexists(Path):
+				continue
+			self.Logger.debug("Removing partial output '%s'.", Path)
+			try:
+				if os.path.isdir(Path) and not os.path.islink(Path):
+					shutil.rmtree(Path)
+				else:
+					os.remove(Path)
+			except PermissionError:
+				# Written through sudo
+				subprocess.call(["sudo", "-n", "rm", "-rf", Path])
+
+################################################################################
+###
+### parseTimeouts(values) - Parse "[TOOL=]SECONDS" command line arguments
+###
+### Returns:      tool name -> seconds, SECONDS alone applies to all tools
+###
+def parseTimeouts(values):
+	timeouts = {}
+	for value in values or []:
+		tool, sep, seconds = value.rpartition("=")
+		if sep:
+			timeouts[tool] = float(seconds)
+		else:
+			for tool in TIMEOUTS:
+				timeouts[tool] = float(seconds)
+	return timeouts
@@ -1,12 +1,31 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import struct
+import zlib
+import lzma
+import hashlib
+
+### Optional decompressors for reading LZO/LZ4/ZSTD images
+try:
+	import lzo
+except ImportError:
+	lzo = None
+try:
+	import lz4.block
+except ImportError:
+	lz4 = None
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
 
 HEADER_FORMAT = "IIiIIHHHHHHqqqqqqqq"
 HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
 HEADER3_FORMAT = "<IIIIIIIHHHHBBBiqIIIqqqqqqq"
 HEADER3_SIZE = struct.calcsize(HEADER3_FORMAT)
 HEADER_MAGIC = 0x73717368
+### mksquashfs pads images to a multiple of this unless -nopad is given
+PAD_SIZE = 4096
 
 HEADER_KEYS = ["s_magic", "inodes", "mkfs_time", "block_size", "fragments", "compression", "block_log",
 			   "flags", "no_ids", "s_major", "s_minor", "root_inode", "bytes_used", "id_table_start",
@@ -24,6 +43,7 @@ LZMA_COMPRESSION		= 2
 LZO_COMPRESSION			= 3
 XZ_COMPRESSION			= 4
 LZ4_COMPRESSION			= 5
+ZSTD_COMPRESSION		= 6
 
 ZLIB_FORMAT = "ihh"
 ZLIB_SIZE = struct.calcsize(ZLIB_FORMAT)
@@ -41,7 +61,20 @@ LZ4_FORMAT = "ii"
 LZ4_SIZE = struct.calcsize(LZ4_FORMAT)
 LZ4_HC = 1
 
-COMPRESSION_STRING = [None, "gzip", "lzma", "lzo", "xz", "lz4"]
+ZSTD_FORMAT = "i"
+ZSTD_SIZE = struct.calcsize(ZSTD_FORMAT)
+
+### What mksquashfs uses (and does not store) if no -X options are given,
+### None stands for the block size
+DEFAULT_COMP_OPTS = {
+	ZLIB_COMPRESSION: {"compression_level": 9, "window_size": 15, "strategy": 1},
+	LZO_COMPRESSION: {"algorithm": 4, "compression_level": 8},
+	XZ_COMPRESSION: {"dictionary_size": None, "flags": 0},
+	LZ4_COMPRESSION: {"version": 1, "flags": 0},
+	ZSTD_COMPRESSION: {"compression_level": 15}
+}
+
+COMPRESSION_STRING = [None, "gzip", "lzma", "lzo", "xz", "lz4", "zstd"]
 
 # Filesystem flags
 SQUASHFS_NOI			= (1 << 0)
@@ -58,6 +91,25 @@ SQUASHFS_COMP_OPT		= (1 << 10)
 
 # Flag whether block is compressed or uncompressed, bit is set if block is uncompressed
 SQUASHFS_COMPRESSED_BIT = (1 << 15)
+SQUASHFS_COMPRESSED_BIT_BLOCK = (1 << 24)
+
+SQUASHFS_METADATA_SIZE	= 8192
+SQUASHFS_INVALID_FRAG	= 0xffffffff
+
+# Inode types, extended types are basic type + 7
+SQUASHFS_DIR_TYPE		= 1
+SQUASHFS_REG_TYPE		= 2
+SQUASHFS_SYMLINK_TYPE	= 3
+SQUASHFS_BLKDEV_TYPE	= 4
+SQUASHFS_CHRDEV_TYPE	= 5
+SQUASHFS_FIFO_TYPE		= 6
+SQUASHFS_SOCKET_TYPE	= 7
+SQUASHFS_LDIR_TYPE		= 8
+SQUASHFS_LREG_TYPE		= 9
+SQUASHFS_LSYMLINK_TYPE	= 10
+
+# Type characters as used by ls -l, index is (inode type - 1) % 7
+TYPE_CHARS = "dflbcps"
 
 ################################################################################
 ###
@@ -104,7 +156,7 @@ def parseHeader(fh, offset=0):
 		if size and not compressed:
 			block = fh.read(size)
 
-			if hd["compression"] & ZLIB_COMPRESSION and size >= ZLIB_SIZE:
+			if hd["compression"] == ZLIB_COMPRESSION and size >= ZLIB_SIZE:
 				keys = ["compression_level", "window_size", "strategy"]
 				values = struct.unpack(ZLIB_FORMAT, block)
 				hd["comp_opts"] = dict(zip(keys, values))
@@ -113,13 +165,13 @@ def parseHeader(fh, offset=0):
 					if (hd["comp_opts"]["strategy"] >> i) & 1:
 						hd["comp_opts"]["strategies"].append(strategy)
 
-			elif hd["compression"] & LZO_COMPRESSION and size >= LZO_SIZE:
+			elif hd["compression"] == LZO_COMPRESSION and size >= LZO_SIZE:
 				keys = ["algorithm", "compression_level"]
 				values = struct.unpack(LZO_FORMAT, block)
 				hd["comp_opts"] = dict(zip(keys, values))
 				hd["comp_opts"]["algorithm_name"] = LZO_ALGORITHMS[hd["comp_opts"]["algorithm"]]
 
-			elif hd["compression"] & XZ_COMPRESSION and size >= XZ_SIZE:
+			elif hd["compression"] == XZ_COMPRESSION and size >= XZ_SIZE:
 				keys = ["dictionary_size", "flags"]
 				values = struct.unpack(XZ_FORMAT, block)
 				hd["comp_opts"] = dict(zip(keys, values))
@@ -128,12 +180,17 @@ def parseHeader(fh, offset=0):
 					if (hd["comp_opts"]["flags"] >> i) & 1:
 						hd["comp_opts"]["filters"].append(filter)
 
-			elif hd["compression"] & LZ4_COMPRESSION and size >= LZ4_SIZE:
+			elif hd["compression"] == LZ4_COMPRESSION and size >= LZ4_SIZE:
 				keys = ["version", "flags"]
 				values = struct.unpack(LZ4_FORMAT, block)
 				hd["comp_opts"] = dict(zip(keys, values))
 				hd["comp_opts"]["hc"] = hd["comp_opts"]["flags"] & LZ4_HC
 
+			elif hd["compression"] == ZSTD_COMPRESSION and size >= ZSTD_SIZE:
+				keys = ["compression_level"]
+				values = struct.unpack(ZSTD_FORMAT, block[:ZSTD_SIZE])
+				hd["comp_opts"] = dict(zip(keys, values))
+
 	### Restore saved file position
 	fh.seek(startpos)
 	return hd
@@ -174,21 +231,315 @@ def buildConOpts(hd):
 	if not "comp_opts" in hd:
 		return args
 
-	if hd["compression"] & ZLIB_COMPRESSION:
+	if hd["compression"] == ZLIB_COMPRESSION:
 		args.extend(("-Xcompression-level", str(hd["comp_opts"]["compression_level"])))
 		args.extend(("-Xwindow-size", str(hd["comp_opts"]["window_size"])))
-		args.extend(("-Xstrategy", ','.join(hd["comp_opts"]["strategies"])))
+		if hd["comp_opts"]["strategies"]:
+			args.extend(("-Xstrategy", ','.join(hd["comp_opts"]["strategies"])))
 
-	elif hd["compression"] & LZO_COMPRESSION:
+	elif hd["compression"] == LZO_COMPRESSION:
 		args.extend(("-Xalgorithm", str(hd["comp_opts"]["algorithm_name"])))
-		args.extend(("-Xcompression-level", str(hd["comp_opts"]["compression_level"])))
+		# mksquashfs only takes a level for lzo1x_999
+		if hd["comp_opts"]["algorithm_name"] == "lzo1x_999":
+			args.extend(("-Xcompression-level", str(hd["comp_opts"]["compression_level"])))
 
-	elif hd["compression"] & XZ_COMPRESSION:
-		args.extend(("-Xbcj", ','.join(hd["comp_opts"]["filters"])))
+	elif hd["compression"] == XZ_COMPRESSION:
+		if hd["comp_opts"]["filters"]:
+			args.extend(("-Xbcj", ','.join(hd["comp_opts"]["filters"])))
 		args.extend(("-Xdict-size", str(hd["comp_opts"]["dictionary_size"])))
 
-	elif hd["compression"] & LZ4_COMPRESSION:
+	elif hd["compression"] == LZ4_COMPRESSION:
 		if hd["comp_opts"]["hc"]:
-			args.extend("-Xhc")
+			args.append("-Xhc")
+
+	elif hd["compression"] == ZSTD_COMPRESSION:
+		args.extend(("-Xcompression-level", str(hd["comp_opts"]["compression_level"])))
+
+	return args
+
+################################################################################
+###
+### compOpts(hd) - Compression options of a parsed header, with the defaults
+###                of mksquashfs filled in for images which do not store them
+###
+def compOpts(hd):
+	opts = dict(DEFAULT_COMP_OPTS.get(hd.get("compression"), {}))
+	for key, value in opts.items():
+		if value is None:
+			opts[key] = hd["block_size"]
+	for key, value in hd.get("comp_opts", {}).items():
+		if key in opts:
+			opts[key] = value
+	### No strategy bit means the default strategy
+	if opts.get("strategy") == 0:
+		opts["strategy"] = 1
+	return opts
+
+################################################################################
+###
+### compareHeaders(orig, built) - Find the parameters a rebuilt image lost
+###
+### Parameters:   orig:    parseHeader() of the original image
+###               built:   parseHeader() of the rebuilt image
+###
+### Version, compression, block size, flags (except whether compression
+### options are stored) and compression options are compared, fields which
+### depend on the content are not.
+###
+### Returns:      list of (field, original value, rebuilt value)
+###
+def compareHeaders(orig, built):
+	diffs = []
+	for key in ("s_major", "s_minor", "compression", "block_size", "block_log"):
+		if orig.get(key) != built.get(key):
+			diffs.append((key, orig.get(key), built.get(key)))
+	if orig["flags"] & ~SQUASHFS_COMP_OPT != built["flags"] & ~SQUASHFS_COMP_OPT:
+		diffs.append(("flags", "0x%04x" % orig["flags"], "0x%04x" % built["flags"]))
+	if orig.get("compression") == built.get("compression"):
+		origOpts = compOpts(orig)
+		builtOpts = compOpts(built)
+		for key in origOpts:
+			if origOpts[key] != builtOpts[key]:
+				diffs.append(("comp_opts." + key, origOpts[key], builtOpts[key]))
+	return diffs
 
-	return args
\ No newline at end of file
+################################################################################
+###
+### decompress(compression, data, size) - Decompress a SquashFS block
+###
+### Parameters:   compression: compression id from the superblock
+###               data:        compressed block
+###               size:        maximum uncompressed size
+###
+def decompress(compression, data, size):
+	if compression == ZLIB_COMPRESSION:
+		return zlib.decompress(data)
+	elif compression == XZ_COMPRESSION:
+		return lzma.decompress(data, format=lzma.FORMAT_XZ)
+	elif compression == LZMA_COMPRESSION:
+		return lzma.decompress(data, format=lzma.FORMAT_ALONE)
+	elif compression == LZO_COMPRESSION:
+		if not lzo:
+			raise Exception("Reading LZO compressed SquashFS requires python-lzo!")
+		return lzo.decompress(bytes(data), False, size)
+	elif compression == LZ4_COMPRESSION:
+		if not lz4:
+			raise Exception("Reading LZ4 compressed SquashFS requires python-lz4!")
+		return lz4.block.decompress(bytes(data), uncompressed_size=size)
+	elif compression == ZSTD_COMPRESSION:
+		if not zstandard:
+			raise Exception("Reading ZSTD compressed SquashFS requires python-zstandard!")
+		return zstandard.ZstdDecompressor().decompress(bytes(data), max_output_size=size)
+	raise Exception("Unknown SquashFS compression: %d" % compression)
+
+################################################################################
+###
+### Image(data, offset=0) - Read-only access to a SquashFS 4 image
+###
+### Parameters:   data:    bytes-like object (bytes, mmap) holding the image
+###               offset:  Optional location of the image within data
+###
+### Only the superblock, inode and directory tables are read to list the
+### filesystem, file data is decompressed on demand by readFile().
+###
+class Image():
+	def __init__(self, data, offset=0):
+		self.data = memoryview(data)[offset:]
+		values = struct.unpack_from("<" + HEADER_FORMAT, self.data)
+		self.header = dict(zip(HEADER_KEYS, values))
+		if self.header["s_magic"] != HEADER_MAGIC:
+			raise Exception("Invalid SquashFS magic number!")
+		if self.header["s_major"] != 4:
+			raise Exception("Only SquashFS 4 images can be read!")
+
+		self.compression = self.header["compression"]
+		self.blockSize = self.header["block_size"]
+		self.metadata = {}
+		self.fragmentCache = {}
+		self.ids = self.readTable(self.header["id_table_start"], self.header["no_ids"], "<I")
+		self.fragments = []
+		if self.header["fragments"]:
+			self.fragments = self.readTable(self.header["fragment_table_start"], self.header["fragments"], "<QII")
+
+	def close(self):
+		self.data.release()
+
+	def metadataBlock(self, pos):
+		### Returns uncompressed metadata block at pos and position of the next one
+		if pos in self.metadata:
+			return self.metadata[pos]
+		size = struct.unpack_from("<H", self.data, pos)[0]
+		compressed = not size & SQUASHFS_COMPRESSED_BIT
+		size &= ~SQUASHFS_COMPRESSED_BIT
+		block = self.data[pos + 2:pos + 2 + size]
+		block = decompress(self.compression, block, SQUASHFS_METADATA_SIZE) if compressed else bytes(block)
+		self.metadata[pos] = (block, pos + 2 + size)
+		return self.metadata[pos]
+
+	def readMetadata(self, pos, offset, length):
+		### Returns length bytes at offset in the metadata block at pos, followed
+		### by block position and offset of the next byte
+		data = bytearray()
+		while len(data) < length:
+			block, nextPos = self.metadataBlock(pos)
+			part = block[offset:offset + length - len(data)]
+			data += part
+			offset += len(part)
+			if offset >= len(block):
+				pos, offset = nextPos, 0
+		return bytes(data), pos, offset
+
+	def readTable(self, start, count, fmt):
+		### Lookup tables are an array of pointers to consecutive metadata blocks
+		size = struct.calcsize(fmt)
+		pos = struct.unpack_from("<Q", self.data, start)[0]
+		data = self.readMetadata(pos, 0, count * size)[0]
+		return [struct.unpack_from(fmt, data, i * size) for i in range(count)]
+
+	################################################################################
+	###
+	### readInode(ref) - Returns dictionary of the inode referenced by ref
+	###
+	def readInode(self, ref):
+		pos = self.header["inode_table_start"] + (ref >> 16)
+		data, pos, offset = self.readMetadata(pos, ref & 0xffff, 16)
+		keys = ["inode_type", "mode", "uid", "gid", "mtime", "inode_number"]
+		inode = dict(zip(keys, struct.unpack("<HHHHII", data)))
+		inode["uid"] = self.ids[inode["uid"]][0]
+		inode["gid"] = self.ids[inode["gid"]][0]
+		inode["type"] = TYPE_CHARS[(inode["inode_type"] - 1) % 7]
+		itype = inode["inode_type"]
+
+		if itype == SQUASHFS_DIR_TYPE:
+			data, pos, offset = self.readMetadata(pos, offset, 16)
+			keys = ["start_block", "nlink", "file_size", "offset", "parent_inode"]
+			inode.update(zip(keys, struct.unpack("<IIHHI", data)))
+		elif itype == SQUASHFS_LDIR_TYPE:
+			data, pos, offset = self.readMetadata(pos, offset, 24)
+			keys = ["nlink", "file_size", "start_block", "parent_inode", "i_count", "offset", "xattr"]
+			inode.update(zip(keys, struct.unpack("<IIIIHHI", data)))
+		elif itype == SQUASHFS_REG_TYPE or itype == SQUASHFS_LREG_TYPE:
+			if itype == SQUASHFS_REG_TYPE:
+				data, pos, offset = self.readMetadata(pos, offset, 16)
+				keys = ["start_block", "fragment", "fragment_offset", "file_size"]
+				inode.update(zip(keys, struct.unpack("<IIII", data)))
+			else:
+				data, pos, offset = self.readMetadata(pos, offset, 40)
+				keys = ["start_block", "file_size", "sparse", "nlink", "fragment", "fragment_offset", "xattr"]
+				inode.update(zip(keys, struct.unpack("<QQQIIII", data)))
+			if inode["fragment"] == SQUASHFS_INVALID_FRAG:
+				blocks = (inode["file_size"] + self.blockSize - 1) // self.blockSize
+			else:
+				blocks = inode["file_size"] // self.blockSize
+			data, pos, offset = self.readMetadata(pos, offset, 4 * blocks)
+			inode["blocks"] = list(struct.unpack("<%dI" % blocks, data))
+		elif itype == SQUASHFS_SYMLINK_TYPE or itype == SQUASHFS_LSYMLINK_TYPE:
+			data, pos, offset = self.readMetadata(pos, offset, 8)
+			inode["nlink"], size = struct.unpack("<II", data)
+			data, pos, offset = self.readMetadata(pos, offset, size)
+			inode["target"] = data.decode("utf-8", errors="surrogateescape")
+		elif (itype - 1) % 7 + 1 in (SQUASHFS_BLKDEV_TYPE, SQUASHFS_CHRDEV_TYPE):
+			data, pos, offset = self.readMetadata(pos, offset, 8)
+			inode["nlink"], inode["rdev"] = struct.unpack("<II", data)
+		return inode
+
+	################################################################################
+	###
+	### listDir(inode) - Yields (name, inode reference) of a directory inode
+	###
+	def listDir(self, inode):
+		### file_size includes the implicit '.' and '..' entries
+		size = inode["file_size"] - 3
+		if size <= 0:
+			return
+		pos = self.header["directory_table_start"] + inode["start_block"]
+		data = self.readMetadata(pos, inode["offset"], size)[0]
+		pos = 0
+		while pos < len(data):
+			count, start, number = struct.unpack_from("<III", data, pos)
+			pos += 12
+			for i in range(count + 1):
+				offset, numberOffset, itype, nameSize = struct.unpack_from("<HhHH", data, pos)
+				pos += 8
+				name = data[pos:pos + nameSize + 1].decode("utf-8", errors="surrogateescape")
+				pos += nameSize + 1
+				yield name, (start << 16) | offset
+
+	################################################################################
+	###
+	### walk() - Yields (path, inode) of every inode, root directory is "."
+	###
+	def walk(self, path=".", ref=None):
+		if ref is None:
+			ref = self.header["root_inode"]
+		inode = self.readInode(ref)
+		yield path, inode
+		if inode["type"] == "d":
+			for name, childRef in self.listDir(inode):
+				childPath = name if path == "." else path + "/" + name
+				yield from self.walk(childPath, childRef)
+
+	def fragment(self, index):
+		if index not in self.fragmentCache:
+			### Keep only a few fragment blocks, files are walked in order
+			if len(self.fragmentCache) > 8:
+				self.fragmentCache.clear()
+			start, size, unused = self.fragments[index]
+			compressed = not size & SQUASHFS_COMPRESSED_BIT_BLOCK
+			size &= ~SQUASHFS_COMPRESSED_BIT_BLOCK
+			block = self.data[start:start + size]
+			self.fragmentCache[index] = decompress(self.compression, block, self.blockSize) if compressed else bytes(block)
+		return self.fragmentCache[index]
+
+	def rawBlocks(self, inode):
+		### Yields (stored data, compressed) of every data block, sparse blocks are None
+		pos = inode["start_block"]
+		for size in inode["blocks"]:
+			compressed = not size & SQUASHFS_COMPRESSED_BIT_BLOCK
+			size &= ~SQUASHFS_COMPRESSED_BIT_BLOCK
+			if not size:
+				yield None, False
+				continue
+			yield self.data[pos:pos + size], compressed
+			pos += size
+
+	################################################################################
+	###
+	### readFile(inode) - Yields the uncompressed content of a regular file inode
+	###
+	def readFile(self, inode):
+		remaining = inode["file_size"]
+		for block, compressed in self.rawBlocks(inode):
+			if block is None:
+				block = bytes(min(self.blockSize, remaining))
+			elif compressed:
+				block = decompress(self.compression, block, self.blockSize)
+			else:
+				block = bytes(block)
+			remaining -= len(block)
+			yield block
+		if remaining > 0 and inode["fragment"] != SQUASHFS_INVALID_FRAG:
+			offset = inode["fragment_offset"]
+			yield self.fragment(inode["fragment"])[offset:offset + remaining]
+
+	################################################################################
+	###
+	### blockDigest(inode) - SHA-256 of the stored (compressed) blocks of a file
+	###
+	### Equal digests mean equal content without decompressing the data blocks,
+	### different digests may still be equal content compressed differently.
+	###
+	def blockDigest(self, inode):
+		digest = hashlib.sha256()
+		remaining = inode["file_size"]
+		for block, compressed in self.rawBlocks(inode):
+			if block is None:
+				digest.update(b"sparse")
+				remaining -= min(self.blockSize, remaining)
+				continue
+			digest.update(block)
+			remaining -= self.blockSize
+		if remaining > 0 and inode["fragment"] != SQUASHFS_INVALID_FRAG:
+			offset = inode["fragment_offset"]
+			digest.update(self.fragment(inode["fragment"])[offset:offset + remaining])
+		return digest.hexdigest()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import glob
+import json
+import stat
+import fcntl
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+STAGING_SUFFIX = ".staging"
+MAPPING_FILE = "mapping.json"
+COPY_BLOCKSIZE = 1024*512
+
+################################################################################
+###
+### lock(target, logger, shared) - Hold an exclusive lock on <target>.lock
+###
+### Waits while another extract/build run holds it. The lock file is left in
+### place, removing it would let a waiting run lock a file nobody else uses.
+### Shared locks only wait for an exclusive one.
+###
+@contextmanager
+def lock(target, logger=None, shared=False):
+	path = os.path.abspath(target) + ".lock"
+	mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+	with open(path, "a") as fh:
+		try:
+			fcntl.flock(fh, mode | fcntl.LOCK_NB)
+		except BlockingIOError:
+			if logger:
+				logger.info("Waiting for another run to release '%s'.", path)
+			fcntl.flock(fh, mode)
+		try:
+			yield
+		finally:
+			fcntl.flock(fh, fcntl.LOCK_UN)
+
+def currentUmask():
+	mask = os.umask(0)
+	os.umask(mask)
+	return mask
+
+################################################################################
+###
+### makeStaging(target) - Create a unique directory next to target
+###
+### It is on the same filesystem as target, so publish() can rename it.
+###
+def makeStaging(target):
+	head, tail = os.path.split(os.path.abspath(target))
+	path = tempfile.mkdtemp(prefix="." + tail + ".", suffix=STAGING_SUFFIX, dir=head)
+	os.chmod(path, 0o777 & ~currentUmask())
+	return path
+
+################################################################################
+###
+### staleStaging(target) - Staging directories of target left by crashed runs
+###
+### Only meaningful while holding lock(target), the run owning a staging
+### directory holds it as well.
+###
+def staleStaging(target):
+	head, tail = os.path.split(os.path.abspath(target))
+	return glob.glob(os.path.join(glob.escape(head), "." + glob.escape(tail) + ".*" + STAGING_SUFFIX))
+
+################################################################################
+###
+### publish(staging, target) - Rename a staging directory to target
+###
+### Raises FileExistsError if target exists.
+###
+def publish(staging, target):
+	# rename() would silently replace an empty directory
+	if os.path.lexists(target):
+		raise FileExistsError("'%s' already exists" % target)
+	os.rename(staging, target)
+
+################################################################################
+###
+### tempFile(target) - Open a unique temporary file next to target
+###
+### Returns:      (file object, path), os.replace() it to target when complete
+###
+def tempFile(target):
+	head, tail = os.path.split(os.path.abspath(target))
+	fd, path = tempfile.mkstemp(prefix="." + tail + ".", suffix=".tmp", dir=head)
+	os.fchmod(fd, 0o666 & ~currentUmask())
+	return os.fdopen(fd, "w+b"), path
+
+################################################################################
+###
+### replaceFile(path, data, st) - Replace a file through a rename
+###
+### Parameters:   data:    bytes or a file object to copy from
+###               st:      stat result whose mode and owner the new file gets
+###                        (Default: those of the file replaced)
+###
+### A file hardlinked to a store or another tree is left intact.
+###
+def replaceFile(path, data, st=None):
+	if st is None and os.path.exists(path):
+		st = os.stat(path)
+	fp, TmpPath = tempFile(path)
+	try:
+		with fp:
+			if isinstance(data, (bytes, bytearray, memoryview)):
+				fp.write(data)
+			else:
+				shutil.copyfileobj(data, fp, COPY_BLOCKSIZE)
+		if st:
+			if (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+				os.chown(TmpPath, st.st_uid, st.st_gid)
+			os.chmod(TmpPath, stat.S_IMODE(st.st_mode))
+		os.replace(TmpPath, path)
+	except:
+		os.unlink(TmpPath)
+		raise
+
+################################################################################
+###
+### linkFile(target, path) - Replace path with a hardlink to target
+###
+def linkFile(target, path):
+	head, tail = os.path.split(os.path.abspath(path))
+	TmpPath = os.path.join(head, "." + tail + ".link")
+	if os.path.lexists(TmpPath):
+		os.unlink(TmpPath)
+	os.link(target, TmpPath)
+	os.replace(TmpPath, path)
+
+def writeJson(path, data, sortKeys=False):
+	replaceFile(path, json.dumps(data, indent="\t", sort_keys=sortKeys).encode("utf-8"))
+
+################################################################################
+###
+### loadMapping(backup) - Mapping of the files an in-place tool changed
+###
+### Returns:      dict, "files" (relative path -> hashes and size of the
+###               original kept in backup) and "links" (relative path ->
+###               file it was hardlinked to)
+###
+def loadMapping(backup):
+	try:
+		with open(os.path.join(backup, MAPPING_FILE), "r") as fp:
+			return json.load(fp)
+	except FileNotFoundError:
+		return {"files": {}, "links": {}}
+
+def writeMapping(backup, mapping):
+	os.makedirs(backup, exist_ok=True)
+	writeJson(os.path.join(backup, MAPPING_FILE), mapping, sortKeys=True)
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import stat
+import json
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import Staging
+
+# ioctl to share the data blocks of two files (btrfs, xfs)
+FICLONE = 0x40049409
+
+LINK_MODES = ["auto", "reflink", "hardlink", "copy"]
+
+def sha256(data):
+	return hashlib.sha256(data).hexdigest()
+
+################################################################################
+###
+### hashFile(path) - SHA-256 of a file
+###
+def hashFile(path, blocksize=1024*512):
+	digest = hashlib.sha256()
+	buffer = bytearray(blocksize)
+	view = memoryview(buffer)
+	with open(path, "rb") as fh:
+		while True:
+			length = fh.readinto(buffer)
+			if not length:
+				break
+			digest.update(view[:length])
+	return digest.hexdigest()
+
+def decodeDev(rdev):
+	### SquashFS and CramFS store Linux' (old or new) encoded device numbers
+	major = (rdev >> 8) & 0xfff
+	minor = (rdev & 0xff) | ((rdev >> 12) & 0xfff00)
+	return os.makedev(major, minor)
+
+################################################################################
+###
+### Store(root) - Content-addressed object store for extracted filesystems
+###
+### Layout:       objects/<2>/<sha256>.<mode>.<uid>.<gid>
+###                           file content with its mode and owner, so trees
+###                           can hardlink to it
+###               manifests/<sha256>.json
+###                           tree of the filesystem image with this SHA-256
+###               refs/<sha256>.json
+###                           materialized tree (path and manifest), keeps
+###                           the manifest alive while the path exists
+###               tmp/        objects being written
+###
+class Store():
+	def __init__(self, root, link="auto"):
+		self.Root = os.path.abspath(root)
+		self.Link = link
+		self.Logger = logging.getLogger(__class__.__name__)
+		self.Lock = threading.Lock()
+		for Name in ("objects", "manifests", "refs", "tmp"):
+			os.makedirs(os.path.join(self.Root, Name), exist_ok=True)
+
+	def ObjectName(self, entry):
+		return "%s.%o.%d.%d" % (entry["sha256"], entry["mode"], entry["uid"], entry["gid"])
+
+	def ObjectPath(self, name):
+		return os.path.join(self.Root, "objects", name[:2], name)
+
+	def ManifestPath(self, key):
+		return os.path.join(self.Root, "manifests", key + ".json")
+
+	def RefPath(self, path):
+		return os.path.join(self.Root, "refs", hashlib.sha256(os.path.abspath(path).encode("utf-8", errors="surrogateescape")).hexdigest() + ".json")
+
+	def WriteJSON(self, path, data):
+		### Atomically replace path, readers never see a partial file
+		fd, TmpPath = tempfile.mkstemp(dir=os.path.join(self.Root, "tmp"))
+		with os.fdopen(fd, "w") as fp:
+			json.dump(data, fp)
+		os.replace(TmpPath, path)
+
+	def LoadManifest(self, key):
+		try:
+			with open(self.ManifestPath(key), "r") as fp:
+				return json.load(fp)
+		except FileNotFoundError:
+			return None
+
+	################################################################################
+	###
+	### Ingest(key, fs) - Add the files of a filesystem to the store
+	###
+	### Parameters:   key:     SHA-256 of the filesystem image
+	###               fs:      SquashFS.Image or CramFS.Image
+	###
+	### Returns:      Manifest (dictionary with "entries"), objects which are
+	###               already stored are not written again
+	###
+	def Ingest(self, key, fs, fstype=None):
+		Entries = []
+		Written = 0
+		for Path, Inode in fs.walk():
+			Entry = {
+				"path": Path, "type": Inode["type"], "mode": Inode["mode"],
+				"uid": Inode["uid"], "gid": Inode["gid"]
+			}
+			if Inode["type"] == "f":
+				Entry["size"] = Inode["file_size"]
+				Written += self.AddObject(Entry, fs.readFile(Inode))
+			elif Inode["type"] == "l":
+				Entry["target"] = Inode["target"]
+			elif Inode["type"] in "bc":
+				Entry["rdev"] = Inode["rdev"]
+			Entries.append(Entry)
+
+		Manifest = {"key": key, "fstype": fstype, "entries": Entries}
+		self.WriteJSON(self.ManifestPath(key), Manifest)
+		self.Logger.debug("Ingested %d entries, %d new objects.", len(Entries), Written)
+		return Manifest
+
+	def AddObject(self, entry, blocks):
+		### Writes content to a temporary file while hashing it, returns 1 if
+		### the object was new
+		Digest = hashlib.sha256()
+		fd, TmpPath = tempfile.mkstemp(dir=os.path.join(self.Root, "tmp"))
+		try:
+			with os.fdopen(fd, "wb") as fp:
+				for Block in blocks:
+					Digest.update(Block)
+					fp.write(Block)
+			entry["sha256"] = Digest.hexdigest()
+			Path = self.ObjectPath(self.ObjectName(entry))
+			if os.path.exists(Path):
+				return 0
+			self.SetAttributes(TmpPath, entry)
+			os.makedirs(os.path.dirname(Path), exist_ok=True)
+			os.replace(TmpPath, Path)
+			TmpPath = None
+			return 1
+		finally:
+			if TmpPath:
+				os.unlink(TmpPath)
+
+	def SetAttributes(self, path, entry):
+		os.chown(path, entry["uid"], entry["gid"], follow_symlinks=False)
+		if entry["type"] != "l":
+			os.chmod(path, entry["mode"])
+
+	################################################################################
+	###
+	### Materialize(manifest, dest) - Create the tree of a manifest at dest
+	###
+	### Regular files are reflinked (copy-on-write) where the filesystem supports
+	### it, hardlinked to the store otherwise. Hardlinked files share their data
+	### with the store and every other tree, replace them instead of editing in
+	### place.
+	###
+	def Materialize(self, manifest, dest):
+		Dirs = []
+		for Entry in manifest["entries"]:
+			Path = dest if Entry["path"] == "." else os.path.join(dest, Entry["path"])
+			Type = Entry["type"]
+			if Type == "d":
+				os.makedirs(Path, exist_ok=True)
+				Dirs.append((Path, Entry))
+				continue
+			if Type == "f":
+				self.LinkObject(self.ObjectPath(self.ObjectName(Entry)), Path, Entry)
+				continue
+			if Type == "l":
+				os.symlink(Entry["target"], Path)
+			elif Type == "b":
+				os.mknod(Path, Entry["mode"] | stat.S_IFBLK, decodeDev(Entry["rdev"]))
+			elif Type == "c":
+				os.mknod(Path, Entry["mode"] | stat.S_IFCHR, decodeDev(Entry["rdev"]))
+			elif Type == "p":
+				os.mkfifo(Path, Entry["mode"])
+			else:
+				self.Logger.warning("Skipping socket '%s'.", Entry["path"])
+				continue
+			self.SetAttributes(Path, Entry)
+
+		### Directories last and deepest first, they may not be writable
+		for Path, Entry in reversed(Dirs):
+			self.SetAttributes(Path, Entry)
+
+		self.WriteJSON(self.RefPath(dest), {"path": os.path.abspath(dest), "manifest": manifest["key"]})
+
+	def LinkObject(self, source, path, entry):
+		Link = self.Link
+		if Link in ("auto", "reflink"):
+			try:
+				with open(source, "rb") as src, open(path, "wb") as dst:
+					fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+				self.SetAttributes(path, entry)
+				return
+			except OSError as e:
+				if os.path.exists(path):
+					os.unlink(path)
+				if Link == "reflink" or e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL):
+					raise
+				with self.Lock:
+					if self.Link == "auto":
+						self.Logger.warning("Filesystem does not support reflinks, hardlinking files to the store.")
+						self.Link = Link = "hardlink"
+				Link = self.Link
+
+		if Link == "hardlink":
+			try:
+				os.link(source, path)
+				return
+			except OSError as e:
+				# Too many links to this object, copy just this file
+				if e.errno == errno.EMLINK:
+					pass
+				elif e.errno != errno.EXDEV:
+					raise
+				else:
+					with self.Lock:
+						if self.Link == "hardlink":
+							self.Logger.warning("Store is on another filesystem, copying files.")
+							self.Link = "copy"
+
+		shutil.copyfile(source, path)
+		self.SetAttributes(path, entry)
+
+	################################################################################
+	###
+	### Relocate(old, new) - Point the refs of trees below old to new after
+	###                      old was renamed
+	###
+	def Relocate(self, old, new):
+		old = os.path.abspath(old)
+		new = os.path.abspath(new)
+		RefsDir = os.path.join(self.Root, "refs")
+		for Name in os.listdir(RefsDir):
+			RefPath = os.path.join(RefsDir, Name)
+			with open(RefPath, "r") as fp:
+				Ref = json.load(fp)
+			if Ref["path"] != old and not Ref["path"].startswith(old + os.sep):
+				continue
+			Path = new + Ref["path"][len(old):]
+			self.WriteJSON(self.RefPath(Path), {"path": Path, "manifest": Ref["manifest"]})
+			os.unlink(RefPath)
+
+	################################################################################
+	###
+	### Locked(shared=True) - Lock the store (<root>.lock)
+	###
+	### Extractions hold a shared lock from adding a tree until its ref has
+	### the final path of the tree, Collect() holds an exclusive one.
+	###
+	def Locked(self, shared=True):
+		return Staging.lock(self.Root, self.Logger, shared)
+
+	################################################################################
+	###
+	### Collect(dryRun=False) - Remove everything not referenced by a live tree
+	###
+	### Refs to trees which no longer exist are dropped, then manifests without
+	### refs and objects not in any remaining manifest are removed. Waits for
+	### running extractions, see Locked().
+	###
+	### Returns:      (removed manifests, removed objects, freed bytes)
+	###
+	def Collect(self, dryRun=False):
+		with self.Locked(shared=False):
+			Manifests = set()
+			RefsDir = os.path.join(self.Root, "refs")
+			for Name in os.listdir(RefsDir):
+				RefPath = os.path.join(RefsDir, Name)
+				with open(RefPath, "r") as fp:
+					Ref = json.load(fp)
+				if os.path.isdir(Ref["path"]):
+					Manifests.add(Ref["manifest"])
+				elif not dryRun:
+					self.Logger.debug("Dropping ref to '%s'.", Ref["path"])
+					os.unlink(RefPath)
+
+			Objects = set()
+			RemovedManifests = 0
+			ManifestsDir = os.path.join(self.Root, "manifests")
+			for Name in os.listdir(ManifestsDir):
+				Key = Name[:-len(".json")]
+				if Key not in Manifests:
+					RemovedManifests += 1
+					if not dryRun:
+						os.unlink(os.path.join(ManifestsDir, Name))
+					continue
+				for Entry in self.LoadManifest(Key)["entries"]:
+					if Entry["type"] == "f":
+						Objects.add(self.ObjectName(Entry))
+
+			RemovedObjects = 0
+			Freed = 0
+			ObjectsDir = os.path.join(self.Root, "objects")
+			for Prefix in os.listdir(ObjectsDir):
+				for Name in os.listdir(os.path.join(ObjectsDir, Prefix)):
+					if Name in Objects:
+						continue
+					Path = os.path.join(ObjectsDir, Prefix, Name)
+					Stat = os.lstat(Path)
+					RemovedObjects += 1
+					# Data of hardlinked objects is only freed with the last link
+					if Stat.st_nlink == 1:
+						Freed += Stat.st_size
+					if not dryRun:
+						os.unlink(Path)
+
+			self.Logger.info("%s %d manifest(s), %d object(s), %d bytes.",
+				"Would remove" if dryRun else "Removed", RemovedManifests, RemovedObjects, Freed)
+			return RemovedManifests, RemovedObjects, Freed
+
+	def Stats(self):
+		Objects = 0
+		Size = 0
+		ObjectsDir = os.path.join(self.Root, "objects")
+		for Prefix in os.listdir(ObjectsDir):
+			for Name in os.listdir(os.path.join(ObjectsDir, Prefix)):
+				Objects += 1
+				Size += os.lstat(os.path.join(ObjectsDir, Prefix, Name)).st_size
+		return {
+			"objects": Objects, "bytes": Size,
+			"manifests": len(os.listdir(os.path.join(self.Root, "manifests"))),
+			"refs": len(os.listdir(os.path.join(self.Root, "refs")))
+		}
+
+
+def main():
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+
+	parser = argparse.ArgumentParser(description="Maintain the object store used by extract.py --store.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-n", "--dry-run", action="store_true", help="Only report what gc would remove")
+	parser.add_argument("store", help="Store directory")
+	parser.add_argument("command", choices=["gc", "stats"], help="gc: remove objects not used by any extracted tree, stats: show store usage")
+	args = parser.parse_args()
+
+	logging.getLogger("Store").setLevel(logging.DEBUG if args.verbose else logging.INFO)
+	if not os.path.isdir(args.store):
+		print("No such store: '%s'" % args.store, file=sys.stderr)
+		return 1
+
+	store = Store(args.store)
+	if args.command == "gc":
+		store.Collect(args.dry_run)
+	else:
+		for Key, Value in store.Stats().items():
+			print("%s: %d" % (Key, Value))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
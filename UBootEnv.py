@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import io
+import re
+import sys
+import mmap
+import zlib
+import struct
+import logging
+import argparse
+import uImage
+
+### Variables every U-Boot environment of these cameras has, used to find them
+ANCHORS = [b"bootcmd=", b"bootargs=", b"bootdelay=", b"baudrate="]
+
+### Largest CONFIG_ENV_SIZE looked for and its granularity
+ENV_SIZE_MAX = 0x80000
+ENV_SIZE_STEP = 0x100
+ENTRY_MAX = 4096
+TEXT = bytes(range(0x20, 0x7f)) + b"\t\n\r"
+NAME_RE = re.compile(rb"[\w.:-]+=")
+
+SINGLE_HEADER = 4	# crc32
+REDUNDANT_HEADER = 5	# crc32, flags
+
+################################################################################
+###
+### findBlocks(data) - Find U-Boot environment blocks in an image
+###
+### Parameters:   data:    bytes-like object (bytes, mmap) holding the image
+###
+### Returns:      list of dictionaries, "offset" (of the block), "size" (of the
+###               block including its header), "crc" (block has a CRC32, False
+###               for the default environment compiled into U-Boot),
+###               "redundant" (has a flags byte), "flags", "data" (offset of
+###               the variables), "end" (offset past the terminating NUL) and
+###               "env" (dict of the variables)
+###
+def findBlocks(data):
+	blocks = []
+	anchors = []
+	for anchor in ANCHORS:
+		pos = data.find(anchor)
+		while pos >= 0:
+			if pos == 0 or data[pos - 1] == 0:
+				anchors.append(pos)
+			pos = data.find(anchor, pos + 1)
+
+	### Anchors of a list already walked lead to the same start
+	starts = set()
+	listEnd = 0
+	for pos in sorted(anchors):
+		if pos < listEnd:
+			continue
+		starts.add(listStart(data, pos))
+		listEnd = data.find(b"\0\0", pos)
+
+	for start in sorted(starts):
+		end = data.find(b"\0\0", start)
+		if end < 0:
+			continue
+		end += 2
+		if blocks and start < blocks[-1]["end"]:
+			continue
+
+		block = checkCrc(data, start, end, REDUNDANT_HEADER) or checkCrc(data, start, end, SINGLE_HEADER)
+		if not block:
+			if bytes(data[start:end]).count(b"=") < 2:
+				### A lonely string, not an environment
+				continue
+			block = {"offset": start, "size": end - start, "crc": False, "redundant": False, "flags": None}
+		block["data"] = start
+		block["end"] = end
+		block["env"] = parseEnv(data[start:end])
+		blocks.append(block)
+	return blocks
+
+def listStart(data, pos):
+	### Walk back over the "name=value\0" strings before pos. The CRC header
+	### before the first string can look like text too, so the start is the
+	### one with a valid header, looked for from the first string on.
+	end = data.find(b"\0\0", pos)
+	end = len(data) if end < 0 else end + 2
+	candidates = [pos]
+	while pos > 1 and data[pos - 1] == 0:
+		prev = pos - 1
+		begin = prev
+		while begin > 0 and prev - begin < ENTRY_MAX and data[begin - 1] in TEXT:
+			begin -= 1
+		### A string without a NUL before it is the first one, its header may
+		### be anywhere in it, else only right after that NUL
+		last = prev if begin == 0 or data[begin - 1] != 0 else min(begin + REDUNDANT_HEADER + 1, prev)
+		candidates += [start for start in range(last - 1, begin - 1, -1) if NAME_RE.match(bytes(data[start:prev]))]
+		if not NAME_RE.match(bytes(data[begin:prev])):
+			break
+		pos = begin
+
+	for start in reversed(candidates):
+		if hasHeader(data, start, end):
+			return start
+	return pos
+
+def hasHeader(data, start, end):
+	return bool(checkCrc(data, start, end, REDUNDANT_HEADER) or checkCrc(data, start, end, SINGLE_HEADER))
+
+def checkCrc(data, start, end, headerSize):
+	### Looks for a block size whose CRC32 matches the header before start
+	offset = start - headerSize
+	if offset < 0:
+		return None
+	stored, = struct.unpack_from("<I", data, offset)
+	limit = min(len(data), offset + ENV_SIZE_MAX)
+	crc = 0
+	pos = start
+	size = ENV_SIZE_STEP
+	while offset + size <= limit:
+		if offset + size >= end:
+			crc = zlib.crc32(data[pos:offset + size], crc)
+			pos = offset + size
+			if crc == stored:
+				return {"offset": offset, "size": size, "crc": True, "redundant": headerSize == REDUNDANT_HEADER,
+						"flags": data[start - 1] if headerSize == REDUNDANT_HEADER else None}
+		size += ENV_SIZE_STEP
+	return None
+
+################################################################################
+###
+### parseEnv(data) - Parse "name=value\0" strings up to the first empty one
+###
+### Returns:      dict name -> value (str, latin-1 so every byte round-trips)
+###
+def parseEnv(data):
+	env = {}
+	for entry in bytes(data).split(b"\0"):
+		if not entry:
+			break
+		name, sep, value = entry.partition(b"=")
+		env[name.decode("latin-1")] = value.decode("latin-1")
+	return env
+
+################################################################################
+###
+### packEnv(env, size, pad) - Serialize variables into a region of size bytes
+###
+### Raises ValueError if they do not fit.
+###
+def packEnv(env, size, pad=b"\0"):
+	data = b"".join((name + "=" + value).encode("latin-1") + b"\0" for name, value in env.items()) + b"\0"
+	if len(data) > size:
+		raise ValueError("Environment needs %d bytes, block has %d" % (len(data), size))
+	return data + pad * (size - len(data))
+
+################################################################################
+###
+### writeBlock(data, block, env) - Replace the variables of a block in place
+###
+### Parameters:   data:    writable bytes-like object (bytearray, mmap)
+###               block:   dictionary from findBlocks()
+###               env:     new variables
+###
+### The block keeps its size, flags and padding byte, its CRC is recomputed.
+###
+def writeBlock(data, block, env):
+	start = block["data"]
+	end = block["offset"] + block["size"]
+	pad = bytes(data[block["end"]:block["end"] + 1]) if block["end"] < end else b"\0"
+	packed = packEnv(env, end - start, pad)
+	data[start:end] = packed
+	if block["crc"]:
+		struct.pack_into("<I", data, block["offset"], zlib.crc32(packed))
+	block["end"] = start + packed.find(b"\0\0") + 2
+	block["env"] = dict(env)
+
+################################################################################
+###
+### updateImageCrc(data) - Recompute the data CRC of an uImage wrapped image
+###
+### Returns:      True if data is an uImage and its header was rewritten
+###
+def updateImageCrc(data):
+	if len(data) < uImage.HEADER_SIZE or struct.unpack_from("!L", data)[0] != uImage.HEADER_MAGIC:
+		return False
+	hd = uImage.parseHeader(io.BytesIO(data[:uImage.HEADER_SIZE]))
+	if hd["imageType"] == uImage.searchTable(uImage.imageType, "multi"):
+		return False
+	hd["dataCrc"] = zlib.crc32(data[uImage.HEADER_SIZE:uImage.HEADER_SIZE + hd["size"]])
+	data[:uImage.HEADER_SIZE] = uImage.packHeader(hd)
+	return True
+
+################################################################################
+###
+### editFile(path, changes, index) - Set/unset variables in an image in place
+###
+### Parameters:   changes: dict name -> value, None removes the variable
+###               index:   block to edit, None edits all blocks with a CRC
+###                        (the default environment if there are none)
+###
+### Returns:      list of the edited blocks
+###
+def editFile(path, changes, index=None):
+	with open(path, "r+b") as fh:
+		data = mmap.mmap(fh.fileno(), 0)
+		try:
+			blocks = findBlocks(data)
+			if index is not None:
+				if not 0 <= index < len(blocks):
+					raise IndexError("No environment block %d in '%s'" % (index, path))
+				blocks = [blocks[index]]
+			else:
+				blocks = [block for block in blocks if block["crc"]] or blocks
+			### Check that all blocks fit before changing any of them
+			edits = []
+			for block in blocks:
+				env = dict(block["env"])
+				for name, value in changes.items():
+					if value is None:
+						env.pop(name, None)
+					else:
+						env[name] = value
+				packEnv(env, block["offset"] + block["size"] - block["data"])
+				edits.append((block, env))
+			for block, env in edits:
+				writeBlock(data, block, env)
+			if edits:
+				updateImageCrc(data)
+			data.flush()
+		finally:
+			data.close()
+	return blocks
+
+################################################################################
+###
+### layout(blocks) - Position of every block, what build.py checks against
+###
+def layout(blocks):
+	return [{"offset": b["offset"], "size": b["size"], "crc": b["crc"], "redundant": b["redundant"]} for b in blocks]
+
+
+def main():
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+
+	parser = argparse.ArgumentParser(description="Show and edit the U-Boot environments of a boot image in place.")
+	parser.add_argument("-b", "--block", type=int, help="Only show/edit this environment block")
+	parser.add_argument("-s", "--set", action="append", default=[], metavar="NAME=VALUE", help="Set a variable")
+	parser.add_argument("-u", "--unset", action="append", default=[], metavar="NAME", help="Remove a variable")
+	parser.add_argument("image", help="Boot image, e.g. dhboot.bin.img")
+	args = parser.parse_args()
+
+	changes = {}
+	for assignment in args.set:
+		name, sep, value = assignment.partition("=")
+		if not sep or not name:
+			print("Invalid assignment: '%s'" % assignment, file=sys.stderr)
+			return 1
+		changes[name] = value
+	for name in args.unset:
+		changes[name] = None
+
+	if changes:
+		try:
+			editFile(args.image, changes, args.block)
+		except (ValueError, IndexError) as e:
+			print(e, file=sys.stderr)
+			return 1
+
+	with open(args.image, "rb") as fh:
+		data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		blocks = findBlocks(data)
+	finally:
+		data.close()
+	for index, block in enumerate(blocks):
+		if args.block is not None and index != args.block:
+			continue
+		kind = ("redundant, flags %d" % block["flags"]) if block["redundant"] else ("crc32" if block["crc"] else "default, no crc")
+		print("# Block %d at %#x, %#x bytes (%s), %d bytes free" % (index, block["offset"], block["size"], kind,
+				block["offset"] + block["size"] - block["end"]))
+		for name, value in block["env"].items():
+			print("%s=%s" % (name, value))
+	if not blocks:
+		print("No environment found.", file=sys.stderr)
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
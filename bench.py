@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import time
+import json
+import logging
+import subprocess
+import tempfile
+import shutil
+import importlib
+import Profiler
+import Runner
+from extract import DahuaExtractor
+from build import DahuaBuilder
+from synth import DahuaSynthesizer
+from configs.config import *
+
+class DahuaBenchmark():
+	PHASES = ["extract", "build", "roundtrip"]
+	def __init__(self, debug, workDir=None, fill=0.5, size=None, repeat=1, keep=False):
+		self.Debug = debug
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+		self.WorkDir = workDir
+		self.Fill = fill
+		self.Size = size
+		self.Repeat = repeat
+		self.Keep = keep
+		self.Results = {}
+		self.Runner = Runner.Runner(debug)
+
+	def Run(self, configs):
+		for Name in configs:
+			Config = importlib.import_module("configs." + Name)
+			Best = None
+			for i in range(self.Repeat):
+				Result = self.RunConfig(Name, Config)
+				if not Best:
+					Best = Result
+					continue
+				# Keep the fastest run of every phase
+				for Phase in self.PHASES:
+					if Result[Phase]["seconds"] < Best[Phase]["seconds"]:
+						Best[Phase] = Result[Phase]
+			self.Results[Name] = Best
+		return self.Results
+
+	def RunConfig(self, name, config):
+		WorkDir = tempfile.mkdtemp(prefix="bench.%s." % name, dir=self.WorkDir)
+		OldCwd = os.getcwd()
+		Result = {}
+		try:
+			os.chdir(WorkDir)
+			Source = name + ".bin"
+
+			self.Logger.info("[%s] Synthesizing firmware image.", name)
+			Synthesizer = DahuaSynthesizer(config, self.Debug, fill=self.Fill)
+			if Synthesizer.CheckDependencies():
+				raise Exception("Missing dependencies!")
+			Synthesizer.Synthesize(Source, self.Size)
+
+			self.Logger.info("[%s] Extracting.", name)
+			Extractor = DahuaExtractor(config, self.Debug, Profiler.Profiler(), self.Runner)
+			if Extractor.CheckDependencies():
+				raise Exception("Missing dependencies!")
+			Result["extract"] = self.Measure(lambda: Extractor.Extract(Source), os.path.getsize(Source), Extractor.Profiler)
+
+			self.Logger.info("[%s] Building.", name)
+			Builder = DahuaBuilder(config, self.Debug, Profiler.Profiler(), self.Runner)
+			if Builder.CheckDependencies():
+				raise Exception("Missing dependencies!")
+			Extracted = Source + ".extracted"
+			Result["build"] = self.Measure(lambda: Builder.Build(Extracted), os.path.getsize(Source), Builder.Profiler)
+
+			self.Logger.info("[%s] Extracting rebuilt image (round-trip).", name)
+			RoundTrip = name + ".roundtrip.bin"
+			shutil.copyfile(os.path.join(Extracted, "build", name + ".bin"), RoundTrip)
+			Extractor = DahuaExtractor(config, self.Debug, Profiler.Profiler(), self.Runner)
+			Result["roundtrip"] = self.Measure(lambda: Extractor.Extract(RoundTrip), os.path.getsize(RoundTrip), Extractor.Profiler)
+		finally:
+			os.chdir(OldCwd)
+			if self.Keep:
+				self.Logger.info("[%s] Keeping work directory: '%s'", name, WorkDir)
+			else:
+				# Extracted files are owned by root.
+				subprocess.call(["sudo", "rm", "-rf", WorkDir])
+
+		return Result
+
+	def Measure(self, function, size, profiler):
+		Start = time.perf_counter()
+		function()
+		Seconds = time.perf_counter() - Start
+		return {
+			"seconds": Seconds,
+			"bytes": size,
+			"throughput": size / Seconds,
+			"stages": profiler.Totals()
+		}
+
+	################################################################################
+	###
+	### Compare(baseline, tolerance) - Check results against a previous run
+	###
+	### Returns list of (config, phase, baseline throughput, current throughput)
+	### for every phase that got slower than the tolerance allows.
+	###
+	def Compare(self, baseline, tolerance):
+		Regressions = []
+		for Name, Result in self.Results.items():
+			if Name not in baseline:
+				continue
+			for Phase in self.PHASES:
+				if Phase not in baseline[Name]:
+					self.Logger.info("%s: no %s in the baseline, taking it as new.", Name, Phase)
+					continue
+				Old = baseline[Name][Phase]["throughput"]
+				New = Result[Phase]["throughput"]
+				if New < Old * (1.0 - tolerance):
+					Regressions.append((Name, Phase, Old, New))
+		return Regressions
+
+	def Dump(self):
+		for Name, Result in self.Results.items():
+			for Phase in self.PHASES:
+				self.Logger.info("%-16s %-10s %8.2fs %8.2f MiB/s", Name, Phase,
+					Result[Phase]["seconds"], Result[Phase]["throughput"] / 1048576)
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+	logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+	logging.addLevelName(logging.WARNING, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+	logging.addLevelName(logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+	logging.addLevelName(logging.CRITICAL, "\033[5m\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.CRITICAL))
+
+	parser = argparse.ArgumentParser(description="Benchmark extract, build and round-trip on synthetic Dahua firmware images.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-c", "--config", action="append", help="Configuration to benchmark, may be repeated. (Default: all)")
+	parser.add_argument("-f", "--fill", type=float, default=0.5, help="Fraction of each partition size to fill with files. (Default: 0.5)")
+	parser.add_argument("-s", "--size", type=int, help="Use this content size (bytes) for every partition instead of the configured size")
+	parser.add_argument("-r", "--repeat", type=int, default=1, help="Run every benchmark N times and keep the fastest. (Default: 1)")
+	parser.add_argument("-w", "--workdir", help="Directory for temporary files. (Default: system temp dir)")
+	parser.add_argument("-k", "--keep", action="store_true", help="Keep work directories")
+	parser.add_argument("-b", "--baseline", help="Compare against this results file and fail on regressions")
+	parser.add_argument("-t", "--tolerance", type=float, default=0.2, help="Allowed throughput loss against baseline. (Default: 0.2)")
+	parser.add_argument("-o", "--output", help="Write results to this file")
+	args = parser.parse_args()
+
+	Logger = logging.getLogger("main")
+
+	Configs = []
+	for ArgConfig in args.config or DAHUA_CONFIGS:
+		Found = None
+		for Config in DAHUA_CONFIGS:
+			if Config.lower() == ArgConfig.lower():
+				Found = Config
+				break
+		if not Found:
+			Logger.error("Invalid config specified: '%s'", ArgConfig)
+			sys.exit(1)
+		Configs.append(Found)
+
+	benchmark = DahuaBenchmark(args.verbose, args.workdir, args.fill, args.size, args.repeat, args.keep)
+	benchmark.Run(Configs)
+	benchmark.Dump()
+
+	if args.output:
+		with open(args.output, "w") as fp:
+			json.dump(benchmark.Results, fp, indent=1)
+
+	if args.baseline:
+		with open(args.baseline, "r") as fp:
+			Baseline = json.load(fp)
+		Regressions = benchmark.Compare(Baseline, args.tolerance)
+		for Name, Phase, Old, New in Regressions:
+			Logger.error("Regression in %s %s: %.2f MiB/s -> %.2f MiB/s", Name, Phase, Old / 1048576, New / 1048576)
+		if Regressions:
+			sys.exit(1)
@@ -6,28 +6,125 @@ import sys
 import distutils.spawn
 import logging
 import zipfile
-import subprocess
 import shutil
+import struct
+import stat
+import json
+import mmap
+import hashlib
+import threading
+import concurrent.futures
+import time
 import uImage
+import Firmware
+import Staging
+import Manifest
 import SquashFS
+import CramFS
+import UBootEnv
+import Profiler
+import Runner
+import verify
+import overlay
+import webopt
+import elfstrip
+import nested
 import importlib
 from configs.config import *
 
+################################################################################
+###
+### statTree(path) - lstat() path and everything below it
+###
+### Returns:      dictionary path -> (size, mtime, mode, uid, gid, inode), raises
+###               PermissionError if a directory can not be read
+###
+### Directories have no inode, the staged copy of the source gets new ones
+### whenever a partition is staged again while their contents stay the same.
+###
+def statTree(path):
+	result = {}
+	stack = [path]
+	while stack:
+		path = stack.pop()
+		try:
+			st = os.lstat(path)
+		except FileNotFoundError:
+			continue
+		if stat.S_ISDIR(st.st_mode):
+			result[path] = (st.st_size, st.st_mtime_ns, st.st_mode, st.st_uid, st.st_gid, None)
+			stack.extend(entry.path for entry in os.scandir(path))
+		else:
+			result[path] = (st.st_size, st.st_mtime_ns, st.st_mode, st.st_uid, st.st_gid, st.st_ino)
+	return result
+
+################################################################################
+###
+### fingerprint(paths) - SHA-256 over statTree() of all paths
+###
+### Returns:      hex digest, None if a directory can not be read
+###
+def fingerprint(paths):
+	digest = hashlib.sha256()
+	try:
+		for path in paths:
+			for name, st in sorted(statTree(path).items()):
+				digest.update(repr((name, st)).encode("utf-8", errors="surrogateescape"))
+	except PermissionError:
+		return None
+	return digest.hexdigest()
+
+################################################################################
+###
+### toolVersion(binary) - Identify the installed version of a tool
+###
+### Path, size and mtime of the executable change whenever it is upgraded,
+### without running it.
+###
+### Returns:      string, None if the tool is not installed
+###
+def toolVersion(binary):
+	path = distutils.spawn.find_executable(binary)
+	if not path:
+		return None
+	st = os.stat(path)
+	return "%s:%d:%d" % (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+### Copy of the source in the build directory the variant steps (patch set, web
+### optimizer, ELF stripper) change
+SOURCE_DIR = "source"
+
 class DahuaBuilder():
 	DEPENDENCIES = ["sudo", "mkimage"]
-	def __init__(self, config, debug):
+	def __init__(self, config, debug, profiler=None, runner=None, overlay=None, clean=False, optimizer=None, stripper=None, manifest=False):
 		self.Config = config
 		self.Debug = debug
+		self.Profiler = profiler if profiler else Profiler.Profiler()
+		self.Runner = runner if runner else Runner.Runner(debug)
 		self.Logger = logging.getLogger(__class__.__name__)
 		if self.Debug:
 			self.Logger.setLevel(logging.DEBUG)
 		else:
 			self.Logger.setLevel(logging.INFO)
+		self.Origin = None
 		self.Source = None
 		self.BuildDir = None
-		self.ZipFileList = None
+		self.ZipFiles = None
 		self.DestFile = None
+		self.DestPath = None
 		self.ZipFile = None
+		self.Overlay = overlay
+		self.Optimizer = optimizer
+		self.Optimized = {}
+		self.Stripper = stripper
+		self.Stripped = {}
+		self.Nested = nested.DahuaNested(debug, self.Runner)
+		self.Manifest = None
+		self.WantManifest = manifest
+		self.Clean = clean
+		self.Journal = None
+		self.JournalPath = None
+		self.Lock = threading.Lock()
 		self.DahuaFiles = self.Config.DAHUA_FILES
 
 	def CheckDependencies(self):
@@ -42,14 +139,200 @@ class DahuaBuilder():
 			self.Logger.critical("Missing dependency: '%s'", dependency)
 			return 1
 
-	def Build(self, source):
-		self.Source = os.path.abspath(source)
+	################################################################################
+	###
+	### Build(source, buildDir, output) - Build a firmware image from source
+	###
+	### Parameters:   buildDir:  directory for intermediary files and the journal
+	###                          (Default: <source>/build)
+	###               output:    firmware image (Default: <buildDir>/<name>.bin)
+	###
+	### The build directory is locked, concurrent builds using the same one wait
+	### for each other. See Prepare() for the source.
+	###
+	def Build(self, source, buildDir=None, output=None):
+		self.Origin = os.path.abspath(source)
+		self.Source = self.Origin
+		self.BuildDir = os.path.abspath(buildDir) if buildDir else os.path.join(self.Origin, "build")
+		self.JournalPath = os.path.join(self.BuildDir, "journal.json")
+		if output:
+			self.DestPath = os.path.abspath(output)
+		else:
+			self.DestPath = os.path.join(self.BuildDir, os.path.basename(self.Origin).rstrip(".extracted").rstrip(".bin") + ".bin")
+
+		with Staging.lock(self.BuildDir, self.Logger):
+			if os.path.isdir(self.BuildDir) and self.Clean:
+				self.Logger.info("Build directory already exists, deleting.")
+				# The staged source holds files of root
+				self.Runner.Cleanup([self.BuildDir])
+
+			if os.path.isdir(self.BuildDir):
+				self.Logger.info("Resuming build in existing build directory '%s'.", self.BuildDir)
+				try:
+					with open(self.JournalPath, "r") as fp:
+						self.Journal = json.load(fp)
+				except (FileNotFoundError, ValueError):
+					self.Journal = {}
+			else:
+				# Create build dir
+				self.Logger.info("Creating build directory '%s'.", self.BuildDir)
+				os.mkdir(self.BuildDir)
+				self.Journal = {}
+
+			self.Prepare()
+			self.CheckRequirements()
+
+			self.ZipFiles = {}
+
+			#
+			self.Logger.info("Starting build process.")
+			for Key, Value in self.DahuaFiles.items():
+				if not Value["pass"]:
+					self.Logger.debug("Skipping '%s'.", Key)
+					continue
+
+				self.Logger.info("Processing '%s'.", Key)
+				self.BuildKey(Key, Value)
+				Headroom = self.CheckSize(Key, Value)
+				if (Key in self.Optimized or Key in self.Stripped) and Headroom is not None:
+					self.Logger.info("'%s': %d bytes left in the partition.", Key, Headroom)
+
+			self.WriteZip()
+			self.WriteManifest()
+
+	################################################################################
+	###
+	### Prepare(Keys) - Bring the source up to date and apply the variant steps
+	###
+	### Parameters:   Keys:      partitions to look at (Default: all)
+	###
+	### Nested containers are repacked in the source itself, with the source
+	### locked. The variant steps (patch set, web optimizer, ELF stripper) work
+	### on a copy in <buildDir>/source: builds with different build directories
+	### neither race on the source nor see each other's changes. The copy is
+	### kept, only the partitions staged again by StageSource() go through the
+	### variant steps. Without variant steps the source is built directly.
+	###
+	def Prepare(self, Keys=None):
+		Variant = self.Overlay or self.Optimizer or self.Stripper
+		with Staging.lock(self.Origin, self.Logger):
+			self.RepackNested()
+			if Variant:
+				Staged = self.StageSource(Keys)
+		if not Variant or not Staged:
+			return
+
+		if self.Overlay:
+			self.Logger.info("Applying patch set '%s'.", self.Overlay.PatchSet)
+			with self.Profiler.Span("overlay"):
+				self.Overlay.Apply(self.Source, keys=Staged)
+
+		Budgets = {Key: Value["size"] for Key, Value in self.DahuaFiles.items() if "size" in Value}
+		if self.Optimizer:
+			self.Logger.info("Optimizing web partitions.")
+			with self.Profiler.Span("webopt"):
+				Keys = [Key for Key in Staged if Firmware.isWebKey(Key)]
+				self.Optimized = self.Optimizer.Optimize(self.Source, Keys, Budgets)
 
+		if self.Stripper:
+			self.Logger.info("Stripping ELF files.")
+			with self.Profiler.Span("elfstrip"):
+				self.Stripped = self.Stripper.Strip(self.Source, sorted(Staged), os.path.join(self.BuildDir, "elfcache"), Budgets)
+
+		# Only a completely prepared partition is reused by the next build
+		for Key, Entry in Staged.items():
+			Entry["output"] = fingerprint(self.SourcePaths(self.Source, Key))
+			self.Journal[SOURCE_DIR + "/" + Key] = Entry
+		self.WriteJournal()
+
+	################################################################################
+	###
+	### StageSource(Keys) - Copy the files of the partitions to <buildDir>/source
+	###
+	### Files are hardlinked, the variant steps replace them through a rename
+	### and leave the source alone. They are copied (reflinked if possible)
+	### when the build directory is on another filesystem.
+	###
+	### A partition is staged again when its files in the source, the variant
+	### steps or its prepared copy changed since the last build, like Stage()
+	### does for the intermediary files.
+	###
+	### Returns:      dictionary key -> journal entry of the partitions staged
+	###
+	def StageSource(self, Keys=None):
+		Copy = os.path.join(self.BuildDir, SOURCE_DIR)
+		self.Source = Copy
+		Command = [fingerprint([self.Overlay.PatchSet]) if self.Overlay else None, bool(self.Optimizer), bool(self.Stripper)]
+		Staged = {}
+		for Key in (self.DahuaFiles if Keys is None else Keys):
+			Inputs = fingerprint(self.SourcePaths(self.Origin, Key))
+			Entry = self.Journal.get(SOURCE_DIR + "/" + Key)
+			if Inputs and Entry and Entry["stage"] == "source" and Entry["inputs"] == Inputs and Entry["command"] == Command \
+					and os.path.isdir(Copy) and Entry["output"] == fingerprint(self.SourcePaths(Copy, Key)):
+				continue
+			Staged[Key] = {"stage": "source", "inputs": Inputs, "command": Command, "output": None}
+			self.Journal.pop(SOURCE_DIR + "/" + Key, None)
+		if not Staged:
+			return Staged
+		self.WriteJournal()
+
+		Paths = [Path for Key in Staged for Path in self.SourcePaths(self.Origin, Key)]
+		self.Logger.info("Staging %s in '%s'.", ", ".join(Staged), Copy)
+		with self.Profiler.Span("stage"):
+			os.makedirs(Copy, exist_ok=True)
+			self.Runner.Cleanup([Path for Key in Staged for Path in self.SourcePaths(Copy, Key)])
+			# Need root to link and copy files of other owners.
+			if Paths and self.Runner.Run(["sudo", "cp", "-al", "--"] + Paths + [Copy], "source") != 0:
+				self.Logger.info("Can not hardlink the source, copying it.")
+				self.Runner.Cleanup([Path for Key in Staged for Path in self.SourcePaths(Copy, Key)])
+				if self.Runner.Run(["sudo", "cp", "-a", "--reflink=auto", "--"] + Paths + [Copy], "source") != 0:
+					raise Exception("Staging the source failed!")
+		return Staged
+
+	def SourcePaths(self, Directory, Key):
+		# <Key> and <Key>.*, each name belongs to the longest key it starts with
+		if not os.path.isdir(Directory):
+			return []
+		Paths = []
+		for Name in sorted(os.listdir(Directory)):
+			if Name.endswith(nested.NESTED_SUFFIX):
+				continue
+			Owners = [Other for Other in self.DahuaFiles if Name == Other or Name.startswith(Other + ".")]
+			if Owners and max(Owners, key=len) == Key:
+				Paths.append(os.path.join(Directory, Name))
+		return Paths
+
+	################################################################################
+	###
+	### RepackNested() - Pack changed contents of <file>.nested (extract.py -r)
+	###                  back into the archives and images they came from
+	###
+	def RepackNested(self):
+		if not any(Name.endswith(nested.NESTED_SUFFIX) for Name in os.listdir(self.Origin)):
+			return
+		self.Logger.info("Repacking changed nested archives and images.")
+		with self.Profiler.Span("nested"):
+			Repacked, Errors = self.Nested.Repack(self.Origin)
+		if Errors:
+			self.Logger.error("Could not repack %d nested archive(s)/image(s)!", Errors)
+			raise Exception("Repacking nested archives and images failed!")
+
+	def CheckRequirements(self):
 		# Check if all required files and directories exist
 		self.Logger.info("Checking required files/directories.")
 		for Key, Value in self.DahuaFiles.items():
 			Passed = True
 
+			Value["multi"] = Value["type"] & DAHUA_TYPE.uImage and self.IsMultiFile(Key)
+			if Value["multi"]:
+				for ChildKey in self.MultiFileKeys(Key):
+					if not os.path.isfile(os.path.join(self.Source, ChildKey + ".raw")):
+						self.Logger.error("Could not find '.raw' file for image '%s' of multi-file image: '%s'", ChildKey, Key)
+						raise Exception("Missing requirement!")
+				Value["pass"] = True
+				self.Logger.debug("Requirements for multi-file image '%s' were met.", Key)
+				continue
+
 			if Value["type"] & DAHUA_TYPE.Plain:
 				if Value["type"] & DAHUA_TYPE.uImage:
 					Path = os.path.join(self.Source, Key + ".raw")
@@ -87,99 +370,435 @@ class DahuaBuilder():
 			else:
 				self.Logger.debug("Requirements for '%s' were NOT met.", Key)
 
-		# Check if build directory exists in source dir
-		self.BuildDir = os.path.join(self.Source, "build")
+	################################################################################
+	###
+	### BuildKey(Key, Value) - Build the file which goes into the zip as member
+	###                        Key
+	###
+	### Stages whose inputs, tool and options did not change since the journal
+	### recorded them are skipped.
+	###
+	def BuildKey(self, Key, Value):
+		if Value["multi"]:
+			if self.Handle_MultiFile(Key) != 0:
+				self.Logger.error("'MultiFile' handler returned non-zero return value for file: '%s'", Key)
+				raise Exception("Handler returned non-zero return value!")
+			return
 
-		if os.path.isdir(self.BuildDir):
-			self.Logger.info("Build directory already exists, deleting.")
-			shutil.rmtree(self.BuildDir)
+		if Value["type"] & DAHUA_TYPE.uImage:
+			DataPath = os.path.join(self.BuildDir, Key + ".raw")
+		else:
+			DataPath = os.path.join(self.BuildDir, Key)
 
-		# Create build dir
-		self.Logger.info("Creating 'build' directory.")
-		os.mkdir(self.BuildDir)
+		if Value["type"] & DAHUA_TYPE.Plain:
+			if Value["type"] & DAHUA_TYPE.uImage:
+				OrigPath = os.path.join(self.Source, Key + ".raw")
+			else:
+				OrigPath = os.path.join(self.Source, Key)
 
-		self.ZipFileList = []
+			if Value["type"] & DAHUA_TYPE.Environment:
+				self.CheckEnvironment(Key, OrigPath)
 
-		#
-		self.Logger.info("Starting build process.")
-		for Key, Value in self.DahuaFiles.items():
-			if not Value["pass"]:
-				self.Logger.debug("Skipping '%s'.", Key)
-				continue
+			self.Stage("copy", [OrigPath], DataPath, lambda TempPath: self.Handle_Plain(Key, OrigPath, TempPath))
 
-			self.Logger.info("Processing '%s'.", Key)
+			if not Value["type"] & DAHUA_TYPE.uImage:
+				self.Logger.debug("Adding '%s' to zip file list.", Key)
+				self.ZipFiles[Key] = DataPath
 
-			if Value["type"] & DAHUA_TYPE.Plain:
-				if Value["type"] & DAHUA_TYPE.uImage:
-					OrigPath = os.path.join(self.Source, Key + ".raw")
-					DestPath = os.path.join(self.BuildDir, Key + ".raw")
-					shutil.copyfile(OrigPath, DestPath)
-				else:
-					OrigPath = os.path.join(self.Source, Key)
-					DestPath = os.path.join(self.BuildDir, Key)
-					shutil.copyfile(OrigPath, DestPath)
-					self.Logger.debug("Adding '%s' to zip file list.", Key)
-					self.ZipFileList.append((DestPath, Key))
+		Inputs = [os.path.join(self.Source, Key + ".extracted"), os.path.join(self.Source, Key + ".raw")]
 
-			if Value["type"] & DAHUA_TYPE.SquashFS:
-				if self.Handle_SquashFS(Key) != 0:
-					self.Logger.error("'SquashFS' handler returned non-zero return value for file: '%s'", Key)
-					raise Exception("Handler returned non-zero return value!")
+		if Value["type"] & DAHUA_TYPE.SquashFS:
+			if self.Stage("SquashFS", Inputs, DataPath, lambda TempPath: self.Handle_SquashFS(Key, TempPath),
+						  self.SquashFSCommand(Key)[1]) != 0:
+				self.Logger.error("'SquashFS' handler returned non-zero return value for file: '%s'", Key)
+				raise Exception("Handler returned non-zero return value!")
 
-			if Value["type"] & DAHUA_TYPE.CramFS:
-				if self.Handle_CramFS(Key) != 0:
-					self.Logger.error("'CramFS' handler returned non-zero return value for file: '%s'", Key)
-					raise Exception("Handler returned non-zero return value!")
+		if Value["type"] & DAHUA_TYPE.CramFS:
+			if self.Stage("CramFS", Inputs, DataPath, lambda TempPath: self.Handle_CramFS(Key, TempPath),
+						  self.CramFSCommand(Key)[1]) != 0:
+				self.Logger.error("'CramFS' handler returned non-zero return value for file: '%s'", Key)
+				raise Exception("Handler returned non-zero return value!")
 
-			if Value["type"] & DAHUA_TYPE.uImage:
-				if self.Handle_uImage(Key) != 0:
-					self.Logger.error("'uImage' handler returned non-zero return value for file: '%s'", Key)
-					raise Exception("Handler returned non-zero return value!")
+		if Value["type"] & DAHUA_TYPE.uImage:
+			if self.Handle_uImage(Key) != 0:
+				self.Logger.error("'uImage' handler returned non-zero return value for file: '%s'", Key)
+				raise Exception("Handler returned non-zero return value!")
 
-			if "size" in Value:
-				size = Value["size"]
-				if Value["type"] & DAHUA_TYPE.uImage:
-					size += uImage.HEADER_SIZE
+	################################################################################
+	###
+	### Stage(Name, Inputs, DestPath, Function, Command) - Build DestPath unless
+	###                                                    the journal has it
+	###                                                    built from the same
+	###                                                    inputs and command
+	###
+	### Function(TempPath) writes the output to a temporary file which replaces
+	### DestPath on success, an interrupted build never leaves a partial DestPath.
+	### Inputs are fingerprinted by path, size, mtime, mode, owner and inode of
+	### every file below them, Command (the tool and its options, without the
+	### paths) by its arguments and toolVersion().
+	###
+	### Returns:      0 on success or if DestPath is up to date, else the return
+	###               value of Function
+	###
+	def Stage(self, Name, Inputs, DestPath, Function, Command=None):
+		Output = os.path.basename(DestPath)
+		Inputs = fingerprint(Inputs)
+		Command = Command + [toolVersion(Command[0])] if Command else None
+		Entry = self.Journal.get(Output)
+		if Inputs and Entry and Entry["stage"] == Name and Entry["inputs"] == Inputs and Entry.get("command") == Command \
+				and Entry["output"] == fingerprint([DestPath]):
+			self.Logger.info("'%s' is up to date.", Output)
+			return 0
 
-				if os.path.getsize(self.ZipFileList[-1][0]) > size:
-					self.Logger.error("Generated file '%s' exceedes maximum allowed filesize!", Key)
-					raise Exception("File exceeds maximum allowed filesize!")
+		# Left behind by an interrupted build, mksquashfs would append to it
+		TempPath = DestPath + ".tmp"
+		if os.path.exists(TempPath):
+			os.remove(TempPath)
 
-		DestPath = os.path.join(self.BuildDir, os.path.basename(self.Source).rstrip(".extracted").rstrip(".bin") + ".bin")
-		self.DestFile = open(DestPath, "wb")
+		Result = Function(TempPath)
+		if Result != 0:
+			return Result
+		os.replace(TempPath, DestPath)
 
-		self.Logger.info("Building compressed firmware image.")
-		self.ZipFile = zipfile.ZipFile(self.DestFile, mode='w', compression=zipfile.ZIP_DEFLATED)
+		with self.Lock:
+			self.Journal[Output] = {"stage": Name, "inputs": Inputs, "command": Command, "output": fingerprint([DestPath])}
+			self.WriteJournal()
+		return 0
 
-		for Item in self.ZipFileList:
-			self.Logger.debug("Writing '%s' as '%s' to zip file.", Item[0], Item[1])
-			self.ZipFile.write(Item[0], Item[1])
+	def WriteJournal(self):
+		TempPath = self.JournalPath + ".tmp"
+		with open(TempPath, "w") as fp:
+			json.dump(self.Journal, fp, indent=1, sort_keys=True)
+		os.replace(TempPath, self.JournalPath)
 
-		self.ZipFile.close()
-		self.ZipFile = None
+	################################################################################
+	###
+	### CheckEnvironment(Key, Path) - Check the U-Boot environments of a boot image
+	###
+	### Every block recorded by extract.py (<file>.env.json) must still be at the
+	### same offset with the same size and a valid CRC, U-Boot would fall back
+	### to its default environment otherwise.
+	###
+	def CheckEnvironment(self, Key, Path):
+		LayoutPath = os.path.join(self.Source, Key + ".env.json")
+		if not os.path.isfile(LayoutPath):
+			return
+		with open(LayoutPath) as fp:
+			Expected = json.load(fp)
 
-		# Write DH header
-		self.Logger.debug("Patching zip header from 'PK' to 'DH'.")
-		self.DestFile.seek(0)
-		self.DestFile.write(b"DH")
+		with open(Path, "rb") as fp:
+			Data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(Path) else b""
+		try:
+			Blocks = {Block["offset"]: Block for Block in UBootEnv.findBlocks(Data)}
+		finally:
+			if Data:
+				Data.close()
 
-		self.DestFile.close()
-		self.DestFile = None
+		for Entry in Expected:
+			Block = Blocks.get(Entry["offset"])
+			# The default environment has no size of its own, edits may shorten it
+			if not Block or Block["crc"] != Entry["crc"] or \
+					(Block["size"] != Entry["size"] if Entry["crc"] else Block["size"] > Entry["size"]):
+				self.Logger.error("U-Boot environment of '%s' at %#x (%#x bytes) is missing, resized or has a bad CRC!",
+								  Key, Entry["offset"], Entry["size"])
+				raise Exception("Invalid U-Boot environment!")
+
+	################################################################################
+	###
+	### CheckSize(Key, Value) - Check the built file against the partition size
+	###
+	### Returns:      remaining bytes in the partition, None if its size is unknown
+	###
+	def CheckSize(self, Key, Value):
+		if "size" not in Value:
+			return None
+
+		size = Value["size"]
+		if Value["type"] & DAHUA_TYPE.uImage:
+			size += uImage.HEADER_SIZE
+
+		Headroom = size - os.path.getsize(self.ZipFiles[Key])
+		if Headroom < 0:
+			self.Logger.error("Generated file '%s' exceedes maximum allowed filesize!", Key)
+			raise Exception("File exceeds maximum allowed filesize!")
+		return Headroom
+
+	################################################################################
+	###
+	### WriteZip() - Write the firmware image from the built files
+	###
+	### Members which are unchanged since the previous image (according to the
+	### journal) are copied compressed from it, the image is not rewritten at all
+	### if nothing changed.
+	###
+	def WriteZip(self):
+		Output = os.path.basename(self.DestPath)
+		Members = {Key: fingerprint([Path]) for Key, Path in self.ZipFiles.items()}
+		Entry = self.Journal.get(Output)
+
+		Previous = None
+		if Entry and Entry["output"] == fingerprint([self.DestPath]):
+			if Entry["members"] == Members:
+				self.Logger.info("'%s' is up to date.", Output)
+				return
+			Previous = Firmware.FirmwareZip(self.DestPath)
+
+		# Replace the previous image only once the new one is complete, the
+		# output may be shared with builds using another build directory
+		self.DestFile, TempPath = Staging.tempFile(self.DestPath)
+		try:
+			self.Logger.info("Building compressed firmware image.")
+			with self.Profiler.Span("zip_write") as Span:
+				self.ZipFile = zipfile.ZipFile(self.DestFile, mode='w', compression=zipfile.ZIP_DEFLATED)
+
+				for Key, Path in self.ZipFiles.items():
+					if Previous and Entry["members"].get(Key) == Members[Key] and Key in Previous.NameToInfo:
+						self.Logger.debug("Copying unchanged '%s' to zip file.", Key)
+						Firmware.copyMember(self.ZipFile, Previous, Key)
+						continue
+					self.Logger.debug("Writing '%s' as '%s' to zip file.", Path, Key)
+					self.ZipFile.write(Path, Key)
+					Span["bytes"] += os.path.getsize(Path)
+
+				self.ZipFile.close()
+				self.ZipFile = None
+
+			# Write DH header
+			self.Logger.debug("Patching zip header from 'PK' to 'DH'.")
+			self.DestFile.seek(0)
+			self.DestFile.write(b"DH")
+
+			self.DestFile.close()
+			self.DestFile = None
+			os.replace(TempPath, self.DestPath)
+		except BaseException:
+			if self.DestFile:
+				self.DestFile.close()
+				self.DestFile = None
+			os.remove(TempPath)
+			raise
+		finally:
+			if Previous:
+				Previous.close()
+
+		self.Journal[Output] = {"stage": "zip", "members": Members, "output": fingerprint([self.DestPath])}
+		self.WriteJournal()
+
+	################################################################################
+	###
+	### Snapshot(Key) - Collect path, size, mtime, mode and owner of every source
+	###                 file the member Key is built from
+	###
+	def Snapshot(self, Key):
+		Value = self.DahuaFiles[Key]
+		Keys = self.MultiFileKeys(Key) if Value.get("multi") else [Key]
+
+		Result = {}
+		for ChildKey in Keys:
+			for Suffix in ("", ".raw", ".uImage", ".extracted"):
+				Path = os.path.join(self.Origin, ChildKey + Suffix)
+				try:
+					Result.update(statTree(Path))
+				except PermissionError:
+					self.Logger.debug("Can not watch '%s': permission denied", Path)
+		return Result
+
+	################################################################################
+	###
+	### Watch(Interval, Debounce, Verify) - Poll the source directory and rebuild
+	###                                     the members whose files changed
+	###
+	### Parameters:   Interval:  seconds between polls
+	###               Debounce:  seconds without changes before rebuilding
+	###               Verify:    verify the image after every rebuild
+	###
+	### Only the affected partitions are staged and prepared again, and only
+	### their filesystem image, uImage and zip member are rebuilt (for
+	### multi-file uImages the changed images and the wrapper).
+	### Runs until interrupted, failed rebuilds are reported and retried on the
+	### next change.
+	###
+	def Watch(self, Interval=1.0, Debounce=0.5, Verify=True):
+		Keys = [Key for Key, Value in self.DahuaFiles.items() if Value["pass"]]
+		Snapshots = {Key: self.Snapshot(Key) for Key in Keys}
+		self.Logger.info("Watching '%s' for changes, press Ctrl+C to stop.", self.Origin)
+
+		while True:
+			time.sleep(Interval)
+			Changed = {}
+			for Key in Keys:
+				Snapshot = self.Snapshot(Key)
+				if Snapshot != Snapshots[Key]:
+					Changed[Key] = Snapshot
+			if not Changed:
+				continue
+
+			# Wait for the editor/copy to settle
+			while True:
+				time.sleep(Debounce)
+				Settled = True
+				for Key in Keys:
+					Snapshot = self.Snapshot(Key)
+					if Snapshot != Changed.get(Key, Snapshots[Key]):
+						Changed[Key] = Snapshot
+						Settled = False
+				if Settled:
+					break
+
+			self.Logger.info("Changed: %s", ", ".join(Changed))
+			try:
+				with Staging.lock(self.BuildDir, self.Logger):
+					self.Prepare(list(Changed))
+					self.Rebuild(list(Changed))
+				if Verify:
+					self.Verify()
+			except Exception as e:
+				self.Logger.error("Rebuild failed: %s", e)
+			Snapshots.update(Changed)
+
+	def Rebuild(self, Keys):
+		for Key in Keys:
+			Value = self.DahuaFiles[Key]
+			self.Logger.info("Rebuilding '%s'.", Key)
+			with self.Profiler.Span("rebuild", key=Key):
+				self.BuildKey(Key, Value)
+			Headroom = self.CheckSize(Key, Value)
+			Size = os.path.getsize(self.ZipFiles[Key])
+			if Headroom is None:
+				self.Logger.info("'%s': %d bytes", Key, Size)
+			else:
+				self.Logger.info("'%s': %d bytes, %d bytes (%.1f%%) left in partition", Key, Size, Headroom, 100.0 * Headroom / (Size + Headroom))
+
+		self.WriteZip()
+		self.WriteManifest()
+
+	################################################################################
+	###
+	### WriteManifest() - Write SHA-256 manifests of the source files that went
+	###                   into the image to the build directory
+	###
+	### Hashes are cached by inode, mtime and size in the build directory, a
+	### rebuild only hashes the files which changed.
+	###
+	def WriteManifest(self):
+		if not self.WantManifest:
+			return
+		if not self.Manifest:
+			self.Manifest = Manifest.Manifest(os.path.join(self.BuildDir, "manifest-cache.json"), debug=self.Debug)
+		with self.Profiler.Span("manifest"):
+			if not self.Manifest.Write(self.Source, self.BuildDir):
+				raise Exception("Writing the manifest failed!")
+
+	def Verify(self):
+		self.Logger.info("Verifying '%s'.", os.path.basename(self.DestPath))
+		Verifier = verify.DahuaVerifier(self.Config, self.Debug)
+		with self.Profiler.Span("verify") as Span:
+			Span["bytes"] = os.path.getsize(self.DestPath)
+			Errors = Verifier.Verify(self.DestPath)
+		if Errors:
+			self.Logger.error("Verification of the generated firmware image failed!")
+			raise Exception("Verification failed!")
+
+	def IsMultiFile(self, Key):
+		HeaderPath = os.path.join(self.Source, Key + ".uImage")
+		if not os.path.isfile(HeaderPath):
+			return False
+		with open(HeaderPath, "rb") as HeaderFile:
+			Header = uImage.parseHeader(HeaderFile)
+		return Header["magic"] == uImage.HEADER_MAGIC and Header["imageType"] == uImage.searchTable(uImage.imageType, "multi")
+
+	def MultiFileKeys(self, Key):
+		# The extractor saved header and length table to <Key>.uImage
+		with open(os.path.join(self.Source, Key + ".uImage"), "rb") as HeaderFile:
+			Header = uImage.parseHeader(HeaderFile)
+		return [Key + ".%d" % Index for Index in range(len(Header["files"]))]
 
 	def Handle_uImage(self, Key):
 		OrigPath = os.path.join(self.Source, Key + ".uImage")
 		DestPath = os.path.join(self.BuildDir, Key)
 		DataPath = os.path.join(self.BuildDir, Key + ".raw")
 
+		Result = self.Stage("uImage", [OrigPath, DataPath], DestPath, lambda TempPath: self.MakeImage(Key, OrigPath, [DataPath], TempPath),
+							self.ImageCommand(OrigPath))
+
+		self.Logger.debug("Adding '%s' to zip file list.", Key)
+		self.ZipFiles[Key] = DestPath
+
+		return Result
+
+	################################################################################
+	###
+	### Handle_MultiFile(Key) - Rebuild every image of a multi-file uImage in
+	###                         parallel and let mkimage create the length table
+	###
+	def Handle_MultiFile(self, Key):
+		OrigPath = os.path.join(self.Source, Key + ".uImage")
+		DestPath = os.path.join(self.BuildDir, Key)
+		Keys = self.MultiFileKeys(Key)
+
+		with concurrent.futures.ThreadPoolExecutor() as Executor:
+			Results = list(Executor.map(self.Handle_MultiFileImage, Keys))
+		if any(Results):
+			return 1
+
+		DataPaths = [os.path.join(self.BuildDir, ChildKey) for ChildKey in Keys]
+		Result = self.Stage("uImage", [OrigPath] + DataPaths, DestPath, lambda TempPath: self.MakeImage(Key, OrigPath, DataPaths, TempPath),
+							self.ImageCommand(OrigPath))
+
+		self.Logger.debug("Adding '%s' to zip file list.", Key)
+		self.ZipFiles[Key] = DestPath
+
+		return Result
+
+	def Handle_MultiFileImage(self, Key):
+		OrigPath = os.path.join(self.Source, Key + ".raw")
+		HeaderPath = os.path.join(self.Source, Key + ".uImage")
+		ExtractedDir = os.path.join(self.Source, Key + ".extracted")
+		DestPath = os.path.join(self.BuildDir, Key)
+
+		# Images can be uImages themselves
+		IsImage = os.path.isfile(HeaderPath)
+		DataPath = DestPath + ".raw" if IsImage else DestPath
+
+		if os.path.isdir(ExtractedDir):
+			with open(OrigPath, "rb") as OrigFile:
+				Magic = struct.unpack("<I", OrigFile.read(4))[0]
+			if Magic == SquashFS.HEADER_MAGIC:
+				self.Logger.info("Processing '%s' (SquashFS).", Key)
+				Result = self.Stage("SquashFS", [ExtractedDir, OrigPath], DataPath, lambda TempPath: self.Handle_SquashFS(Key, TempPath),
+									self.SquashFSCommand(Key)[1])
+			else:
+				self.Logger.info("Processing '%s' (CramFS).", Key)
+				Result = self.Stage("CramFS", [ExtractedDir, OrigPath], DataPath, lambda TempPath: self.Handle_CramFS(Key, TempPath),
+									self.CramFSCommand(Key)[1])
+		else:
+			self.Logger.info("Processing '%s' (Plain).", Key)
+			Result = self.Stage("copy", [OrigPath], DataPath, lambda TempPath: self.Handle_Plain(Key, OrigPath, TempPath))
+
+		if Result != 0:
+			self.Logger.error("Handler returned non-zero return value for image: '%s'", Key)
+			return Result
+
+		if IsImage:
+			return self.Stage("uImage", [HeaderPath, DataPath], DestPath, lambda TempPath: self.MakeImage(Key, HeaderPath, [DataPath], TempPath),
+							  self.ImageCommand(HeaderPath))
+		return 0
+
+	def Handle_Plain(self, Key, OrigPath, DestPath):
+		with self.Profiler.Span("copy", key=Key) as Span:
+			Span["bytes"] = os.path.getsize(OrigPath)
+			shutil.copyfile(OrigPath, DestPath)
+		return 0
+
+	def ImageCommand(self, OrigPath):
+		### mkimage and its options for an image like OrigPath, None if it is no uImage
 		# Read uImage header of the original file.
 		OrigFile = open(OrigPath, "rb")
 		Header = uImage.parseHeader(OrigFile)
 		OrigFile.close()
 
 		if Header["magic"] != uImage.HEADER_MAGIC:
-			OrigFile.close()
-			self.Logger.error("Invalid uImage magic number!")
-			return 1
+			return None
 
 		Arch = uImage.archType[Header["arch"]][1]
 		OS = uImage.osType[Header["osType"]][1]
@@ -188,23 +807,25 @@ class DahuaBuilder():
 		LoadAddress = str(hex(Header["loadAddr"]))[2:]
 		EntryPoint = str(hex(Header["entryAddr"]))[2:]
 		Name = Header["name"].decode("ascii", errors="ignore").rstrip('\0')
+		return ["mkimage", "-A", Arch, "-O", OS, "-T", ImageType, "-C", Compression, "-a", LoadAddress, "-e", EntryPoint, "-n", Name]
 
-		if self.Debug:
-			self.Logger.debug(' '.join(["mkimage", "-A", Arch, "-O", OS, "-T", ImageType, "-C", Compression,
-										"-a", LoadAddress, "-e", EntryPoint, "-n", Name, "-d", DataPath, DestPath]))
-
-		Result = subprocess.call(["mkimage", "-A", Arch, "-O", OS, "-T", ImageType, "-C", Compression,
-								  "-a", LoadAddress, "-e", EntryPoint, "-n", Name, "-d", DataPath, DestPath])
+	def MakeImage(self, Key, OrigPath, DataPaths, DestPath):
+		DataPath = ":".join(DataPaths)
+		Command = self.ImageCommand(OrigPath)
+		if not Command:
+			self.Logger.error("Invalid uImage magic number!")
+			return 1
 
-		self.Logger.debug("Adding '%s' to zip file list.", Key)
-		self.ZipFileList.append((DestPath, Key))
+		with self.Profiler.Span("mkimage", key=Key) as Span:
+			Span["bytes"] = sum(os.path.getsize(Path) for Path in DataPaths)
+			Result = self.Runner.Run(Command + ["-d", DataPath, DestPath], Key, [DestPath])
 
 		return Result
 
-	def Handle_SquashFS(self, Key):
-		ExtractedDir = os.path.join(self.Source, Key + ".extracted")
+	def SquashFSCommand(self, Key):
+		### Header of the original image and mksquashfs with the options to build
+		### it again, (None, None) if the original is no SquashFS image
 		OrigPath = os.path.join(self.Source, Key + ".raw")
-		DestPath = os.path.join(self.BuildDir, Key + ".raw")
 
 		# Read SquashFS header to figure out compression and blocksize of the original file.
 		OrigFile = open(OrigPath, "rb")
@@ -212,44 +833,107 @@ class DahuaBuilder():
 		OrigFile.close()
 
 		if Header["s_magic"] != SquashFS.HEADER_MAGIC:
-			OrigFile.close()
+			return None, None
+
+		Version = "" if Header["s_major"] == 4 else str(Header["s_major"])
+		return Header, ["mksquashfs" + Version] + SquashFS.buildConOpts(Header)
+
+	def Handle_SquashFS(self, Key, DestPath):
+		ExtractedDir = os.path.join(self.Source, Key + ".extracted")
+
+		Header, Command = self.SquashFSCommand(Key)
+		if not Command:
 			self.Logger.error("Invalid SquashFS magic number!")
 			return 1
 
-		Version = "" if Header["s_major"] == 4 else str(Header["s_major"])
-		Binary = "mksquashfs" + Version
+		Binary = Command[0]
 		if self.CheckDependency(Binary):
 			return 1
 
-		ConOpts = SquashFS.buildConOpts(Header)
-
 		# Need root to access all files.
-		if self.Debug:
-			self.Logger.debug(' '.join(["sudo", Binary, ExtractedDir, DestPath] + ConOpts))
-			Result = subprocess.call(["sudo", Binary, ExtractedDir, DestPath] + ConOpts)
-		else:
-			Result = subprocess.call(["sudo", Binary, ExtractedDir, DestPath] + ConOpts, stdout=subprocess.DEVNULL)
+		with self.Profiler.Span(Binary, key=Key) as Span:
+			Result = self.Runner.Run(["sudo", Binary, ExtractedDir, DestPath] + Command[1:], Key, [DestPath])
+			if os.path.isfile(DestPath):
+				Span["bytes"] = os.path.getsize(DestPath)
 
+		if Result == 0:
+			Result = self.CheckSquashFS(Key, Header, DestPath)
 		return Result
 
-	def Handle_CramFS(self, Key):
-		ExtractedDir = os.path.join(self.Source, Key + ".extracted")
+	def CheckSquashFS(self, Key, Original, Path):
+		# Options mksquashfs dropped or did not understand cost headroom or break booting
+		with open(Path, "rb") as fp:
+			Header = SquashFS.parseHeader(fp)
+		if Header["s_magic"] != SquashFS.HEADER_MAGIC:
+			self.Logger.error("'%s': mksquashfs wrote no SquashFS image!", Key)
+			return 1
+
+		Diffs = SquashFS.compareHeaders(Original, Header)
+		for Field, Orig, Built in Diffs:
+			self.Logger.error("'%s': SquashFS %s is %s, the original has %s!", Key, Field, Built, Orig)
+		if Original.get("bytes_used"):
+			self.Logger.info("'%s': %d bytes used, %.1f%% of the original %d bytes.", Key, Header["bytes_used"],
+							 100.0 * Header["bytes_used"] / Original["bytes_used"], Original["bytes_used"])
+		return 1 if Diffs else 0
+
+	def CramFSCommand(self, Key):
+		### Header of the original image and mkcramfs with the options to build
+		### it again, (None, None) if the original is no CramFS image
 		OrigPath = os.path.join(self.Source, Key + ".raw")
-		DestPath = os.path.join(self.BuildDir, Key + ".raw")
 
-		Binary = "mkcramfs"
+		# Read CramFS header to figure out byte order, padding and edition of the original file.
+		with open(OrigPath, "rb") as OrigFile:
+			Header = CramFS.parseHeader(OrigFile)
+
+		if Header["magic"] != CramFS.HEADER_MAGIC:
+			return None, None
+		return Header, ["mkcramfs"] + CramFS.buildConOpts(Header)
+
+	def Handle_CramFS(self, Key, DestPath):
+		ExtractedDir = os.path.join(self.Source, Key + ".extracted")
+
+		Header, Command = self.CramFSCommand(Key)
+		if not Command:
+			self.Logger.error("Invalid CramFS magic number!")
+			return 1
+
+		Binary = Command[0]
 		if self.CheckDependency(Binary):
 			return 1
 
 		# Need root to access all files.
-		if self.Debug:
-			self.Logger.debug(' '.join(["sudo", Binary, ExtractedDir, DestPath]))
-			Result = subprocess.call(["sudo", Binary, ExtractedDir, DestPath])
-		else:
-			Result = subprocess.call(["sudo", Binary, ExtractedDir, DestPath], stdout=subprocess.DEVNULL)
+		with self.Profiler.Span(Binary, key=Key) as Span:
+			Result = self.Runner.Run(["sudo"] + Command + [ExtractedDir, DestPath], Key, [DestPath])
+			if os.path.isfile(DestPath):
+				Span["bytes"] = os.path.getsize(DestPath)
 
+		if Result == 0:
+			Result = self.CheckCramFS(Key, Header, DestPath)
 		return Result
 
+	def CheckCramFS(self, Key, Original, Path):
+		# A mkcramfs which ignored an option or wrote a broken image would brick the camera
+		with open(Path, "rb") as fp:
+			Header = CramFS.parseHeader(fp)
+			if Header["magic"] != CramFS.HEADER_MAGIC:
+				self.Logger.error("'%s': mkcramfs wrote no CramFS image!", Key)
+				return 1
+			for Field in ("endian", "start", "edition"):
+				if Header[Field] != Original[Field]:
+					self.Logger.error("'%s': CramFS %s is %r, the original has %r!", Key, Field, Header[Field], Original[Field])
+					return 1
+			Data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			Crc = CramFS.checkCrc(Data)
+		except Exception as e:
+			self.Logger.error("'%s': %s", Key, e)
+			return 1
+		finally:
+			Data.close()
+		if Crc and Crc[0] != Crc[1]:
+			self.Logger.error("'%s': CramFS CRC is 0x%08x, should be 0x%08x!", Key, Crc[0], Crc[1])
+			return 1
+		return 0
 
 if __name__ == "__main__":
 	logging.basicConfig(format="%(levelname)s\t%(message)s")
@@ -262,6 +946,19 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description="Build Dahua firmware images.")
 	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
 	parser.add_argument("-c", "--config", default="auto", help="Configuration to use. (Default: auto)")
+	parser.add_argument("-n", "--no-verify", action="store_true", help="Don't verify the generated firmware image")
+	parser.add_argument("-p", "--profile", metavar="FILE", help="Write per-stage timing report (JSON/Chrome trace) to FILE")
+	parser.add_argument("--overlay", metavar="DIR", help="Apply the patch set in DIR before building")
+	parser.add_argument("--optimize-web", action="store_true", help="Minify/recompress the web partitions of the staged source before building")
+	parser.add_argument("--strip-elf", action="store_true", help="Strip symbols/debug sections of the ELF files of the staged source before building")
+	parser.add_argument("-m", "--manifest", action="store_true", help="Write SHA-256 manifests of the source files to the build directory (manifest.sha256, manifest/<file>.sha256)")
+	parser.add_argument("-o", "--output", metavar="FILE", help="Firmware image to create. (Default: <build dir>/<name>.bin)")
+	parser.add_argument("-b", "--build-dir", metavar="DIR", help="Directory for intermediary files. (Default: <source>/build)")
+	parser.add_argument("--clean", action="store_true", help="Delete the build directory instead of resuming the previous build")
+	parser.add_argument("-w", "--watch", action="store_true", help="Keep running and rebuild the partitions whose files change")
+	parser.add_argument("--interval", type=float, default=1.0, help="Seconds between polls in watch mode (Default: 1)")
+	parser.add_argument("-j", "--jobs", type=int, help="Number of external tools running at once. (Default: number of CPUs)")
+	parser.add_argument("-t", "--timeout", metavar="[TOOL=]SECONDS", action="append", help="Kill a tool (or all tools) running longer than this, may be repeated")
 	parser.add_argument("source", help="Source Directory (of previously extracted firmware image)")
 	args = parser.parse_args()
 
@@ -305,7 +1002,44 @@ if __name__ == "__main__":
 
 	Config = importlib.import_module("configs." + Found)
 
-	builder = DahuaBuilder(Config, args.verbose)
+	patchSet = None
+	if args.overlay:
+		# Need root to change the files of the staged source.
+		if os.geteuid() != 0:
+			Logger.error("Applying a patch set needs root to change the extracted files, please run with sudo.")
+			sys.exit(1)
+		patchSet = overlay.DahuaOverlay(args.verbose)
+		patchSet.Load(args.overlay)
+
+	# Need root to read all files.
+	if args.manifest and os.geteuid() != 0:
+		Logger.error("Writing manifests needs root to read every extracted file, please run with sudo.")
+		sys.exit(1)
+
+	# Need root to replace the files of the staged source.
+	if (args.optimize_web or args.strip_elf) and os.geteuid() != 0:
+		Logger.error("Optimizing/stripping needs root to replace the extracted files, please run with sudo.")
+		sys.exit(1)
+
+	runner = Runner.Runner(args.verbose, args.jobs, Runner.parseTimeouts(args.timeout))
+	optimizer = webopt.DahuaWebOptimizer(args.verbose, args.jobs) if args.optimize_web else None
+	stripper = elfstrip.DahuaElfStripper(args.verbose, args.jobs) if args.strip_elf else None
+	builder = DahuaBuilder(Config, args.verbose, runner=runner, overlay=patchSet, clean=args.clean, optimizer=optimizer,
+						   stripper=stripper, manifest=args.manifest)
 	if builder.CheckDependencies():
 		sys.exit(1)
-	builder.Build(args.source)
+	# A failed build is where the timings matter most
+	try:
+		builder.Build(args.source, args.build_dir, args.output)
+		if not args.no_verify:
+			builder.Verify()
+		if args.watch:
+			try:
+				builder.Watch(args.interval, Verify=not args.no_verify)
+			except KeyboardInterrupt:
+				pass
+	finally:
+		if args.profile:
+			builder.Profiler.Dump(Logger)
+			builder.Profiler.Write(args.profile)
+			Logger.info("Wrote profile to: '%s'", args.profile)
@@ -7,17 +7,17 @@ DAHUA_FILES = OrderedDict([
 	}),
 	("kernel.img", {
 		"required": True,
-		"type": DAHUA_TYPE.Plain,
+		"type": DAHUA_TYPE.Plain | DAHUA_TYPE.Kernel,
 		"size": 0x00180000
 	}),
 	("dhboot-min.bin.img", {
 		"required": True,
-		"type": DAHUA_TYPE.Plain,
+		"type": DAHUA_TYPE.Plain | DAHUA_TYPE.Environment,
 		"size": 0x00040000
 	}),
 	("dhboot.bin.img", {
 		"required": True,
-		"type": DAHUA_TYPE.Plain,
+		"type": DAHUA_TYPE.Plain | DAHUA_TYPE.Environment,
 		"size": 0x00040000
 	}),
 	("romfs-x.squashfs.img", {
@@ -11,12 +11,12 @@ DAHUA_FILES = OrderedDict([
 	}),
 	("kernel.img", {
 		"required": True,
-		"type": DAHUA_TYPE.Plain,
+		"type": DAHUA_TYPE.Plain | DAHUA_TYPE.Kernel,
 		"size": 0x00180000
 	}),
 	("dhboot.bin.img", {
 		"required": True,
-		"type": DAHUA_TYPE.Plain,
+		"type": DAHUA_TYPE.Plain | DAHUA_TYPE.Environment,
 		"size": 0x00030000
 	}),
 	("romfs-x.squashfs.img", {
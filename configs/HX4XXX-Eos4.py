@@ -11,12 +11,12 @@ DAHUA_FILES = OrderedDict([
 	}),
 	("kernel.img", {
 		"required": True,
-		"type": DAHUA_TYPE.Plain,
+		"type": DAHUA_TYPE.Plain | DAHUA_TYPE.Kernel,
 		"size": 0x00500000
 	}),
 	("dhboot.bin.img", {
 		"required": True,
-		"type": DAHUA_TYPE.Plain,
+		"type": DAHUA_TYPE.Plain | DAHUA_TYPE.Environment,
 		"size": 0x00100000
 	}),
 	("romfs-x.squashfs.img", {
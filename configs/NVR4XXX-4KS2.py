@@ -7,7 +7,7 @@ DAHUA_FILES = OrderedDict([
 	}),
 	("u-boot.bin.img", {
 		"required": True,
-		"type": DAHUA_TYPE.Plain,
+		"type": DAHUA_TYPE.Plain | DAHUA_TYPE.Environment,
 		"size": 0x00300000
 	}),
 	("uImage.img", {
@@ -12,7 +12,7 @@ DAHUA_FILES = OrderedDict([
 	}),
 	("kernel-x.cramfs.img", {
 		"required": True,
-		"type": DAHUA_TYPE.Plain,
+		"type": DAHUA_TYPE.Plain | DAHUA_TYPE.Kernel,
 		"size": 0x00200000
 	}),
 	("romfs-x.cramfs.img", {
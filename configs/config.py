@@ -6,6 +6,8 @@ class DAHUA_TYPE(IntEnum):
 	uImage = 2
 	SquashFS = 4
 	CramFS = 8
+	Kernel = 16
+	Environment = 32
 
 DAHUA_CONFIGS = [
 	"HX4XXX-Eos4", "HX4XXX-Eos", "HX4X2X-Themis",
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import json
+import hashlib
+import logging
+import Firmware
+import importlib
+from configs.config import *
+
+class DahuaDiff():
+	UIMAGE_FIELDS = ["name", "time", "size", "loadAddr", "entryAddr", "dataCrc", "osType", "arch", "imageType", "compression"]
+	SQUASHFS_FIELDS = ["s_major", "s_minor", "compression", "block_size", "flags", "inodes", "fragments", "no_ids", "bytes_used", "comp_opts"]
+	CRAMFS_FIELDS = ["endian", "start", "size", "flags", "edition", "blocks", "files", "name"]
+	INODE_FIELDS = ["type", "mode", "uid", "gid", "target", "rdev"]
+	def __init__(self, config, debug):
+		self.Config = config
+		self.Debug = debug
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+		self.Changes = []
+		self.DahuaFiles = self.Config.DAHUA_FILES
+
+	def Change(self, kind, key, path=None, fields=None):
+		Change = {"change": kind, "partition": key, "path": path}
+		if fields:
+			Change["fields"] = fields
+		self.Changes.append(Change)
+		self.Logger.debug("%s %s%s %s", kind[0].upper(), key, ":" + path if path else "", " ".join(fields) if fields else "")
+
+	def CompareFields(self, old, new, keys):
+		Fields = {}
+		for Key in keys:
+			if old.get(Key) != new.get(Key):
+				Fields[Key] = [old.get(Key), new.get(Key)]
+		return Fields
+
+	def Diff(self, old, new):
+		self.Changes = []
+		OldZip = Firmware.FirmwareZip(old)
+		NewZip = Firmware.FirmwareZip(new)
+		try:
+			OldNames = OldZip.namelist()
+			NewNames = NewZip.namelist()
+			Keys = [Key for Key in self.DahuaFiles if Key in OldNames or Key in NewNames]
+			Keys += [Key for Key in OldNames + NewNames if Key not in Keys and Key not in self.DahuaFiles]
+
+			for Key in Keys:
+				if Key not in NewNames:
+					self.Change("removed", Key)
+				elif Key not in OldNames:
+					self.Change("added", Key)
+				else:
+					self.DiffPartition(Key, OldZip.getinfo(Key), NewZip.getinfo(Key), OldZip, NewZip)
+		finally:
+			OldZip.close()
+			NewZip.close()
+		return self.Changes
+
+	################################################################################
+	###
+	### DiffPartition - Compare headers, superblocks and filesystem trees
+	###
+	### Partitions with the same ZIP CRC are skipped, filesystems are compared by
+	### their directory tables and stored data blocks, only files whose stored
+	### data differs get decompressed.
+	###
+	def DiffPartition(self, key, oldInfo, newInfo, oldZip, newZip):
+		if oldInfo.CRC == newInfo.CRC and oldInfo.file_size == newInfo.file_size:
+			self.Logger.debug("'%s' is unchanged.", key)
+			return
+
+		self.Logger.info("Comparing '%s'.", key)
+		OldData = Firmware.mapMember(oldZip, oldInfo)
+		NewData = Firmware.mapMember(newZip, newInfo)
+		Old = Firmware.openPartition(OldData)
+		New = Firmware.openPartition(NewData)
+		try:
+			if Old["uImage"] and New["uImage"]:
+				Fields = self.CompareFields(Old["uImage"], New["uImage"], self.UIMAGE_FIELDS)
+				if Fields:
+					self.Change("modified", key, fields=Fields)
+
+			if Old["fstype"] != New["fstype"] or not Old["fs"] or not New["fs"]:
+				self.Change("modified", key, fields={
+					"filesystem": [Old["fstype"], New["fstype"]],
+					"size": [oldInfo.file_size, newInfo.file_size],
+					"crc": [oldInfo.CRC, newInfo.CRC]
+				})
+				return
+
+			Fields = self.CompareFields(Old["superblock"], New["superblock"],
+				self.SQUASHFS_FIELDS if Old["fstype"] == "SquashFS" else self.CRAMFS_FIELDS)
+			if Fields:
+				self.Change("modified", key, path=".", fields=Fields)
+
+			self.DiffTree(key, Old["fs"], New["fs"])
+		finally:
+			for Part in (Old, New):
+				if Part["fs"]:
+					Part["fs"].close()
+			for Data in (OldData, NewData):
+				if Data:
+					Data.close()
+
+	def DiffTree(self, key, oldFS, newFS):
+		OldTree = dict(oldFS.walk())
+		NewTree = dict(newFS.walk())
+
+		for Path, OldInode in OldTree.items():
+			if Path not in NewTree:
+				self.Change("removed", key, Path)
+				continue
+
+			NewInode = NewTree[Path]
+			Fields = self.CompareFields(OldInode, NewInode, self.INODE_FIELDS)
+			if OldInode["type"] == "f" and NewInode["type"] == "f":
+				if OldInode["file_size"] != NewInode["file_size"]:
+					Fields["size"] = [OldInode["file_size"], NewInode["file_size"]]
+				elif oldFS.blockDigest(OldInode) != newFS.blockDigest(NewInode):
+					# Stored data differs, may still be the same content compressed differently
+					OldDigest = self.ContentDigest(oldFS, OldInode)
+					NewDigest = self.ContentDigest(newFS, NewInode)
+					if OldDigest != NewDigest:
+						Fields["sha256"] = [OldDigest, NewDigest]
+			if Fields:
+				self.Change("modified", key, Path, Fields)
+
+		for Path in NewTree:
+			if Path not in OldTree:
+				self.Change("added", key, Path)
+
+	def ContentDigest(self, fs, inode):
+		Digest = hashlib.sha256()
+		for Block in fs.readFile(inode):
+			Digest.update(Block)
+		return Digest.hexdigest()
+
+	def Dump(self):
+		for Change in self.Changes:
+			Name = Change["partition"] + (":" + Change["path"] if Change["path"] else "")
+			Details = ", ".join("%s: %s -> %s" % (Field, Values[0], Values[1]) for Field, Values in Change.get("fields", {}).items())
+			print("%s %s%s" % (Change["change"][0].upper(), Name, " (" + Details + ")" if Details else ""))
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+	logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+	logging.addLevelName(logging.WARNING, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+	logging.addLevelName(logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+	logging.addLevelName(logging.CRITICAL, "\033[5m\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.CRITICAL))
+
+	parser = argparse.ArgumentParser(description="Compare two Dahua firmware images without extracting them.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-c", "--config", default="auto", help="Configuration to use. (Default: auto)")
+	parser.add_argument("-o", "--output", help="Write change list as JSON to this file")
+	parser.add_argument("old", help="Old firmware image")
+	parser.add_argument("new", help="New firmware image")
+	args = parser.parse_args()
+
+	Logger = logging.getLogger("main")
+	if args.verbose:
+		Logger.setLevel(logging.DEBUG)
+	else:
+		Logger.setLevel(logging.INFO)
+
+	for Source in (args.old, args.new):
+		if not os.path.isfile(Source):
+			Logger.error("No such file: '%s'", Source)
+			sys.exit(1)
+
+	Found = None
+	if args.config == "auto":
+		Name = os.path.basename(os.path.abspath(args.old)).lower()
+		for Config in DAHUA_CONFIGS:
+			if Config.lower() in Name:
+				Logger.warn("Autodetected config: %s", Config)
+				Found = Config
+				break
+
+		if not Found:
+			Logger.error("Could not autodetect config!")
+	else:
+		ArgConfig = args.config.lower()
+		for Config in DAHUA_CONFIGS:
+			if Config.lower() == ArgConfig:
+				Logger.warn("Found config: %s", Config)
+				Found = Config
+				break
+
+		if not Found:
+			Logger.error("Invalid config specified! (Add to configs/config.py DAHUA_CONFIGS if you made a new one)")
+
+	if not Found:
+		Logger.info("Please use -c to select the correct config from the following list:")
+		for Config in DAHUA_CONFIGS:
+			Logger.info("\t" + Config)
+		sys.exit(1)
+
+	Config = importlib.import_module("configs." + Found)
+
+	differ = DahuaDiff(Config, args.verbose)
+	differ.Diff(args.old, args.new)
+	differ.Dump()
+
+	if args.output:
+		with open(args.output, "w") as fp:
+			json.dump(differ.Changes, fp, indent=1, default=str)
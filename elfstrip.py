@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import stat
+import mmap
+import lzma
+import zlib
+import struct
+import shutil
+import logging
+import concurrent.futures
+import ELF
+import SquashFS
+import Firmware
+import Store
+import Staging
+try:
+	import lzo
+except ImportError:
+	lzo = None
+
+### <Key>.elfstrip next to <Key>.extracted holds the originals and the mapping
+BACKUP_SUFFIX = ".elfstrip"
+### Cache entry of a file strip() can not make smaller
+CACHE_NONE = ".none"
+CRAMFS_PAGE_SIZE = 4096
+
+def isElf(path):
+	with open(path, "rb") as fp:
+		return fp.read(len(ELF.HEADER_MAGIC)) == ELF.HEADER_MAGIC
+
+################################################################################
+###
+### compressedSize(data, compression, blockSize) - Estimate how much space data
+###                                                 takes in a filesystem image
+###
+### Parameters:   compression: SquashFS compression id, None for zlib (CramFS)
+###               blockSize:   the filesystem compresses blocks of this size
+###
+### Blocks which do not get smaller are counted as stored. LZ4/Zstandard (and
+### LZO without python-lzo) are estimated with zlib.
+###
+def compressedSize(data, compression, blockSize):
+	Size = 0
+	for offset in range(0, len(data), blockSize):
+		block = data[offset:offset + blockSize]
+		if compression == SquashFS.XZ_COMPRESSION:
+			packed = lzma.compress(block, format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE)
+		elif compression == SquashFS.LZMA_COMPRESSION:
+			packed = lzma.compress(block, format=lzma.FORMAT_ALONE)
+		elif compression == SquashFS.LZO_COMPRESSION and lzo:
+			packed = lzo.compress(block, 9, False)
+		else:
+			packed = zlib.compress(block, 9)
+		Size += min(len(packed), len(block))
+	return Size
+
+################################################################################
+###
+### stripFile(path, cacheDir, compression, blockSize) - Strip one ELF file
+###                                                     (runs in a worker process)
+###
+### Results are cached by the SHA-256 of the input in cacheDir.
+###
+### Returns:      (path, stripped data, compressed bytes saved) or
+###               (path, None, 0) if the file did not get smaller
+###
+def stripFile(path, cacheDir, compression, blockSize):
+	with open(path, "rb") as fp:
+		data = fp.read()
+	Digest = Store.sha256(data)
+	CachePath = os.path.join(cacheDir, Digest) if cacheDir else None
+
+	if CachePath and os.path.isfile(CachePath + CACHE_NONE):
+		return path, None, 0
+	if CachePath and os.path.isfile(CachePath):
+		with open(CachePath, "rb") as fp:
+			new = fp.read()
+	else:
+		try:
+			new = ELF.strip(data)
+		except (struct.error, IndexError, KeyError):
+			new = None
+		if CachePath:
+			Staging.replaceFile(CachePath if new else CachePath + CACHE_NONE, new if new else b"")
+
+	if not new:
+		return path, None, 0
+	return path, new, compressedSize(data, compression, blockSize) - compressedSize(new, compression, blockSize)
+
+class DahuaElfStripper():
+	def __init__(self, debug, jobs=None):
+		self.Debug = debug
+		self.Jobs = jobs if jobs else os.cpu_count()
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+
+	################################################################################
+	###
+	### Strip(source, keys, cacheDir, budgets, dryRun) - Strip the ELF files of an
+	###                                                  extracted firmware in place
+	###
+	### Parameters:   keys:     partitions to strip (Default: every partition
+	###                         with an .extracted tree)
+	###               cacheDir: stripped files by SHA-256 of the original
+	###                         (Default: <source>/build/elfcache)
+	###               budgets:  partition key -> size, for the report
+	###
+	### Symbol tables, comments and debug sections are removed on a process pool,
+	### kernel modules are left alone. Originals are kept in <Key>.elfstrip with
+	### a mapping for Revert().
+	###
+	### Returns:      partition key -> (bytes saved, compressed bytes saved)
+	###
+	def Strip(self, source, keys=None, cacheDir=None, budgets=None, dryRun=False):
+		Source = os.path.abspath(source)
+		CacheDir = os.path.abspath(cacheDir) if cacheDir else os.path.join(Source, "build", "elfcache")
+		os.makedirs(CacheDir, exist_ok=True)
+		if keys is None:
+			keys = [Name[:-len(".extracted")] for Name in sorted(os.listdir(Source)) if Name.endswith(".extracted")]
+
+		Saved = {}
+		for Key in keys:
+			Tree = os.path.join(Source, Key + ".extracted")
+			if not os.path.isdir(Tree):
+				continue
+			Backup = os.path.join(Source, Key + BACKUP_SUFFIX)
+			Mapping = Staging.loadMapping(Backup)
+			Compression, BlockSize = self.Compression(Source, Key)
+
+			Saved[Key] = self.StripTree(Tree, Backup, Mapping, CacheDir, Compression, BlockSize, dryRun)
+			if not dryRun and Mapping["files"]:
+				Staging.writeMapping(Backup, Mapping)
+
+			Budget = (budgets or {}).get(Key)
+			Raw, Compressed = Saved[Key]
+			if Budget:
+				self.Logger.info("'%s': %s %d bytes, about %d compressed (%.1f%% of the %d byte partition).", Key,
+								 "would save" if dryRun else "saved", Raw, Compressed, Compressed * 100.0 / Budget, Budget)
+			else:
+				self.Logger.info("'%s': %s %d bytes, about %d compressed.", Key, "would save" if dryRun else "saved", Raw, Compressed)
+		return Saved
+
+	def Compression(self, source, key):
+		### Compressor and block size of the filesystem image the tree came from
+		for Path in (os.path.join(source, key), os.path.join(source, key + ".raw")):
+			if not os.path.isfile(Path) or not os.path.getsize(Path):
+				continue
+			with open(Path, "rb") as fp:
+				Data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				Part = Firmware.openPartition(Data)
+				if Part["fs"]:
+					Part["fs"].close()
+			finally:
+				Data.close()
+			if Part["fstype"] == "SquashFS":
+				return Part["superblock"].get("compression", SquashFS.ZLIB_COMPRESSION), Part["superblock"]["block_size"]
+			if Part["fstype"] == "CramFS":
+				return None, CRAMFS_PAGE_SIZE
+		return None, CRAMFS_PAGE_SIZE
+
+	def StripTree(self, tree, backup, mapping, cacheDir, compression, blockSize, dryRun):
+		### Hardlinks inside the tree are stripped once and linked again
+		Inodes = {}
+		for Root, Dirs, Files in os.walk(tree):
+			for Name in sorted(Files):
+				Path = os.path.join(Root, Name)
+				Stat = os.lstat(Path)
+				if stat.S_ISREG(Stat.st_mode) and Stat.st_size > len(ELF.HEADER_MAGIC) and isElf(Path):
+					Inodes.setdefault((Stat.st_dev, Stat.st_ino), []).append(Path)
+		Jobs = [Paths[0] for Paths in Inodes.values()]
+		Links = {Paths[0]: Paths[1:] for Paths in Inodes.values()}
+
+		Raw = 0
+		Compressed = 0
+		with concurrent.futures.ProcessPoolExecutor(self.Jobs) as Executor:
+			Futures = [Executor.submit(stripFile, Path, cacheDir, compression, blockSize) for Path in Jobs]
+			for Future in concurrent.futures.as_completed(Futures):
+				Path, New, Packed = Future.result()
+				if New is None:
+					continue
+				RelPath = os.path.relpath(Path, tree)
+				Size = os.path.getsize(Path)
+				Raw += Size - len(New)
+				Compressed += Packed
+				self.Logger.info("%s: %d -> %d bytes, about %d compressed bytes saved", RelPath, Size, len(New), Packed)
+				if dryRun:
+					continue
+
+				Entry = mapping["files"].get(RelPath)
+				if not Entry:
+					### Keep the first original only
+					BackupPath = os.path.join(backup, "files", RelPath)
+					os.makedirs(os.path.dirname(BackupPath), exist_ok=True)
+					shutil.copyfile(Path, BackupPath)
+					Entry = mapping["files"][RelPath] = {"original": Store.hashFile(Path), "size": Size}
+				Entry["stripped"] = Store.sha256(New)
+				Staging.replaceFile(Path, New)
+				for Link in Links[Path]:
+					mapping["links"][os.path.relpath(Link, tree)] = RelPath
+					Staging.linkFile(Path, Link)
+		return Raw, Compressed
+
+	################################################################################
+	###
+	### Revert(source, keys) - Undo Strip() using the mapping
+	###
+	### Files changed after they were stripped are left as they are.
+	###
+	def Revert(self, source, keys=None):
+		Source = os.path.abspath(source)
+		if keys is None:
+			keys = [Name[:-len(BACKUP_SUFFIX)] for Name in sorted(os.listdir(Source)) if Name.endswith(BACKUP_SUFFIX)]
+		for Key in keys:
+			Tree = os.path.join(Source, Key + ".extracted")
+			Backup = os.path.join(Source, Key + BACKUP_SUFFIX)
+			if not os.path.isfile(os.path.join(Backup, Staging.MAPPING_FILE)):
+				continue
+			Mapping = Staging.loadMapping(Backup)
+			Kept = 0
+
+			for RelPath, Entry in Mapping["files"].items():
+				Path = os.path.join(Tree, RelPath)
+				if not os.path.isfile(Path) or Store.hashFile(Path) != Entry["stripped"]:
+					self.Logger.warning("'%s': '%s' was changed after it was stripped, keeping it.", Key, RelPath)
+					Kept += 1
+					continue
+				with open(os.path.join(Backup, "files", RelPath), "rb") as fp:
+					Staging.replaceFile(Path, fp)
+				for Link, Target in Mapping["links"].items():
+					if Target == RelPath and os.path.isfile(os.path.join(Tree, Link)):
+						Staging.linkFile(Path, os.path.join(Tree, Link))
+
+			if not Kept:
+				shutil.rmtree(Backup)
+			self.Logger.info("'%s': restored %d file(s).", Key, len(Mapping["files"]) - Kept)
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+	logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+	logging.addLevelName(logging.WARNING, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+	logging.addLevelName(logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+	logging.addLevelName(logging.CRITICAL, "\033[5m\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.CRITICAL))
+
+	parser = argparse.ArgumentParser(description="Strip the ELF files of an extracted Dahua firmware image.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-n", "--dry-run", action="store_true", help="Only show how many bytes would be saved")
+	parser.add_argument("-j", "--jobs", type=int, help="Number of worker processes. (Default: number of CPUs)")
+	parser.add_argument("-k", "--key", action="append", help="Partition to strip/revert, may be repeated (Default: all extracted partitions)")
+	parser.add_argument("--cache", metavar="DIR", help="Cache of stripped files. (Default: <source>/build/elfcache)")
+	parser.add_argument("command", choices=["strip", "revert"], help="strip: remove symbols/debug sections in place, revert: restore the originals")
+	parser.add_argument("source", help="Extracted firmware")
+	args = parser.parse_args()
+
+	# Need root to replace the extracted files.
+	if not args.dry_run and os.geteuid() != 0:
+		logging.getLogger("main").error("Replacing the extracted files needs root, please run with sudo.")
+		sys.exit(1)
+
+	stripper = DahuaElfStripper(args.verbose, args.jobs)
+	if args.command == "strip":
+		stripper.Strip(args.source, args.key, args.cache, dryRun=args.dry_run)
+	else:
+		stripper.Revert(args.source, args.key)
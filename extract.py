@@ -5,26 +5,51 @@ import os
 import sys
 import distutils.spawn
 import logging
-import zipfile
-import subprocess
 import shutil
+import struct
+import mmap
+import json
+import concurrent.futures
 import uImage
+import SquashFS
+import CramFS
+import Kernel
+import UBootEnv
+import Profiler
+import Runner
+import Firmware
+import Store
+import Manifest
+import langdb
+import nested
+import Staging
+import overlay
 import importlib
+import contextlib
 from configs.config import *
 
 class DahuaExtractor():
 	DEPENDENCIES = ["sudo"]
-	def __init__(self, config, debug):
+	def __init__(self, config, debug, profiler=None, runner=None, store=None, overlay=None, langDb=None, manifest=None, nested=None, depth=None):
 		self.Config = config
 		self.Debug = debug
+		self.Profiler = profiler if profiler else Profiler.Profiler()
+		self.Runner = runner if runner else Runner.Runner(debug)
 		self.Logger = logging.getLogger(__class__.__name__)
 		if self.Debug:
 			self.Logger.setLevel(logging.DEBUG)
 		else:
 			self.Logger.setLevel(logging.INFO)
 		self.Source = None
-		self.SourceFile = None
+		self.Stream = None
 		self.ZipFile = None
+		self.MultiFiles = {}
+		self.Store = store
+		self.Overlay = overlay
+		self.LangDb = langDb
+		self.Manifest = manifest
+		self.Nested = nested
+		self.Depth = depth
 		self.DahuaFiles = self.Config.DAHUA_FILES
 
 	def CheckDependencies(self):
@@ -39,29 +64,96 @@ class DahuaExtractor():
 			self.Logger.critical("Missing dependency: '%s'", dependency)
 			return 1
 
-	def Extract(self, source):
-		self.Source = os.path.abspath(source)
+	################################################################################
+	###
+	### Extract(source, dest) - Extract source to dest (<source>.extracted in the
+	###                         current directory by default)
+	###
+	### Everything is extracted to a staging directory next to dest which is
+	### renamed to dest when complete, dest is locked during the extraction.
+	### source can also be "-" (stdin) or a file object, the image is then read
+	### sequentially and dest is required.
+	###
+	def Extract(self, source, dest=None):
+		if isinstance(source, str) and source != "-":
+			self.Source = os.path.abspath(source)
+			self.Stream = None
+			Target = dest if dest else os.path.basename(self.Source) + ".extracted"
+		else:
+			self.Source = None
+			self.Stream = sys.stdin.buffer if source == "-" else source
+			if not dest:
+				raise Exception("Destination directory required when extracting from a stream!")
+			Target = dest
+
+		# Store.Collect() must not see the tree before its ref is relocated
+		with Staging.lock(Target, self.Logger), self.Store.Locked() if self.Store else contextlib.nullcontext():
+			if os.path.exists(Target):
+				self.Logger.error("Destination directory '%s' already exists! Please delete it if you want to continue.", os.path.basename(Target))
+				raise Exception("Destination directory already exists!")
+
+			for Stale in Staging.staleStaging(Target):
+				self.Logger.info("Removing staging directory of an interrupted run: '%s'", Stale)
+				self.Runner.Cleanup([Stale])
+
+			self.DestDir = Staging.makeStaging(Target)
+			try:
+				if self.Stream:
+					self.UnpackStream()
+				else:
+					self.Unpack()
+
+				if self.Overlay:
+					self.Logger.info("Applying patch set '%s'.", self.Overlay.PatchSet)
+					with self.Profiler.Span("overlay"):
+						self.Overlay.Apply(self.DestDir)
+
+				if self.Nested:
+					self.Logger.info("Unpacking nested archives and images.")
+					with self.Profiler.Span("nested"):
+						self.Nested.Extract(self.DestDir, self.Depth)
+
+				if self.Manifest:
+					self.Logger.info("Writing manifest.")
+					with self.Profiler.Span("manifest"):
+						if not self.Manifest.Write(self.DestDir):
+							raise Exception("Writing the manifest failed!")
+			except BaseException:
+				self.Logger.debug("Removing staging directory '%s'.", self.DestDir)
+				self.Runner.Cleanup([self.DestDir])
+				raise
+
+			self.Logger.debug("Renaming '%s' to '%s'.", self.DestDir, Target)
+			Staging.publish(self.DestDir, Target)
+			if self.Store:
+				self.Store.Relocate(self.DestDir, Target)
+			self.DestDir = Target
+			if self.LangDb:
+				with self.Profiler.Span("langdb"):
+					self.LangDb.Ingest(Target)
+			self.Source = None
+			self.Stream = None
+
+	def Unpack(self):
 		self.Logger.debug("Opening source file '%s'", self.Source)
-		self.SourceFile = open(self.Source, "r+b")
+		with open(self.Source, "rb") as SourceFile:
+			Header = SourceFile.read(2)
 
-		Header = self.SourceFile.read(2)
-		self.SourceFile.seek(0)
 		self.Logger.debug("Checking source header: '%s'", Header.decode("ascii", errors="ignore"))
-		if Header == b'DH':
-			self.Logger.debug("Patching source header to: 'PK'")
-			self.SourceFile.write(b"PK")
-			self.SourceFile.seek(0)
-		elif Header == b'PK':
+		if Header == b'PK':
 			self.Logger.debug("Source header is already 'PK' ? (Should be 'DH')")
-		else:
+		elif Header != b'DH':
 			self.Logger.error("Unknown source header! Is this really a dahua firmware upgrade image?")
 			raise Exception("Unknown source header!")
 
+		# Read through a patched header, other runs may read the same image
 		self.Logger.debug("Opening source as zipfile.")
-		self.ZipFile = zipfile.ZipFile(self.SourceFile)
+		self.ZipFile = Firmware.FirmwareZip(self.Source)
 
 		self.Logger.debug("Checking zipfile CRC.")
-		ZipTestResult = self.ZipFile.testzip()
+		with self.Profiler.Span("zip_test") as Span:
+			Span["bytes"] = sum(item.compress_size for item in self.ZipFile.filelist)
+			ZipTestResult = self.ZipFile.testzip()
 		if ZipTestResult:
 			self.Logger.error("ZipFile corrupt, first file which did not pass test: '%s'", ZipTestResult)
 			raise Exception("ZipFile corrupt!")
@@ -70,13 +162,10 @@ class DahuaExtractor():
 		for index, item in enumerate(self.ZipFile.filelist):
 			self.Logger.debug("%s: %s (%d bytes)", index, item.filename, item.file_size)
 
-		self.DestDir = os.path.basename(self.Source) + ".extracted"
-		if os.path.exists(self.DestDir):
-			self.Logger.error("Destination directory '%s' already exists! Please delete it if you want to continue.", os.path.basename(self.DestDir))
-			raise Exception("Destination directory already exists!")
-
 		self.Logger.info("Extracting %d files to: '%s'", len(self.ZipFile.filelist), self.DestDir)
-		self.ZipFile.extractall(path=self.DestDir)
+		with self.Profiler.Span("zip_extract") as Span:
+			Span["bytes"] = sum(item.file_size for item in self.ZipFile.filelist)
+			self.ZipFile.extractall(path=self.DestDir)
 		self.ExtractedFiles = self.ZipFile.namelist()
 
 		self.Logger.debug("Closing zipfile.")
@@ -88,38 +177,79 @@ class DahuaExtractor():
 			if Key not in self.DahuaFiles:
 				self.Logger.warning("Unrecognized file: '%s'.", Key)
 				continue
-
-			Value = self.DahuaFiles[Key]
-			self.Logger.info("Processing '%s'.", Key)
-
-			if Value["type"] & DAHUA_TYPE.uImage:
-				if self.Handle_uImage(Key) != 0:
-					self.Logger.error("'uImage' handler returned non-zero return value for file: '%s'", Key)
-					raise Exception("Handler returned non-zero return value!")
-				# for the next handler
-				Key += ".raw"
-
-			if Value["type"] & DAHUA_TYPE.Plain:
-				pass
-
-			if Value["type"] & DAHUA_TYPE.SquashFS:
-				if self.Handle_SquashFS(Key) != 0:
-					self.Logger.error("'SquashFS' handler returned non-zero return value for file: '%s'", Key)
-					raise Exception("Handler returned non-zero return value!")
-
-			if Value["type"] & DAHUA_TYPE.CramFS:
-				if self.Handle_CramFS(Key) != 0:
-					self.Logger.error("'CramFS' handler returned non-zero return value for file: '%s'", Key)
-					raise Exception("Handler returned non-zero return value!")
-
-		self.Logger.debug("Reverting source header patch.")
-		self.SourceFile.seek(0)
-		self.SourceFile.write(b"DH")
-
-		self.Logger.debug("Closing source file.")
-		self.SourceFile.close()
-		self.SourceFile = None
-		self.Source = None
+			self.HandleKey(Key)
+
+	################################################################################
+	###
+	### UnpackStream() - Extract the members while the image is still being read
+	###
+	### Every member is handled in the background as soon as it is complete, so
+	### splitting and extracting it overlaps with reading the next one. CRCs and
+	### the central directory are checked on the fly instead of a zip test.
+	###
+	def UnpackStream(self):
+		self.Logger.info("Extracting stream to: '%s'", self.DestDir)
+		self.ExtractedFiles = []
+		Futures = []
+		with concurrent.futures.ThreadPoolExecutor() as Executor:
+			with self.Profiler.Span("zip_stream") as Span:
+				for Info, Member in Firmware.FirmwareStream(self.Stream).Members():
+					Key = Info.filename
+					if Key in (".", "..") or os.path.basename(Key) != Key:
+						self.Logger.error("Invalid member name: '%s'", Key)
+						raise Exception("Invalid member name!")
+
+					self.Logger.debug("Extracting '%s' (%d bytes).", Key, Info.file_size)
+					with open(os.path.join(self.DestDir, Key), "wb") as fp:
+						shutil.copyfileobj(Member, fp, uImage.BLOCKSIZE)
+					Span["bytes"] += Info.file_size
+					self.ExtractedFiles.append(Key)
+
+					if Key not in self.DahuaFiles:
+						self.Logger.warning("Unrecognized file: '%s'.", Key)
+						continue
+					Futures.append(Executor.submit(self.HandleKey, Key))
+
+					# Stop early if a handler failed
+					for Future in Futures:
+						if Future.done():
+							Future.result()
+
+			for Future in Futures:
+				Future.result()
+
+	def HandleKey(self, Key):
+		Value = self.DahuaFiles[Key]
+		self.Logger.info("Processing '%s'.", Key)
+
+		if Value["type"] & DAHUA_TYPE.uImage:
+			if self.Handle_uImage(Key) != 0:
+				self.Logger.error("'uImage' handler returned non-zero return value for file: '%s'", Key)
+				raise Exception("Handler returned non-zero return value!")
+			# Children of multi-file images are handled by their content
+			if Key in self.MultiFiles:
+				return
+			# for the next handler
+			Key += ".raw"
+
+		if Value["type"] & DAHUA_TYPE.Plain:
+			pass
+
+		if Value["type"] & DAHUA_TYPE.Kernel:
+			self.Handle_Kernel(Key)
+
+		if Value["type"] & DAHUA_TYPE.Environment:
+			self.Handle_Environment(Key)
+
+		if Value["type"] & DAHUA_TYPE.SquashFS:
+			if self.Handle_SquashFS(Key) != 0:
+				self.Logger.error("'SquashFS' handler returned non-zero return value for file: '%s'", Key)
+				raise Exception("Handler returned non-zero return value!")
+
+		if Value["type"] & DAHUA_TYPE.CramFS:
+			if self.Handle_CramFS(Key) != 0:
+				self.Logger.error("'CramFS' handler returned non-zero return value for file: '%s'", Key)
+				raise Exception("Handler returned non-zero return value!")
 
 	def Handle_uImage(self, Key):
 		Path = os.path.join(self.DestDir, Key)
@@ -131,53 +261,210 @@ class DahuaExtractor():
 			self.Logger.error("Invalid uImage magic number!")
 			return 1
 
-		# Save uImage header
-		HeaderFile = open(Path + ".uImage", "wb")
-		HeaderFile.write(OrigFile.read(uImage.HEADER_SIZE))
-		HeaderFile.close()
+		if Header["imageType"] == uImage.searchTable(uImage.imageType, "multi"):
+			OrigFile.close()
+			return self.Handle_MultiFile(Key, Header)
+
+		with self.Profiler.Span("uImage", key=Key) as Span:
+			Span["bytes"] = os.path.getsize(Path)
 
-		# Save raw image
-		RawFile = open(Path + ".raw", "wb")
-		shutil.copyfileobj(OrigFile, RawFile)
-		RawFile.close()
+			# Save uImage header
+			HeaderFile = open(Path + ".uImage", "wb")
+			HeaderFile.write(OrigFile.read(uImage.HEADER_SIZE))
+			HeaderFile.close()
+
+			# Save raw image
+			RawFile = open(Path + ".raw", "wb")
+			shutil.copyfileobj(OrigFile, RawFile)
+			RawFile.close()
 
 		OrigFile.close()
 		return 0
 
+	################################################################################
+	###
+	### Handle_MultiFile(Key, Header) - Split a multi-file uImage into its images
+	###
+	### Saves the header and length table to <Key>.uImage and every image i to
+	### <Key>.<i>.raw (or <Key>.<i>.uImage + .raw if it is an uImage itself).
+	### The images are carved and extracted in parallel, depending on their content.
+	###
+	def Handle_MultiFile(self, Key, Header):
+		Path = os.path.join(self.DestDir, Key)
+		Offsets = uImage.getMultiFileOffsets(Header)
+		self.Logger.info("'%s' is a multi-file image with %d images.", Key, len(Offsets))
+
+		# Save uImage header and length table
+		with open(Path, "rb") as OrigFile, open(Path + ".uImage", "wb") as HeaderFile:
+			HeaderFile.write(OrigFile.read(Offsets[0][0] if Offsets else uImage.HEADER_SIZE + 4))
+
+		Keys = [Key + ".%d" % Index for Index in range(len(Offsets))]
+		self.MultiFiles[Key] = Keys
+
+		with concurrent.futures.ThreadPoolExecutor() as Executor:
+			Results = list(Executor.map(self.Handle_MultiFileImage, [Path] * len(Offsets), Keys, Offsets))
+
+		return 1 if any(Results) else 0
+
+	def Handle_MultiFileImage(self, Path, Key, Location):
+		Offset, Length = Location
+		ChildPath = os.path.join(self.DestDir, Key)
+
+		with open(Path, "rb") as OrigFile:
+			Header = uImage.parseHeader(OrigFile, Offset) if Length >= uImage.HEADER_SIZE else {"magic": 0}
+			with self.Profiler.Span("uImage", key=Key) as Span:
+				Span["bytes"] = Length
+				try:
+					if Header["magic"] == uImage.HEADER_MAGIC:
+						uImage.dumpToFile(OrigFile, Offset, uImage.HEADER_SIZE, ChildPath + ".uImage")
+						uImage.dumpToFile(OrigFile, Offset + uImage.HEADER_SIZE, Length - uImage.HEADER_SIZE, ChildPath + ".raw")
+					else:
+						uImage.dumpToFile(OrigFile, Offset, Length, ChildPath + ".raw")
+				except EOFError as e:
+					self.Logger.error("Image '%s' of the multi-file image is truncated: %s", Key, e)
+					return 1
+
+		with open(ChildPath + ".raw", "rb") as RawFile:
+			Magic = RawFile.read(4)
+
+		if len(Magic) == 4 and struct.unpack("<I", Magic)[0] == SquashFS.HEADER_MAGIC:
+			self.Logger.info("Processing '%s' (SquashFS).", Key)
+			Result = self.Handle_SquashFS(Key + ".raw")
+		elif len(Magic) == 4 and CramFS.HEADER_MAGIC in struct.unpack("<I", Magic) + struct.unpack(">I", Magic):
+			self.Logger.info("Processing '%s' (CramFS).", Key)
+			Result = self.Handle_CramFS(Key + ".raw")
+		else:
+			self.Logger.info("Processing '%s' (Plain).", Key)
+			Result = 0
+
+		if Result != 0:
+			self.Logger.error("Handler returned non-zero return value for image: '%s'", Key)
+		return Result
+
 	def Handle_SquashFS(self, Key):
 		Path = os.path.join(self.DestDir, Key)
-		DestDir = Path.rstrip(".raw") + ".extracted"
+		DestDir = (Path[:-len(".raw")] if Path.endswith(".raw") else Path) + ".extracted"
+
+		if self.Store:
+			Result = self.Handle_Store(Key, Path, DestDir)
+			if Result is not None:
+				return Result
 
 		Binary = "unsquashfs"
 		if self.CheckDependency(Binary):
 			return 1
 
 		# Need root to preserve permissions.
-		if self.Debug:
-			self.Logger.debug(' '.join(["sudo", Binary, "-d", DestDir, Path]))
-			Result = subprocess.call(["sudo", Binary, "-d", DestDir, Path])
-		else:
-			Result = subprocess.call(["sudo", Binary, "-d", DestDir, Path], stdout=subprocess.DEVNULL)
+		with self.Profiler.Span(Binary, key=Key) as Span:
+			Span["bytes"] = os.path.getsize(Path)
+			Result = self.Runner.Run(["sudo", Binary, "-d", DestDir, Path], Key, [DestDir])
 
 		return Result
 
 	def Handle_CramFS(self, Key):
 		Path = os.path.join(self.DestDir, Key)
-		DestDir = Path.rstrip(".raw") + ".extracted"
+		DestDir = (Path[:-len(".raw")] if Path.endswith(".raw") else Path) + ".extracted"
+
+		if self.Store:
+			Result = self.Handle_Store(Key, Path, DestDir)
+			if Result is not None:
+				return Result
 
 		Binary = "cramfsck"
 		if self.CheckDependency(Binary):
 			return 1
 
 		# Need root to preserve permissions.
-		if self.Debug:
-			self.Logger.debug(' '.join(["sudo", Binary, "-x", DestDir, Path]))
-			Result = subprocess.call(["sudo", Binary, "-x", DestDir, Path])
-		else:
-			Result = subprocess.call(["sudo", Binary, "-x", DestDir, Path], stdout=subprocess.DEVNULL)
+		with self.Profiler.Span(Binary, key=Key) as Span:
+			Span["bytes"] = os.path.getsize(Path)
+			Result = self.Runner.Run(["sudo", Binary, "-x", DestDir, Path], Key, [DestDir])
 
 		return Result
 
+	################################################################################
+	###
+	### Handle_Kernel(Key) - Save version, config, initramfs and DTBs of a kernel
+	###
+	### Written to <file>.kernel, not <file>.extracted which is always a
+	### filesystem to build.py, overlay.py and rebase.py. The kernel itself is
+	### left untouched, nothing found is not an error.
+	###
+	def Handle_Kernel(self, Key):
+		Path = os.path.join(self.DestDir, Key)
+		if not os.path.getsize(Path):
+			return
+		with self.Profiler.Span("kernel", key=Key) as Span:
+			Span["bytes"] = os.path.getsize(Path)
+			with open(Path, "rb") as fp:
+				Data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				Summary = Kernel.inspect(Data, Path + ".kernel")
+			finally:
+				Data.close()
+
+		if Summary["version"]:
+			self.Logger.info("'%s': %s", Key, Summary["version"])
+		else:
+			self.Logger.warning("No kernel found in '%s'.", Key)
+
+	################################################################################
+	###
+	### Handle_Environment(Key) - Record the U-Boot environment blocks of a boot image
+	###
+	### <file>.env.json lists where the blocks are, build.py checks that they
+	### are still there with the same size. Edit them with UBootEnv.py.
+	###
+	def Handle_Environment(self, Key):
+		Path = os.path.join(self.DestDir, Key)
+		if not os.path.getsize(Path):
+			return
+		with open(Path, "rb") as fp:
+			Data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			Blocks = UBootEnv.findBlocks(Data)
+		finally:
+			Data.close()
+
+		with open(Path + ".env.json", "w") as fp:
+			json.dump(UBootEnv.layout(Blocks), fp, indent="\t")
+		for Block in Blocks:
+			self.Logger.debug("'%s': environment at %#x, %#x bytes: %s", Key, Block["offset"], Block["size"], Block["env"])
+		self.Logger.info("'%s': %d U-Boot environment block(s).", Key, len(Blocks))
+
+	################################################################################
+	###
+	### Handle_Store(Key, Path, DestDir) - Extract a filesystem through the store
+	###
+	### A filesystem image which is already in the store (by its SHA-256) is
+	### only linked to DestDir, otherwise its files are read in place and added.
+	###
+	### Returns:      0 on success, None if the image can not be read in place
+	###
+	def Handle_Store(self, Key, Path, DestDir):
+		with self.Profiler.Span("store", key=Key) as Span:
+			Span["bytes"] = os.path.getsize(Path)
+			Digest = Store.hashFile(Path)
+			Manifest = self.Store.LoadManifest(Digest)
+			if Manifest:
+				self.Logger.debug("'%s' is already in the store.", Key)
+			else:
+				with open(Path, "rb") as fp:
+					Data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+				try:
+					Part = Firmware.openPartition(Data)
+					if not Part["fs"]:
+						self.Logger.warning("'%s' can not be read in place, extracting it without the store.", Key)
+						return None
+					try:
+						Manifest = self.Store.Ingest(Digest, Part["fs"], Part["fstype"])
+					finally:
+						Part["fs"].close()
+				finally:
+					Data.close()
+
+			self.Store.Materialize(Manifest, DestDir)
+		return 0
+
 if __name__ == "__main__":
 	logging.basicConfig(format="%(levelname)s\t%(message)s")
 	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
@@ -189,7 +476,17 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description="Extract Dahua firmware images.")
 	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
 	parser.add_argument("-c", "--config", default="auto", help="Configuration to use. (Default: auto)")
-	parser.add_argument("source", help="Source File")
+	parser.add_argument("-p", "--profile", metavar="FILE", help="Write per-stage timing report (JSON/Chrome trace) to FILE")
+	parser.add_argument("-s", "--store", metavar="DIR", help="Deduplicate extracted filesystems through the object store in DIR")
+	parser.add_argument("-l", "--link", choices=Store.LINK_MODES, default="auto", help="How files are taken from the store. (Default: auto, reflink if supported, else hardlink)")
+	parser.add_argument("--overlay", metavar="DIR", help="Apply the patch set in DIR after extracting")
+	parser.add_argument("-m", "--manifest", action="store_true", help="Write SHA-256 manifests of the extracted files (manifest.sha256, manifest/<file>.sha256)")
+	parser.add_argument("-r", "--recursive", metavar="DEPTH", type=int, nargs="?", const=nested.DEFAULT_DEPTH, help="Also unpack archives and images found in the partitions to <file>.nested, DEPTH levels deep (Default: %d)" % nested.DEFAULT_DEPTH)
+	parser.add_argument("--lang-db", metavar="FILE", help="Record the language files of the web partitions in the database FILE (see langdb.py)")
+	parser.add_argument("-j", "--jobs", type=int, help="Number of external tools running at once. (Default: number of CPUs)")
+	parser.add_argument("-t", "--timeout", metavar="[TOOL=]SECONDS", action="append", help="Kill a tool (or all tools) running longer than this, may be repeated")
+	parser.add_argument("-o", "--output", metavar="DIR", help="Destination directory. (Default: <source>.extracted in the current directory)")
+	parser.add_argument("source", help="Source File, - reads it from stdin (while it is being downloaded)")
 	args = parser.parse_args()
 
 	Logger = logging.getLogger("main")
@@ -198,13 +495,17 @@ if __name__ == "__main__":
 	else:
 		Logger.setLevel(logging.INFO)
 
-	if not os.path.isfile(args.source):
+	if args.source == "-":
+		if not args.output:
+			Logger.error("Reading from stdin needs -o")
+			sys.exit(1)
+	elif not os.path.isfile(args.source):
 		Logger.error("No such file: '%s'", args.source)
 		sys.exit(1)
 
 	Found = None
 	if args.config == "auto":
-		Name = os.path.basename(os.path.abspath(args.source)).lower()
+		Name = os.path.basename(os.path.abspath(args.output if args.source == "-" else args.source)).lower()
 		for Config in DAHUA_CONFIGS:
 			if Config.lower() in Name:
 				Logger.warn("Autodetected config: %s", Config)
@@ -232,7 +533,43 @@ if __name__ == "__main__":
 
 	Config = importlib.import_module("configs." + Found)
 
-	extractor = DahuaExtractor(Config, args.verbose)
+	store = None
+	if args.store:
+		# Need root to preserve permissions.
+		if os.geteuid() != 0:
+			Logger.error("Extracting through the store needs root to preserve permissions, please run with sudo.")
+			sys.exit(1)
+		store = Store.Store(args.store, args.link)
+
+	patchSet = None
+	if args.overlay:
+		# Need root to change the files of the extracted filesystems.
+		if os.geteuid() != 0:
+			Logger.error("Applying a patch set needs root to change the extracted files, please run with sudo.")
+			sys.exit(1)
+		patchSet = overlay.DahuaOverlay(args.verbose)
+		patchSet.Load(args.overlay)
+
+	langDb = None
+	if args.lang_db:
+		langDb = langdb.DahuaLangDb(args.lang_db, args.verbose)
+
+	# Need root to read all files.
+	if args.manifest and os.geteuid() != 0:
+		Logger.error("Writing manifests needs root to read every extracted file, please run with sudo.")
+		sys.exit(1)
+
+	runner = Runner.Runner(args.verbose, args.jobs, Runner.parseTimeouts(args.timeout))
+	manifest = Manifest.Manifest(jobs=args.jobs, debug=args.verbose) if args.manifest else None
+	unpacker = nested.DahuaNested(args.verbose, runner, args.jobs) if args.recursive else None
+	extractor = DahuaExtractor(Config, args.verbose, runner=runner, store=store, overlay=patchSet, langDb=langDb,
+							   manifest=manifest, nested=unpacker, depth=args.recursive)
 	if extractor.CheckDependencies():
 		sys.exit(1)
-	extractor.Extract(args.source)
+	try:
+		extractor.Extract(args.source, args.output)
+	finally:
+		if args.profile:
+			extractor.Profiler.Dump(Logger)
+			extractor.Profiler.Write(args.profile)
+			Logger.info("Wrote profile to: '%s'", args.profile)
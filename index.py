@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import logging
+import concurrent.futures
+import ELF
+import Firmware
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS firmware (
+	id INTEGER PRIMARY KEY,
+	name TEXT NOT NULL,
+	path TEXT NOT NULL,
+	fingerprint TEXT NOT NULL UNIQUE,
+	time INTEGER,
+	indexed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS partition (
+	id INTEGER PRIMARY KEY,
+	name TEXT NOT NULL,
+	crc INTEGER NOT NULL,
+	size INTEGER NOT NULL,
+	sha256 TEXT NOT NULL,
+	fstype TEXT,
+	image_name TEXT,
+	image_time INTEGER,
+	UNIQUE (name, crc, size)
+);
+CREATE TABLE IF NOT EXISTS firmware_partition (
+	firmware_id INTEGER NOT NULL REFERENCES firmware(id) ON DELETE CASCADE,
+	partition_id INTEGER NOT NULL REFERENCES partition(id),
+	PRIMARY KEY (firmware_id, partition_id)
+);
+CREATE TABLE IF NOT EXISTS file (
+	id INTEGER PRIMARY KEY,
+	partition_id INTEGER NOT NULL REFERENCES partition(id) ON DELETE CASCADE,
+	path TEXT NOT NULL,
+	name TEXT NOT NULL,
+	type TEXT NOT NULL,
+	mode INTEGER NOT NULL,
+	uid INTEGER NOT NULL,
+	gid INTEGER NOT NULL,
+	size INTEGER,
+	sha256 TEXT,
+	target TEXT,
+	elf_class INTEGER,
+	elf_machine TEXT,
+	elf_type TEXT,
+	elf_interp TEXT,
+	elf_soname TEXT,
+	elf_needed TEXT,
+	elf_stripped INTEGER
+);
+CREATE INDEX IF NOT EXISTS file_sha256 ON file (sha256);
+CREATE INDEX IF NOT EXISTS file_path ON file (path);
+CREATE INDEX IF NOT EXISTS file_name ON file (name);
+CREATE INDEX IF NOT EXISTS file_partition ON file (partition_id);
+CREATE INDEX IF NOT EXISTS file_soname ON file (elf_soname);
+CREATE INDEX IF NOT EXISTS partition_sha256 ON partition (sha256);
+CREATE INDEX IF NOT EXISTS firmware_partition_partition ON firmware_partition (partition_id);
+"""
+
+FILE_COLUMNS = ["path", "name", "type", "mode", "uid", "gid", "size", "sha256", "target", "elf_class",
+				"elf_machine", "elf_type", "elf_interp", "elf_soname", "elf_needed", "elf_stripped"]
+
+################################################################################
+###
+### IndexMember(source, name) - Hash one firmware member and every file in it
+###
+### Runs in a worker process: the member is decompressed to a memory mapped
+### temporary file and its filesystem (if any) is read in place.
+###
+### Returns:      (partition dictionary, list of file rows)
+###
+def IndexMember(source, name):
+	ZipFile = Firmware.FirmwareZip(source)
+	try:
+		Info = ZipFile.getinfo(name)
+		Data = Firmware.mapMember(ZipFile, Info)
+	finally:
+		ZipFile.close()
+
+	Part = Firmware.openPartition(Data)
+	Partition = {
+		"name": name, "crc": Info.CRC, "size": Info.file_size,
+		"sha256": hashlib.sha256(Data).hexdigest(), "fstype": Part["fstype"],
+		"image_name": None, "image_time": None
+	}
+	if Part["uImage"]:
+		Partition["image_name"] = Part["uImage"]["name"].rstrip(b"\0").decode("utf-8", errors="replace")
+		Partition["image_time"] = Part["uImage"]["time"]
+
+	Files = []
+	try:
+		if Part["fs"]:
+			for Path, Inode in Part["fs"].walk():
+				Files.append(IndexInode(Part["fs"], Path, Inode))
+	finally:
+		if Part["fs"]:
+			Part["fs"].close()
+		if Data:
+			Data.close()
+	return Partition, Files
+
+def IndexInode(fs, path, inode):
+	Row = {
+		"path": path, "name": os.path.basename(path), "type": inode["type"], "mode": inode["mode"],
+		"uid": inode["uid"], "gid": inode["gid"], "size": None, "sha256": None, "target": inode.get("target")
+	}
+	if inode["type"] == "f":
+		Row["size"] = inode["file_size"]
+		Digest = hashlib.sha256()
+		Blocks = fs.readFile(inode)
+		First = next(Blocks, b"")
+		if First.startswith(ELF.HEADER_MAGIC):
+			### Section and program headers may be anywhere, keep the whole file
+			Content = First + b"".join(Blocks)
+			Digest.update(Content)
+			Info = ELF.parseInfo(Content)
+			if Info:
+				Row.update({
+					"elf_class": Info["class"], "elf_machine": Info["machine"], "elf_type": Info["type"],
+					"elf_interp": Info["interp"], "elf_soname": Info["soname"],
+					"elf_needed": " ".join(Info["needed"]), "elf_stripped": int(Info["stripped"])
+				})
+		else:
+			Digest.update(First)
+			for Block in Blocks:
+				Digest.update(Block)
+		Row["sha256"] = Digest.hexdigest()
+	return tuple(Row.get(Column) for Column in FILE_COLUMNS)
+
+class DahuaIndexer():
+	def __init__(self, database, debug, jobs=None):
+		self.Debug = debug
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+		self.Jobs = jobs
+		self.Database = sqlite3.connect(database)
+		self.Database.execute("PRAGMA foreign_keys = ON")
+		self.Database.execute("PRAGMA journal_mode = WAL")
+		self.Database.executescript(SCHEMA)
+
+	def close(self):
+		self.Database.close()
+
+	def Fingerprint(self, zipFile):
+		### Identifies a firmware by the name, CRC and size of its members
+		Digest = hashlib.sha256()
+		for Info in sorted(zipFile.infolist(), key=lambda Info: Info.filename):
+			Digest.update(("%s:%08x:%d\n" % (Info.filename, Info.CRC, Info.file_size)).encode("utf-8"))
+		return Digest.hexdigest()
+
+	def FindPartition(self, info):
+		Row = self.Database.execute("SELECT id FROM partition WHERE name = ? AND crc = ? AND size = ?",
+			(info.filename, info.CRC, info.file_size)).fetchone()
+		return Row[0] if Row else None
+
+	################################################################################
+	###
+	### Index(sources) - Add firmware images to the database
+	###
+	### Firmwares whose members all match an indexed firmware are skipped,
+	### members already indexed for another firmware (same name, ZIP CRC and
+	### size) are linked instead of being read again.
+	###
+	def Index(self, sources):
+		Start = time.perf_counter()
+		Pending = []
+		Firmwares = {}
+		for Source in sources:
+			Source = os.path.abspath(Source)
+			try:
+				ZipFile = Firmware.FirmwareZip(Source)
+			except Exception as e:
+				self.Logger.error("'%s': %s", Source, e)
+				continue
+
+			try:
+				Fingerprint = self.Fingerprint(ZipFile)
+				Row = self.Database.execute("SELECT id, path FROM firmware WHERE fingerprint = ?", (Fingerprint,)).fetchone()
+				if Row:
+					self.Logger.debug("'%s' is already indexed as '%s'.", Source, Row[1])
+					continue
+
+				Infos = ZipFile.infolist()
+				Time = max((int(time.mktime(Info.date_time + (0, 0, -1))) for Info in Infos), default=None)
+				with self.Database:
+					Cursor = self.Database.execute("INSERT INTO firmware (name, path, fingerprint, time, indexed) VALUES (?, ?, ?, ?, ?)",
+						(os.path.basename(Source), Source, Fingerprint, Time, int(time.time())))
+				FirmwareId = Cursor.lastrowid
+				Firmwares[FirmwareId] = Source
+
+				for Info in Infos:
+					PartitionId = self.FindPartition(Info)
+					if PartitionId:
+						self.Link(FirmwareId, PartitionId)
+					else:
+						Pending.append((FirmwareId, Source, Info))
+			finally:
+				ZipFile.close()
+
+		Files = 0
+		### Firmwares with members not indexed yet, dropped again unless all of them succeed
+		Incomplete = set(FirmwareId for FirmwareId, Source, Info in Pending)
+		Failed = set()
+		try:
+			with concurrent.futures.ProcessPoolExecutor(self.Jobs) as Executor:
+				Futures = {}
+				for FirmwareId, Source, Info in Pending:
+					### Identical members in new firmwares are only read once
+					Key = (Info.filename, Info.CRC, Info.file_size)
+					if Key in Futures:
+						Futures[Key][1].append(FirmwareId)
+						continue
+					Futures[Key] = (Executor.submit(IndexMember, Source, Info.filename), [FirmwareId], Source)
+
+				for Key, (Future, FirmwareIds, Source) in Futures.items():
+					try:
+						Partition, Rows = Future.result()
+					except Exception as e:
+						self.Logger.error("'%s' in '%s': %s", Key[0], Source, e)
+						Failed.update(FirmwareIds)
+						continue
+					PartitionId = self.AddPartition(Partition, Rows)
+					for FirmwareId in FirmwareIds:
+						self.Link(FirmwareId, PartitionId)
+					Files += len(Rows)
+					self.Logger.debug("Indexed '%s' (%d files).", Key[0], len(Rows))
+			Incomplete = Failed
+		finally:
+			for FirmwareId in Incomplete:
+				self.Logger.error("'%s' was not indexed completely, it is indexed again on the next run.", Firmwares.pop(FirmwareId))
+				with self.Database:
+					self.Database.execute("DELETE FROM firmware WHERE id = ?", (FirmwareId,))
+
+		for FirmwareId, Source in Firmwares.items():
+			self.Logger.info("Indexed '%s'.", Source)
+
+		self.Logger.info("Indexed %d firmware(s), %d partition(s), %d file(s) in %.2fs.",
+			len(Firmwares), len(Futures), Files, time.perf_counter() - Start)
+		return len(Firmwares)
+
+	def AddPartition(self, partition, rows):
+		with self.Database:
+			Cursor = self.Database.execute("INSERT INTO partition (%s) VALUES (%s)" % (", ".join(partition), ", ".join("?" * len(partition))),
+				tuple(partition.values()))
+			PartitionId = Cursor.lastrowid
+			self.Database.executemany("INSERT INTO file (partition_id, %s) VALUES (?, %s)" % (", ".join(FILE_COLUMNS), ", ".join("?" * len(FILE_COLUMNS))),
+				((PartitionId,) + Row for Row in rows))
+		return PartitionId
+
+	def Link(self, firmwareId, partitionId):
+		with self.Database:
+			self.Database.execute("INSERT OR IGNORE INTO firmware_partition (firmware_id, partition_id) VALUES (?, ?)", (firmwareId, partitionId))
+
+	################################################################################
+	###
+	### Query functions - Return rows of (firmware, partition, path, sha256, ...)
+	###
+	QUERY = """SELECT firmware.name, partition.name, file.path, file.sha256, file.size, file.mode, file.elf_machine
+		FROM file
+		JOIN partition ON partition.id = file.partition_id
+		JOIN firmware_partition ON firmware_partition.partition_id = partition.id
+		JOIN firmware ON firmware.id = firmware_partition.firmware_id
+		WHERE %s
+		ORDER BY firmware.time, firmware.name, partition.name, file.path"""
+
+	def FindHash(self, sha256):
+		return self.Database.execute(self.QUERY % "file.sha256 = ?", (sha256.lower(),)).fetchall()
+
+	def FindPath(self, pattern):
+		### Glob on the full path if it contains a slash, otherwise on the name
+		Column = "file.path" if "/" in pattern else "file.name"
+		Operator = "GLOB" if any(c in pattern for c in "*?[") else "="
+		return self.Database.execute(self.QUERY % ("%s %s ?" % (Column, Operator)), (pattern,)).fetchall()
+
+	def FindNeeded(self, library):
+		return self.Database.execute(self.QUERY % "(' ' || file.elf_needed || ' ') LIKE ?", ("% " + library + " %",)).fetchall()
+
+	def History(self, path):
+		### One row per firmware, with changes of the file marked
+		Rows = []
+		Previous = {}
+		for Row in self.FindPath(path):
+			Key = (Row[1], Row[2])
+			Rows.append(Row + ("=" if Key in Previous and Previous[Key] == Row[3] else "*",))
+			Previous[Key] = Row[3]
+		return Rows
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+	logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+	logging.addLevelName(logging.WARNING, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+	logging.addLevelName(logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+	logging.addLevelName(logging.CRITICAL, "\033[5m\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.CRITICAL))
+
+	parser = argparse.ArgumentParser(description="Index the files of Dahua firmware images into a SQLite database and query it.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-d", "--database", default="firmware.sqlite", help="Database file. (Default: firmware.sqlite)")
+	parser.add_argument("-j", "--jobs", type=int, help="Number of worker processes. (Default: number of CPUs)")
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument("--hash", help="List files with this SHA-256")
+	group.add_argument("--path", help="List files with this name or path (glob patterns allowed)")
+	group.add_argument("--needed", help="List ELF files linked against this library")
+	group.add_argument("--history", help="Show how a path changed across the indexed firmwares")
+	parser.add_argument("sources", nargs="*", help="Firmware images to index")
+	args = parser.parse_args()
+
+	Logger = logging.getLogger("main")
+	if args.verbose:
+		Logger.setLevel(logging.DEBUG)
+	else:
+		Logger.setLevel(logging.INFO)
+
+	indexer = DahuaIndexer(args.database, args.verbose, args.jobs)
+	try:
+		if args.sources:
+			for Source in args.sources:
+				if not os.path.isfile(Source):
+					Logger.error("No such file: '%s'", Source)
+					sys.exit(1)
+			indexer.Index(args.sources)
+
+		Rows = None
+		if args.hash:
+			Rows = indexer.FindHash(args.hash)
+		elif args.path:
+			Rows = indexer.FindPath(args.path)
+		elif args.needed:
+			Rows = indexer.FindNeeded(args.needed)
+		elif args.history:
+			Rows = indexer.History(args.history)
+
+		if Rows is not None:
+			for Row in Rows:
+				print("\t".join("" if Value is None else str(Value) for Value in Row))
+			if not Rows:
+				sys.exit(1)
+	finally:
+		indexer.close()
@@ -1,70 +1,186 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
+import argparse
 import json
 import sys
+import os
 import os.path
+import concurrent.futures
 from collections import OrderedDict
+import Staging
 
 VERBOSE = True
 
 def eprint(*args, **kwargs):
     print(*args, file = sys.stderr, **kwargs)
 
-if __name__ == "__main__":
-	if len(sys.argv) != 4:
-		eprint("Usage: {0} <reference> <input> <output>".format(sys.argv[0]))
-		exit(1)
+def loadLang(path):
+	FP = open(path, "rb")
+	TXT = FP.read().decode("utf-8-sig")
+	FP.close()
+	return json.loads(TXT, object_pairs_hook = OrderedDict, strict = False)
 
-	REFERENCE = sys.argv[1]
-	INPUT = sys.argv[2]
-	OUTPUT = sys.argv[3]
+def dumpLang(lang):
+	TXT = json.dumps(lang, ensure_ascii = False, separators=(",\n", ":"))
+	TXT = TXT.replace("{", "{\n", 1)
+	TXT = "\n}".join(TXT.rsplit("}", 1))
+	return TXT.encode("utf-8-sig")
 
-	RefFP = open(REFERENCE, "rb")
-	RefTXT = RefFP.read().decode("utf-8-sig")
-	RefFP.close()
-	Ref = json.loads(RefTXT, object_pairs_hook = OrderedDict, strict = False)
+################################################################################
+###
+### mergeLang(ref, lang) - Make a language file match the keys of a reference
+###
+### Keys of lang which are not in ref are dropped, keys missing from lang are
+### taken from ref and appended at the end.
+###
+### Returns:      (merged OrderedDict, list of not found keys, list of
+###               excessive keys)
+###
+def mergeLang(ref, lang):
+	Out = OrderedDict()
+	NotFound = []
 
-	InFP = open(INPUT, "rb")
-	InTXT = InFP.read().decode("utf-8-sig")
-	InFP.close()
-	In = json.loads(InTXT, object_pairs_hook = OrderedDict, strict = False)
+	for k, v in ref.items():
+		if k in lang:
+			Out[k] = lang[k]
 
-	Out = OrderedDict()
+	for k, v in ref.items():
+		if not k in lang:
+			NotFound.append(k)
+			Out[k] = v
 
-	NotFound = 0
-	Excessive = 0
+	Excessive = [k for k in lang if not k in ref]
+	return Out, NotFound, Excessive
 
-	for k, v in Ref.items():
-		if k in In and not k in Out:
-			Out[k] = In[k]
+### The reference of a batch, parsed once per worker process
+Reference = None
 
-	for k, v in Ref.items():
-		if not k in In:
-			if VERBOSE:
-				eprint("[NOT FOUND] \"{0}\"".format(k))
-			NotFound += 1
-			Out[k] = v
+def initWorker(ref):
+	global Reference
+	Reference = ref
+
+def mergeFile(path, output):
+	### Runs in a worker process, returns the report entry of one language
+	### Unreadable inputs and outputs which can not be replaced (files of root
+	### in an extracted firmware) are reported like parse errors
+	try:
+		In = loadLang(path)
+		Out, NotFound, Excessive = mergeLang(Reference, In)
+		Data = dumpLang(Out)
+		with open(path, "rb") as fp:
+			Changed = output != path or fp.read() != Data
+		if Changed:
+			Staging.replaceFile(output, Data)
+	except (OSError, ValueError, UnicodeDecodeError) as e:
+		return path, {"error": str(e)}
+	return path, {"output": output, "items": len(In), "found": len(Out) - len(NotFound),
+				  "not_found": NotFound, "excessive": Excessive, "changed": Changed}
+
+################################################################################
+###
+### mergeBatch(reference, inputs, outputDir, jobs) - Merge many language files
+###                                                  against one reference
+###
+### Parameters:   inputs:     language files or directories of them, the
+###                           reference itself is skipped
+###               outputDir:  where the merged files go (Default: replace the
+###                           inputs)
+###
+### Returns:      report, input path -> "output", "items", "found", "not_found"
+###               and "excessive" keys, "changed", or "error"
+###
+def mergeBatch(reference, inputs, outputDir = None, jobs = None):
+	for Path in [reference] + list(inputs):
+		if not os.path.exists(Path):
+			raise FileNotFoundError("'{0}' does not exist".format(Path))
+	Ref = loadLang(reference)
+	Paths = []
+	for Input in inputs:
+		if os.path.isdir(Input):
+			Paths.extend(os.path.join(Input, Name) for Name in sorted(os.listdir(Input))
+						 if os.path.isfile(os.path.join(Input, Name)) and not Name.startswith("."))
+		else:
+			Paths.append(Input)
+	Unique = OrderedDict()
+	for Path in Paths:
+		if not os.path.samefile(Path, reference):
+			Unique.setdefault(os.path.abspath(Path), Path)
+	Paths = list(Unique.values())
+
+	### Outputs keep their path below the directory common to all inputs, so
+	### same-named languages of different directories do not overwrite each other
+	Outputs = Paths
+	if outputDir and Paths:
+		Root = os.path.commonpath([os.path.dirname(Path) for Path in Unique])
+		Outputs = [os.path.join(outputDir, os.path.relpath(Path, Root)) for Path in Unique]
+		for Dir in sorted(set(os.path.dirname(Output) for Output in Outputs)):
+			os.makedirs(Dir, exist_ok = True)
 
-	for k, v in In.items():
-		if not k in Ref:
-			if VERBOSE:
-				eprint("[EXCESSIVE] \"{0}\"".format(k))
-			Excessive += 1
+	Report = OrderedDict()
+	with concurrent.futures.ProcessPoolExecutor(jobs, initializer = initWorker, initargs = (Ref,)) as Executor:
+		for Path, Entry in Executor.map(mergeFile, Paths, Outputs):
+			Report[Path] = Entry
+	return Ref, Report
 
-	OutTXT = json.dumps(Out, ensure_ascii = False, separators=(",\n", ":"))
-	OutTXT = OutTXT.replace("{", "{\n", 1)
-	OutTXT = "\n}".join(OutTXT.rsplit("}", 1))
+def mergeSingle(reference, input, output):
+	Ref = loadLang(reference)
+	In = loadLang(input)
+	Out, NotFound, Excessive = mergeLang(Ref, In)
 
-	OutFP = open(OUTPUT, "wb")
-	OutFP.write(OutTXT.encode("utf-8-sig"))
-	OutFP.close()
+	if VERBOSE:
+		for k in NotFound:
+			eprint("[NOT FOUND] \"{0}\"".format(k))
+		for k in Excessive:
+			eprint("[EXCESSIVE] \"{0}\"".format(k))
+
+	Staging.replaceFile(output, dumpLang(Out))
 
 	eprint("--- Statistics ---")
-	eprint("Reference: {0}".format(os.path.basename(REFERENCE)))
+	eprint("Reference: {0}".format(os.path.basename(reference)))
 	eprint("Reference items: {0}".format(len(Ref)))
-	eprint("Input: {0}".format(os.path.basename(INPUT)))
+	eprint("Input: {0}".format(os.path.basename(input)))
 	eprint("Input items: {0}".format(len(In)))
 	eprint("Output items: {0}".format(len(Out)))
-	eprint("Found: {0}".format(len(Out) - NotFound))
-	eprint("Not found: {0}".format(NotFound))
-	eprint("Excessive: {0}".format(Excessive))
+	eprint("Found: {0}".format(len(Out) - len(NotFound)))
+	eprint("Not found: {0}".format(len(NotFound)))
+	eprint("Excessive: {0}".format(len(Excessive)))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Make Dahua language files match the keys of a reference language file.",
+									 usage = "%(prog)s <reference> <input> <output>\n       %(prog)s -b [-o DIR] [-r FILE] [-j N] <reference> <input|dir> ...")
+	parser.add_argument("-b", "--batch", action = "store_true", help = "Merge every input (files or directories of them) in place or into -o DIR")
+	parser.add_argument("-o", "--output-dir", metavar = "DIR", help = "Batch: write the merged files to DIR instead of replacing the inputs")
+	parser.add_argument("-r", "--report", metavar = "FILE", help = "Batch: write the NOT FOUND/EXCESSIVE keys of every language to FILE (JSON, - for stdout)")
+	parser.add_argument("-j", "--jobs", type = int, help = "Batch: number of worker processes. (Default: number of CPUs)")
+	parser.add_argument("reference")
+	parser.add_argument("files", nargs = "+", metavar = "input")
+	args = parser.parse_args()
+
+	if not args.batch:
+		if len(args.files) != 2:
+			eprint("Usage: {0} <reference> <input> <output>".format(sys.argv[0]))
+			exit(1)
+		mergeSingle(args.reference, args.files[0], args.files[1])
+		exit(0)
+
+	try:
+		Ref, Report = mergeBatch(args.reference, args.files, args.output_dir, args.jobs)
+	except FileNotFoundError as e:
+		eprint(e)
+		exit(1)
+	if args.report == "-":
+		print(json.dumps(Report, ensure_ascii = False, indent = "\t"))
+	elif args.report:
+		Staging.replaceFile(args.report, json.dumps(Report, ensure_ascii = False, indent = "\t").encode("utf-8"))
+
+	Errors = 0
+	eprint("--- Statistics ---")
+	eprint("Reference: {0} ({1} items)".format(os.path.basename(args.reference), len(Ref)))
+	for Path, Entry in Report.items():
+		if "error" in Entry:
+			eprint("{0}: {1}".format(Path, Entry["error"]))
+			Errors += 1
+			continue
+		eprint("{0}: {1} items, found {2}, not found {3}, excessive {4}{5}".format(Path, Entry["items"],
+			Entry["found"], len(Entry["not_found"]), len(Entry["excessive"]), "" if Entry["changed"] else ", unchanged"))
+	exit(1 if Errors else 0)
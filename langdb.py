@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import time
+import struct
+import sqlite3
+import hashlib
+import logging
+import uImage
+import Firmware
+import lang
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS version (
+	id INTEGER PRIMARY KEY,
+	name TEXT NOT NULL UNIQUE,
+	path TEXT NOT NULL,
+	time INTEGER,
+	ingested INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS language (
+	id INTEGER PRIMARY KEY,
+	name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS langfile (
+	id INTEGER PRIMARY KEY,
+	sha256 TEXT NOT NULL UNIQUE,
+	items INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS version_language (
+	version_id INTEGER NOT NULL REFERENCES version(id) ON DELETE CASCADE,
+	language_id INTEGER NOT NULL REFERENCES language(id),
+	langfile_id INTEGER NOT NULL REFERENCES langfile(id),
+	dir TEXT NOT NULL,
+	path TEXT NOT NULL,
+	PRIMARY KEY (version_id, dir, language_id)
+);
+CREATE TABLE IF NOT EXISTS langkey (
+	id INTEGER PRIMARY KEY,
+	name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS entry (
+	langfile_id INTEGER NOT NULL REFERENCES langfile(id) ON DELETE CASCADE,
+	key_id INTEGER NOT NULL REFERENCES langkey(id),
+	value TEXT NOT NULL,
+	PRIMARY KEY (langfile_id, key_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entry_key ON entry (key_id);
+CREATE INDEX IF NOT EXISTS version_language_langfile ON version_language (langfile_id);
+"""
+
+### Language files are the *.txt JSON files in a "lang" directory of a web partition
+LANG_DIR = "lang"
+LANG_SUFFIX = ".txt"
+
+################################################################################
+###
+### findLangFiles(tree) - Find the language files of an extracted web partition
+###
+### Returns:      list of (language name, path)
+###
+def findLangFiles(tree):
+	Files = []
+	for Root, Dirs, Names in os.walk(tree):
+		Dirs.sort()
+		if os.path.basename(Root).lower() != LANG_DIR:
+			continue
+		for Name in sorted(Names):
+			Path = os.path.join(Root, Name)
+			if Name.lower().endswith(LANG_SUFFIX) and os.path.isfile(Path) and not os.path.islink(Path):
+				Files.append((Name[:-len(LANG_SUFFIX)], Path))
+	return Files
+
+class DahuaLangDb():
+	def __init__(self, database, debug):
+		self.Debug = debug
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+		self.Database = sqlite3.connect(database)
+		self.Database.execute("PRAGMA foreign_keys = ON")
+		self.Database.execute("PRAGMA journal_mode = WAL")
+		self.Database.executescript(SCHEMA)
+
+	def close(self):
+		self.Database.close()
+
+	################################################################################
+	###
+	### Ingest(source, name) - Add the language files of an extracted firmware
+	###
+	### Parameters:   source:  <firmware.bin>.extracted
+	###               name:    version name (Default: source without .extracted)
+	###
+	### Language files are stored once by their SHA-256, a new release only adds
+	### the files which changed and links the others. Ingesting a version again
+	### replaces what was recorded for it.
+	###
+	### Returns:      number of language files which were new to the database
+	###
+	def Ingest(self, source, name=None):
+		Start = time.perf_counter()
+		Source = os.path.abspath(source)
+		Name = name if name else os.path.basename(Source).rsplit(".extracted", 1)[0]
+
+		Files = []
+		Time = None
+		for Entry in sorted(os.listdir(Source)):
+			if not Entry.endswith(".extracted") or not Firmware.isWebKey(Entry):
+				continue
+			Key = Entry[:-len(".extracted")]
+			Time = Time or self.ImageTime(os.path.join(Source, Key + ".uImage"))
+			Files.extend(findLangFiles(os.path.join(Source, Entry)))
+		if not Files:
+			self.Logger.warning("'%s': no language files found.", Source)
+			return 0
+
+		New = 0
+		Linked = 0
+		with self.Database:
+			self.Database.execute("DELETE FROM version WHERE name = ?", (Name,))
+			VersionId = self.Database.execute("INSERT INTO version (name, path, time, ingested) VALUES (?, ?, ?, ?)",
+				(Name, Source, Time, int(time.time()))).lastrowid
+			for Language, Path in Files:
+				with open(Path, "rb") as fp:
+					Data = fp.read()
+				Digest = hashlib.sha256(Data).hexdigest()
+				Row = self.Database.execute("SELECT id FROM langfile WHERE sha256 = ?", (Digest,)).fetchone()
+				if Row:
+					LangFileId = Row[0]
+				else:
+					try:
+						Entries = lang.loadLang(Path)
+					except (ValueError, UnicodeDecodeError) as e:
+						self.Logger.warning("'%s': %s", Path, e)
+						continue
+					if not isinstance(Entries, dict):
+						continue
+					LangFileId = self.AddLangFile(Digest, Entries)
+					New += 1
+				LanguageId = self.Id("language", Language)
+				### Every lang directory (of each web partition) has its own files
+				self.Database.execute("INSERT OR REPLACE INTO version_language (version_id, language_id, langfile_id, dir, path) VALUES (?, ?, ?, ?, ?)",
+					(VersionId, LanguageId, LangFileId, os.path.relpath(os.path.dirname(Path), Source), os.path.relpath(Path, Source)))
+				Linked += 1
+			self.Database.execute("DELETE FROM langfile WHERE id NOT IN (SELECT langfile_id FROM version_language)")
+
+		self.Logger.info("Ingested '%s': %d language file(s), %d new, in %.2fs.", Name, Linked, New, time.perf_counter() - Start)
+		return New
+
+	def ImageTime(self, path):
+		try:
+			with open(path, "rb") as fp:
+				return uImage.parseHeader(fp)["time"]
+		except (OSError, struct.error):
+			return None
+
+	def AddLangFile(self, digest, entries):
+		LangFileId = self.Database.execute("INSERT INTO langfile (sha256, items) VALUES (?, ?)", (digest, len(entries))).lastrowid
+		self.Database.executemany("INSERT OR IGNORE INTO langkey (name) VALUES (?)", ((Key,) for Key in entries))
+		self.Database.executemany("INSERT OR REPLACE INTO entry (langfile_id, key_id, value) SELECT ?, id, ? FROM langkey WHERE name = ?",
+			((LangFileId, str(Value), Key) for Key, Value in entries.items()))
+		return LangFileId
+
+	def Id(self, table, name):
+		self.Database.execute("INSERT OR IGNORE INTO %s (name) VALUES (?)" % table, (name,))
+		return self.Database.execute("SELECT id FROM %s WHERE name = ?" % table, (name,)).fetchone()[0]
+
+	def VersionId(self, name):
+		### None picks the latest version
+		if name is None:
+			Row = self.Database.execute("SELECT id FROM version ORDER BY time IS NULL, time DESC, id DESC LIMIT 1").fetchone()
+		else:
+			Row = self.Database.execute("SELECT id FROM version WHERE name = ?", (name,)).fetchone()
+		if not Row:
+			raise KeyError("Version '%s' is not in the database" % name if name else "The database is empty")
+		return Row[0]
+
+	################################################################################
+	###
+	### Query functions - Return rows of (key, value, ...)
+	###
+	### lang limits added/removed to one language, otherwise a key counts if
+	### any language of the version has it.
+	###
+	KEYS = """SELECT DISTINCT langkey.id FROM version_language
+		JOIN entry ON entry.langfile_id = version_language.langfile_id
+		JOIN langkey ON langkey.id = entry.key_id
+		JOIN language ON language.id = version_language.language_id
+		WHERE version_language.version_id = ? AND (? IS NULL OR language.name = ?)"""
+
+	def Added(self, since, version=None, language=None):
+		### Keys in version (Default: latest) which since did not have
+		return self.Difference(self.VersionId(version), self.VersionId(since), language)
+
+	def Removed(self, since, version=None, language=None):
+		### Keys since had which are gone in version (Default: latest)
+		return self.Difference(self.VersionId(since), self.VersionId(version), language)
+
+	def Difference(self, versionId, otherId, language):
+		return self.Database.execute("""SELECT langkey.name FROM langkey
+			WHERE id IN (%s) AND id NOT IN (%s) ORDER BY langkey.name""" % (self.KEYS, self.KEYS),
+			(versionId, language, language, otherId, language, language)).fetchall()
+
+	def Untranslated(self, language, reference="English", version=None):
+		### Keys of reference which language is missing or has the same (untranslated) value for,
+		### per lang directory
+		Version = self.VersionId(version)
+		return self.Database.execute("""SELECT langkey.name, ref.value, CASE WHEN own.value IS NULL THEN 'missing' ELSE 'same' END, vref.dir
+			FROM version_language AS vref
+			JOIN language AS lref ON lref.id = vref.language_id AND lref.name = ?
+			JOIN entry AS ref ON ref.langfile_id = vref.langfile_id
+			JOIN langkey ON langkey.id = ref.key_id
+			LEFT JOIN version_language AS vown ON vown.version_id = vref.version_id AND vown.dir = vref.dir
+				AND vown.language_id = (SELECT id FROM language WHERE name = ?)
+			LEFT JOIN entry AS own ON own.langfile_id = vown.langfile_id AND own.key_id = ref.key_id
+			WHERE vref.version_id = ? AND (own.value IS NULL OR (own.value = ref.value AND ref.value != ''))
+			ORDER BY vref.dir, langkey.name""", (reference, language, Version)).fetchall()
+
+	def History(self, key, language=None):
+		### Value of a key in every version and lang directory, * marks where it changed
+		Rows = []
+		Previous = {}
+		for Row in self.Database.execute("""SELECT version.name, language.name, entry.value, version_language.dir
+			FROM version
+			JOIN version_language ON version_language.version_id = version.id
+			JOIN language ON language.id = version_language.language_id
+			JOIN entry ON entry.langfile_id = version_language.langfile_id
+			JOIN langkey ON langkey.id = entry.key_id
+			WHERE langkey.name = ? AND (? IS NULL OR language.name = ?)
+			ORDER BY version.time IS NULL, version.time, version.id, version_language.dir, language.name""", (key, language, language)):
+			Rows.append(Row + ("=" if Previous.get((Row[3], Row[1])) == Row[2] else "*",))
+			Previous[(Row[3], Row[1])] = Row[2]
+		return Rows
+
+	def Versions(self):
+		return self.Database.execute("""SELECT version.name, version.time, COUNT(version_language.language_id), version.path
+			FROM version LEFT JOIN version_language ON version_language.version_id = version.id
+			GROUP BY version.id ORDER BY version.time IS NULL, version.time, version.id""").fetchall()
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+	logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+	logging.addLevelName(logging.WARNING, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+	logging.addLevelName(logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+	logging.addLevelName(logging.CRITICAL, "\033[5m\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.CRITICAL))
+
+	parser = argparse.ArgumentParser(description="Track the language keys of Dahua firmwares across versions in a SQLite database.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-d", "--database", default="lang.sqlite", help="Database file. (Default: lang.sqlite)")
+	parser.add_argument("-n", "--name", help="Version name of the ingested firmware. (Default: directory name without .extracted)")
+	parser.add_argument("-V", "--version", dest="target", metavar="VERSION", help="Version to query. (Default: the latest)")
+	parser.add_argument("-l", "--lang", help="Only look at this language for --added/--removed/--history")
+	parser.add_argument("-r", "--reference", default="English", help="Reference language for --untranslated. (Default: English)")
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument("--versions", action="store_true", help="List the ingested versions")
+	group.add_argument("--added", metavar="VERSION", help="List keys added since VERSION")
+	group.add_argument("--removed", metavar="VERSION", help="List keys removed since VERSION")
+	group.add_argument("--untranslated", metavar="LANG", help="List keys of the reference which LANG is missing or did not translate")
+	group.add_argument("--history", metavar="KEY", help="Show how the value of a key changed across versions")
+	parser.add_argument("sources", nargs="*", help="Extracted firmwares to ingest")
+	args = parser.parse_args()
+
+	Logger = logging.getLogger("main")
+	if args.verbose:
+		Logger.setLevel(logging.DEBUG)
+	else:
+		Logger.setLevel(logging.INFO)
+
+	if args.name and len(args.sources) > 1:
+		Logger.error("-n can only name a single version.")
+		sys.exit(1)
+
+	database = DahuaLangDb(args.database, args.verbose)
+	try:
+		for Source in args.sources:
+			if not os.path.isdir(Source):
+				Logger.error("No such directory: '%s'", Source)
+				sys.exit(1)
+			database.Ingest(Source, args.name)
+
+		Rows = None
+		try:
+			if args.versions:
+				Rows = database.Versions()
+			elif args.added:
+				Rows = database.Added(args.added, args.target, args.lang)
+			elif args.removed:
+				Rows = database.Removed(args.removed, args.target, args.lang)
+			elif args.untranslated:
+				Rows = database.Untranslated(args.untranslated, args.reference, args.target)
+			elif args.history:
+				Rows = database.History(args.history, args.lang)
+		except KeyError as e:
+			Logger.error(e.args[0])
+			sys.exit(1)
+
+		if Rows is not None:
+			for Row in Rows:
+				print("\t".join("" if Value is None else str(Value) for Value in Row))
+			if not Rows:
+				sys.exit(1)
+	finally:
+		database.close()
@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import stat
+import json
+import gzip
+import lzma
+import zlib
+import struct
+import shutil
+import hashlib
+import logging
+import tarfile
+import tempfile
+import distutils.spawn
+import concurrent.futures
+import uImage
+import SquashFS
+import CramFS
+import Runner
+import Store
+import Staging
+
+### The archives and images found in <Key>.extracted are unpacked to
+### <Key>.nested, a container <path> gets <path>.json (its node manifest) and
+### <path>.raw (files) or <path>.extracted (trees). Trees found in a node are
+### unpacked to <node>.nested the same way, files found in <path>.raw to
+### <path>.raw.*
+NESTED_SUFFIX = ".nested"
+NODE_SUFFIX = ".json"
+DEFAULT_DEPTH = 3
+PROBE_SIZE = 512
+
+GZIP_MAGIC = b"\x1f\x8b\x08"
+GZIP_FEXTRA = 0x04
+GZIP_FNAME = 0x08
+GZIP_FRESERVED = 0xe0
+### Extra flags written by gzip -9 and gzip -1, everything else is taken as 6
+GZIP_LEVELS = {2: 9, 4: 1}
+XZ_MAGIC = b"\xfd7zXZ\x00"
+TAR_MAGIC = b"ustar"
+TAR_MAGIC_OFFSET = 257
+TAR_GNU_MAGIC = b"ustar  \x00"
+
+################################################################################
+###
+### identify(head) - Container type of a file by the magic number at its start
+###
+### Parameters:   head:    the first PROBE_SIZE bytes of the file
+###
+### Returns:      "uImage", "SquashFS", "CramFS", "gzip", "xz", "tar" or None
+###
+def identify(head):
+	if len(head) >= uImage.HEADER_SIZE and struct.unpack_from("!L", head)[0] == uImage.HEADER_MAGIC:
+		return "uImage"
+	if len(head) >= SquashFS.HEADER_SIZE and struct.unpack_from("<I", head)[0] == SquashFS.HEADER_MAGIC:
+		return "SquashFS"
+	if len(head) >= CramFS.HEADER_SIZE and CramFS.HEADER_MAGIC in struct.unpack_from("<I", head) + struct.unpack_from(">I", head):
+		return "CramFS"
+	if len(head) >= 10 and head.startswith(GZIP_MAGIC) and not head[3] & GZIP_FRESERVED:
+		return "gzip"
+	if head.startswith(XZ_MAGIC):
+		return "xz"
+	if head[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + len(TAR_MAGIC)] == TAR_MAGIC:
+		return "tar"
+	return None
+
+################################################################################
+###
+### gzipHeader(fh) - Name, time and compression level of a gzip file
+###
+### Python's gzip module reads these but does not return them.
+###
+def gzipHeader(fh):
+	startpos = fh.tell()
+	fh.seek(0)
+	try:
+		head = fh.read(10)
+		flags = head[3]
+		name = None
+		if flags & GZIP_FEXTRA:
+			fh.seek(struct.unpack("<H", fh.read(2))[0], os.SEEK_CUR)
+		if flags & GZIP_FNAME:
+			name = b""
+			while True:
+				c = fh.read(1)
+				if not c or c == b"\0":
+					break
+				name += c
+			name = name.decode("latin-1")
+		return {"name": name, "mtime": struct.unpack_from("<I", head, 4)[0], "level": GZIP_LEVELS.get(head[8], 6)}
+	finally:
+		fh.seek(startpos)
+
+################################################################################
+###
+### tarMembers(path) - Format and member names of a tar archive in their order
+###
+def tarMembers(path):
+	with open(path, "rb") as fh:
+		fh.seek(TAR_MAGIC_OFFSET)
+		magic = fh.read(len(TAR_GNU_MAGIC))
+	with tarfile.open(path, "r:") as tf:
+		members = tf.getmembers()
+		pax = bool(tf.pax_headers) or any(member.pax_headers for member in members)
+	if pax:
+		format = "pax"
+	elif magic == TAR_GNU_MAGIC:
+		format = "gnu"
+	else:
+		format = "ustar"
+	return format, [member.name for member in members]
+
+################################################################################
+###
+### fingerprint(path) - Digest of the names, modes, owners, sizes and times of
+###                     a file or every entry below a directory
+###
+### Returns:      hex digest, None if something can not be read
+###
+def fingerprint(path):
+	digest = hashlib.sha256()
+	try:
+		st = os.lstat(path)
+		entries = [(".", st)]
+		if stat.S_ISDIR(st.st_mode):
+			for root, dirs, files in os.walk(path, onerror=raiseError):
+				for name in dirs + files:
+					entries.append((os.path.relpath(os.path.join(root, name), path), os.lstat(os.path.join(root, name))))
+	except OSError:
+		return None
+	for name, st in sorted(entries):
+		digest.update(repr((name, st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_mtime_ns)).encode("utf-8", errors="surrogateescape"))
+	return digest.hexdigest()
+
+def raiseError(e):
+	raise e
+
+class DahuaNested():
+	def __init__(self, debug, runner=None, jobs=None):
+		self.Debug = debug
+		self.Runner = runner if runner else Runner.Runner(debug, jobs)
+		self.Jobs = jobs if jobs else os.cpu_count()
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+		self.Source = None
+
+	def CheckDependency(self, dependency):
+		if not distutils.spawn.find_executable(dependency):
+			self.Logger.error("Missing dependency: '%s'", dependency)
+			return 1
+
+	def RelPath(self, path):
+		return os.path.relpath(path, self.Source)
+
+	def AbsPath(self, path):
+		return os.path.join(self.Source, path)
+
+	################################################################################
+	###
+	### Extract(source, depth) - Unpack the archives and images found in the
+	###                          partitions of an extracted firmware
+	###
+	### Parameters:   depth:   levels of nesting to follow, 1 unpacks only what
+	###                        is in <Key>.extracted (Default: DEFAULT_DEPTH)
+	###
+	### Containers are identified by their magic number, a level is unpacked in
+	### parallel before the next one is searched. Files hardlinked to a
+	### container are unpacked once and recorded as its "links".
+	###
+	### Returns:      number of nodes unpacked
+	###
+	def Extract(self, source, depth=DEFAULT_DEPTH):
+		self.Source = os.path.abspath(source)
+		Outputs = [os.path.join(self.Source, Name) for Name in sorted(os.listdir(self.Source)) if Name.endswith(".extracted")]
+		Count = 0
+		for Level in range(1, depth + 1):
+			Found = []
+			for Output in Outputs:
+				Found.extend(self.Scan(Output))
+			if not Found:
+				break
+
+			### Containers unpacked by an earlier run keep their node and
+			### whatever was edited in it, only their contents are searched
+			Outputs = []
+			New = []
+			for Args in Found:
+				if os.path.isfile(Args[1] + NODE_SUFFIX):
+					with open(Args[1] + NODE_SUFFIX, "r") as fp:
+						Output = self.AbsPath(json.load(fp)["output"])
+					if os.path.exists(Output):
+						Outputs.append(Output)
+				else:
+					New.append(Args)
+			if New:
+				self.Logger.info("Unpacking %d nested container(s) at depth %d.", len(New), Level)
+				with concurrent.futures.ThreadPoolExecutor(self.Jobs) as Executor:
+					Nodes = list(Executor.map(lambda Args: self.Unpack(*Args, Level), New))
+				Unpacked = [self.AbsPath(Node["output"]) for Node in Nodes if Node]
+				Outputs += Unpacked
+				Count += len(Unpacked)
+		else:
+			if Outputs:
+				self.Logger.debug("Depth limit %d reached, not looking into %d node(s).", depth, len(Outputs))
+		return Count
+
+	################################################################################
+	###
+	### Scan(output) - Find the containers in a tree or a file unpacked before
+	###
+	### Returns:      list of (path, base, type, hardlinks of path)
+	###
+	def Scan(self, output):
+		if not os.path.isdir(output):
+			with open(output, "rb") as fh:
+				Type = identify(fh.read(PROBE_SIZE))
+			return [(output, output, Type, [])] if Type else []
+
+		Nested = output[:-len(".extracted")] + NESTED_SUFFIX
+		Inodes = {}
+		for Root, Dirs, Files in os.walk(output):
+			Dirs.sort()
+			for Name in sorted(Files):
+				Path = os.path.join(Root, Name)
+				st = os.lstat(Path)
+				if not stat.S_ISREG(st.st_mode) or st.st_size < 4:
+					continue
+				if (st.st_dev, st.st_ino) in Inodes:
+					Inodes[(st.st_dev, st.st_ino)][3].append(self.RelPath(Path))
+					continue
+				try:
+					with open(Path, "rb") as fh:
+						Type = identify(fh.read(PROBE_SIZE))
+				except PermissionError:
+					self.Logger.debug("Can not read '%s', skipping.", self.RelPath(Path))
+					continue
+				if Type:
+					Inodes[(st.st_dev, st.st_ino)] = (Path, os.path.join(Nested, os.path.relpath(Path, output)), Type, [])
+		return list(Inodes.values())
+
+	################################################################################
+	###
+	### Unpack(path, base, type, links, depth) - Unpack one container and write
+	###                                          its node manifest to <base>.json
+	###
+	### Returns:      node dictionary, None if it was not a container after all
+	###               or could not be unpacked
+	###
+	def Unpack(self, path, base, type, links, depth):
+		Node = {
+			"type": type, "container": self.RelPath(path), "links": links, "depth": depth,
+			"size": os.path.getsize(path), "sha256": Store.hashFile(path), "params": {}
+		}
+		### Only what this run creates is ever removed again
+		Existing = [base + Suffix for Suffix in (".raw", ".uImage", ".extracted") if os.path.lexists(base + Suffix)]
+		if Existing:
+			self.Logger.warning("'%s' exists without a node manifest, not unpacking '%s'.", self.RelPath(Existing[0]), Node["container"])
+			return None
+		os.makedirs(os.path.dirname(base), exist_ok=True)
+		try:
+			Output = getattr(self, "Unpack_" + type)(path, base, Node["params"])
+		except (OSError, EOFError, ValueError, struct.error, zlib.error, lzma.LZMAError, tarfile.TarError) as e:
+			self.Logger.warning("'%s' is no %s: %s", Node["container"], type, e)
+			Output = None
+		if not Output:
+			for Suffix in (".raw", ".uImage"):
+				if os.path.isfile(base + Suffix):
+					os.unlink(base + Suffix)
+			if os.path.isdir(base + ".extracted"):
+				self.Runner.Cleanup([base + ".extracted"])
+			return None
+
+		Node["output"] = self.RelPath(Output)
+		Node["fingerprint"] = fingerprint(Output)
+		Staging.writeJson(base + NODE_SUFFIX, Node)
+		self.Logger.debug("'%s': %s unpacked to '%s'.", Node["container"], type, Node["output"])
+		return Node
+
+	def Unpack_uImage(self, path, base, params):
+		with open(path, "rb") as fh:
+			Header = uImage.parseHeader(fh)
+			if Header["headerCrc"] != uImage.calculateHeaderCrc(Header):
+				raise ValueError("header CRC mismatch")
+			if Header["imageType"] == uImage.searchTable(uImage.imageType, "multi"):
+				self.Logger.info("'%s' is a multi-file uImage, not unpacking it.", self.RelPath(path))
+				return None
+			Trailer = os.fstat(fh.fileno()).st_size - uImage.HEADER_SIZE - Header["size"]
+			if Trailer < 0:
+				raise ValueError("truncated, %d bytes missing" % -Trailer)
+			uImage.dumpToFile(fh, 0, uImage.HEADER_SIZE, base + ".uImage")
+			uImage.dumpToFile(fh, uImage.HEADER_SIZE, Header["size"], base + ".raw")
+		params["header"] = self.RelPath(base + ".uImage")
+		### Padding after the image is kept as it is
+		params["trailer"] = Trailer
+		return base + ".raw"
+
+	def Unpack_gzip(self, path, base, params):
+		with open(path, "rb") as fh:
+			params.update(gzipHeader(fh))
+		with gzip.open(path, "rb") as src, open(base + ".raw", "wb") as dst:
+			shutil.copyfileobj(src, dst, uImage.BLOCKSIZE)
+		return base + ".raw"
+
+	def Unpack_xz(self, path, base, params):
+		with open(path, "rb") as fh:
+			params["check"] = fh.read(len(XZ_MAGIC) + 2)[-1] & 0x0f
+		with lzma.open(path, "rb") as src, open(base + ".raw", "wb") as dst:
+			shutil.copyfileobj(src, dst, uImage.BLOCKSIZE)
+		return base + ".raw"
+
+	def Unpack_tar(self, path, base, params):
+		params["format"], params["members"] = tarMembers(path)
+		if self.CheckDependency("tar"):
+			return None
+		os.mkdir(base + ".extracted")
+		# Need root to preserve owners and device nodes.
+		if self.Runner.Run(["sudo", "tar", "-xpf", path, "-C", base + ".extracted", "--numeric-owner"],
+						   self.RelPath(path), [base + ".extracted"]) != 0:
+			return None
+		return base + ".extracted"
+
+	def Unpack_SquashFS(self, path, base, params):
+		with open(path, "rb") as fh:
+			Header = SquashFS.parseHeader(fh)
+		if Header["s_magic"] != SquashFS.HEADER_MAGIC:
+			raise ValueError("invalid superblock")
+		if self.CheckDependency("unsquashfs"):
+			return None
+		if self.Runner.Run(["sudo", "unsquashfs", "-d", base + ".extracted", path], self.RelPath(path), [base + ".extracted"]) != 0:
+			return None
+		return base + ".extracted"
+
+	def Unpack_CramFS(self, path, base, params):
+		with open(path, "rb") as fh:
+			Header = CramFS.parseHeader(fh)
+		if Header["magic"] != CramFS.HEADER_MAGIC:
+			raise ValueError("invalid superblock")
+		if self.CheckDependency("cramfsck"):
+			return None
+		if self.Runner.Run(["sudo", "cramfsck", "-x", base + ".extracted", path], self.RelPath(path), [base + ".extracted"]) != 0:
+			return None
+		return base + ".extracted"
+
+	################################################################################
+	###
+	### Nodes(source) - Load the node manifests of an extracted firmware
+	###
+	### Returns:      list of (manifest path, node)
+	###
+	def Nodes(self, source):
+		self.Source = os.path.abspath(source)
+		Nodes = []
+		for Name in sorted(os.listdir(self.Source)):
+			if not Name.endswith(NESTED_SUFFIX) or not os.path.isdir(os.path.join(self.Source, Name)):
+				continue
+			for Root, Dirs, Files in os.walk(os.path.join(self.Source, Name)):
+				for File in sorted(Files):
+					if not File.endswith(NODE_SUFFIX):
+						continue
+					Path = os.path.join(Root, File)
+					with open(Path, "r") as fp:
+						Node = json.load(fp)
+					Nodes.append((Path, Node))
+					### Do not mistake files of the firmware for manifests
+					Output = os.path.basename(Node["output"])
+					if Output in Dirs:
+						Dirs.remove(Output)
+		return Nodes
+
+	################################################################################
+	###
+	### Repack(source) - Pack nodes whose contents changed back into their
+	###                  containers, deepest first
+	###
+	### A repacked container changes the contents of its parent, which is then
+	### repacked as well, up to the file in <Key>.extracted. Nodes whose
+	### container was also changed since they were unpacked are not touched.
+	###
+	### Returns:      (number of nodes repacked, number of errors)
+	###
+	def Repack(self, source):
+		Nodes = self.Nodes(source)
+		Repacked = 0
+		Errors = 0
+		for Depth in sorted(set(Node["depth"] for Path, Node in Nodes), reverse=True):
+			Level = [(Path, Node) for Path, Node in Nodes if Node["depth"] == Depth]
+			with concurrent.futures.ThreadPoolExecutor(self.Jobs) as Executor:
+				for Result in Executor.map(lambda Args: self.RepackNode(*Args), Level):
+					Repacked += Result == 0
+					Errors += Result == 1
+		if Repacked or Errors:
+			self.Logger.info("Repacked %d nested container(s), %d error(s).", Repacked, Errors)
+		return Repacked, Errors
+
+	################################################################################
+	###
+	### RepackNode(path, node) - Repack one node if its contents changed
+	###
+	### Returns:      0 when repacked, 1 on error, None if nothing was done
+	###
+	def RepackNode(self, path, node):
+		Container = self.AbsPath(node["container"])
+		Output = self.AbsPath(node["output"])
+		if not os.path.exists(Output):
+			self.Logger.warning("'%s' was removed, leaving '%s' as it is.", node["output"], node["container"])
+			return None
+		Fingerprint = fingerprint(Output)
+		if Fingerprint is None:
+			self.Logger.warning("Can not read all of '%s', not repacking it.", node["output"])
+			return None
+		if Fingerprint == node["fingerprint"]:
+			return None
+		if not os.path.isfile(Container) or Store.hashFile(Container) != node["sha256"]:
+			self.Logger.error("'%s' and '%s' were both changed, not repacking it.", node["container"], node["output"])
+			return 1
+		# Need root to replace the container in the extracted filesystem.
+		if os.geteuid() != 0:
+			self.Logger.error("Repacking '%s' needs root to replace it, please run with sudo.", node["container"])
+			return 1
+
+		self.Logger.info("Repacking '%s' (%s).", node["container"], node["type"])
+		TempDir = tempfile.mkdtemp(dir=os.path.dirname(path), prefix=".nested.")
+		try:
+			TempPath = os.path.join(TempDir, os.path.basename(Container))
+			if getattr(self, "Pack_" + node["type"])(node, Container, Output, TempPath) != 0 or not os.path.isfile(TempPath):
+				self.Logger.error("Could not repack '%s'.", node["container"])
+				return 1
+			with open(TempPath, "rb") as fh:
+				Staging.replaceFile(Container, fh)
+		finally:
+			shutil.rmtree(TempDir, ignore_errors=True)
+		for Link in node["links"]:
+			Staging.linkFile(Container, self.AbsPath(Link))
+
+		node["size"] = os.path.getsize(Container)
+		node["sha256"] = Store.hashFile(Container)
+		node["fingerprint"] = fingerprint(Output)
+		Staging.writeJson(path, node)
+		return 0
+
+	def Pack_uImage(self, node, container, output, dest):
+		with open(self.AbsPath(node["params"]["header"]), "rb") as fh:
+			Header = uImage.parseHeader(fh)
+		with open(output, "rb") as fh:
+			Header["dataCrc"] = uImage.crc32File(fh)
+		Header["size"] = os.path.getsize(output)
+		with open(dest, "wb") as df, open(output, "rb") as fh, open(container, "rb") as orig:
+			df.write(uImage.packHeader(Header))
+			shutil.copyfileobj(fh, df, uImage.BLOCKSIZE)
+			if node["params"]["trailer"]:
+				orig.seek(-node["params"]["trailer"], os.SEEK_END)
+				shutil.copyfileobj(orig, df, uImage.BLOCKSIZE)
+		return 0
+
+	def Pack_gzip(self, node, container, output, dest):
+		Params = node["params"]
+		with open(dest, "wb") as df, open(output, "rb") as fh:
+			with gzip.GzipFile(Params["name"] or "", "wb", Params["level"], df, Params["mtime"]) as gz:
+				shutil.copyfileobj(fh, gz, uImage.BLOCKSIZE)
+		return 0
+
+	def Pack_xz(self, node, container, output, dest):
+		with lzma.open(dest, "wb", format=lzma.FORMAT_XZ, check=node["params"]["check"]) as xz, open(output, "rb") as fh:
+			shutil.copyfileobj(fh, xz, uImage.BLOCKSIZE)
+		return 0
+
+	def Pack_tar(self, node, container, output, dest):
+		if self.CheckDependency("tar"):
+			return 1
+		### Original members in their order (if they still exist), then new files
+		Members = node["params"]["members"]
+		Names = [Name for Name in Members if os.path.lexists(os.path.join(output, Name))]
+		Known = set(os.path.normpath(Name) for Name in Names)
+		Prefix = "./" if Members and all(Name.startswith("./") for Name in Members) else ""
+		for Root, Dirs, Files in os.walk(output):
+			Dirs.sort()
+			for Name in Dirs + sorted(Files):
+				RelPath = os.path.relpath(os.path.join(Root, Name), output)
+				if RelPath not in Known:
+					Names.append(Prefix + RelPath)
+
+		ListPath = dest + ".list"
+		with open(ListPath, "wb") as fp:
+			fp.write(b"".join(os.fsencode(Name) + b"\0" for Name in Names))
+		# Need root to read every file.
+		return self.Runner.Run(["sudo", "tar", "--numeric-owner", "--no-recursion", "--format=" + node["params"]["format"],
+								"-C", output, "--null", "--verbatim-files-from", "-T", ListPath, "-cf", dest],
+							   node["container"], [dest])
+
+	def Pack_SquashFS(self, node, container, output, dest):
+		with open(container, "rb") as fh:
+			Header = SquashFS.parseHeader(fh)
+		Binary = "mksquashfs" + ("" if Header["s_major"] == 4 else str(Header["s_major"]))
+		if self.CheckDependency(Binary):
+			return 1
+		# Need root to access all files.
+		Result = self.Runner.Run(["sudo", Binary, output, dest] + SquashFS.buildConOpts(Header), node["container"], [dest])
+		if Result != 0:
+			return Result
+		with open(dest, "rb") as fh:
+			Diffs = SquashFS.compareHeaders(Header, SquashFS.parseHeader(fh))
+		for Field, Orig, Built in Diffs:
+			self.Logger.error("'%s': SquashFS %s is %s, the original has %s!", node["container"], Field, Built, Orig)
+		return 1 if Diffs else 0
+
+	def Pack_CramFS(self, node, container, output, dest):
+		with open(container, "rb") as fh:
+			Header = CramFS.parseHeader(fh)
+		if self.CheckDependency("mkcramfs"):
+			return 1
+		# Need root to access all files.
+		return self.Runner.Run(["sudo", "mkcramfs"] + CramFS.buildConOpts(Header) + [output, dest], node["container"], [dest])
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+	logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+	logging.addLevelName(logging.WARNING, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+	logging.addLevelName(logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+	logging.addLevelName(logging.CRITICAL, "\033[5m\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.CRITICAL))
+
+	parser = argparse.ArgumentParser(description="Unpack and repack archives and images nested in an extracted Dahua firmware image.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-d", "--depth", type=int, default=DEFAULT_DEPTH, help="Levels of nesting to unpack. (Default: %d)" % DEFAULT_DEPTH)
+	parser.add_argument("-j", "--jobs", type=int, help="Number of containers unpacked at once. (Default: number of CPUs)")
+	parser.add_argument("command", choices=["extract", "repack", "list"], help="extract: unpack into <Key>.nested, repack: pack changed nodes back, list: show the nodes")
+	parser.add_argument("source", help="Extracted firmware")
+	args = parser.parse_args()
+
+	nested = DahuaNested(args.verbose, jobs=args.jobs)
+	if args.command == "extract":
+		nested.Extract(args.source, args.depth)
+	elif args.command == "repack":
+		sys.exit(1 if nested.Repack(args.source)[1] else 0)
+	else:
+		for Path, Node in sorted(nested.Nodes(args.source), key=lambda Entry: Entry[1]["container"]):
+			print("%s%s (%s, %d bytes) -> %s" % ("  " * (Node["depth"] - 1), Node["container"], Node["type"], Node["size"], Node["output"]))
@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import re
+import sys
+import stat
+import json
+import shutil
+import difflib
+import hashlib
+import logging
+import tempfile
+import Store
+
+PATCHSET_FILE = "patchset.json"
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+NO_NEWLINE = "\\ No newline at end of file"
+
+# Equal sized files with at most this many changed byte ranges become binary edits
+MAX_BINARY_EDITS = 16
+
+class ConflictError(Exception):
+	pass
+
+################################################################################
+###
+### checkPath(tree, relPath) - Path of relPath in tree, if it stays in the tree
+###
+### Paths leaving the tree through ".." or a symlinked parent directory would
+### change files of the host, they raise ConflictError.
+###
+def checkPath(tree, relPath):
+	relPath = os.path.normpath(relPath)
+	parts = relPath.split(os.sep)
+	if parts[0] == ".." or os.path.isabs(relPath):
+		raise ConflictError("path leaves the filesystem")
+	for i in range(1, len(parts)):
+		if os.path.islink(os.path.join(tree, *parts[:i])):
+			raise ConflictError("path goes through the symlink '%s'" % os.sep.join(parts[:i]))
+	return os.path.join(tree, relPath)
+
+################################################################################
+###
+### parsePatch(text) - Parse a unified diff of a single file
+###
+### Returns:      List of hunks, every hunk is (old start, old lines, new lines)
+###
+def parsePatch(text):
+	hunks = []
+	lines = text.split("\n")
+	if lines and lines[-1] == "":
+		lines.pop()
+	hunk = None
+	lastLine = None
+	for line in lines:
+		match = HUNK_HEADER.match(line)
+		if match:
+			hunk = (int(match.group(1)), [], [])
+			hunks.append(hunk)
+		elif hunk is None:
+			continue
+		elif line == NO_NEWLINE:
+			### Strip the newline of the line before the marker
+			for lst in (hunk[1], hunk[2]):
+				if lst and lst[-1] is lastLine:
+					lst[-1] = lst[-1][:-1]
+					lastLine = lst[-1]
+		else:
+			tag, lastLine = line[:1], line[1:] + "\n"
+			if tag in (" ", "-"):
+				hunk[1].append(lastLine)
+			if tag in (" ", "+"):
+				hunk[2].append(lastLine)
+	return hunks
+
+def findLines(lines, needle, start):
+	### Returns index of needle in lines closest to start, or None
+	for distance in range(len(lines) + 1):
+		for pos in (start - distance, start + distance):
+			if 0 <= pos <= len(lines) - len(needle) and lines[pos:pos + len(needle)] == needle:
+				return pos
+	return None
+
+################################################################################
+###
+### applyPatch(data, hunks, reverse=False) - Apply hunks of parsePatch()
+###
+### Hunks may have moved, they are searched for around their original line.
+###
+### Returns:      Patched data or None if a hunk does not apply
+###
+def applyPatch(data, hunks, reverse=False):
+	lines = data.decode("latin-1").splitlines(keepends=True)
+	delta = 0
+	for start, old, new in hunks:
+		if reverse:
+			old, new = new, old
+		pos = findLines(lines, old, max(start - 1, 0) + delta)
+		if pos is None:
+			return None
+		lines[pos:pos + len(old)] = new
+		### Offset of the following lines against the original file
+		delta = pos + len(new) - (max(start - 1, 0) + len(old))
+	return "".join(lines).encode("latin-1")
+
+def makePatch(old, new, path):
+	oldLines = old.decode("latin-1").splitlines(keepends=True)
+	newLines = new.decode("latin-1").splitlines(keepends=True)
+	out = []
+	for line in difflib.unified_diff(oldLines, newLines, "a/" + path, "b/" + path):
+		out.append(line)
+		if not line.endswith("\n"):
+			out.append("\n" + NO_NEWLINE + "\n")
+	return "".join(out)
+
+def diffRanges(old, new, limit, blocksize=4096):
+	### Returns list of (offset, length) of differing bytes of two equal sized
+	### buffers, None if there are more than limit ranges
+	ranges = []
+	for block in range(0, len(old), blocksize):
+		if old[block:block + blocksize] == new[block:block + blocksize]:
+			continue
+		for pos in range(block, min(block + blocksize, len(old))):
+			if old[pos] == new[pos]:
+				continue
+			if ranges and ranges[-1][0] + ranges[-1][1] == pos:
+				ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+			else:
+				if len(ranges) == limit:
+					return None
+				ranges.append((pos, 1))
+	return ranges
+
+def isText(data):
+	return b"\0" not in data[:8192]
+
+def sha256(data):
+	return hashlib.sha256(data).hexdigest()
+
+def readFile(path):
+	with open(path, "rb") as fp:
+		return fp.read()
+
+class DahuaOverlay():
+	def __init__(self, debug):
+		self.Debug = debug
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+		self.PatchSet = None
+		self.Operations = None
+
+	def Load(self, patchSet):
+		self.PatchSet = os.path.abspath(patchSet)
+		with open(os.path.join(self.PatchSet, PATCHSET_FILE), "r") as fp:
+			self.Operations = json.load(fp)
+
+	################################################################################
+	###
+	### Apply(source, dryRun=False, keys=None) - Apply the loaded patch set to an extracted firmware
+	###
+	### Parameters:   keys:    only apply the operations of these partitions
+	###                        (Default: all)
+	###
+	### All operations are checked before anything is written, if any of them
+	### conflicts nothing is changed. Operations which are already applied are
+	### skipped and only changed files are rewritten (through a rename, which
+	### also keeps files hardlinked to a store intact).
+	###
+	### Returns:      List of partition keys which were changed
+	###
+	def Apply(self, source, dryRun=False, keys=None):
+		Source = os.path.abspath(source)
+		Plan = []
+		Conflicts = []
+		for Key, Operations in self.Operations.items():
+			if keys is not None and Key not in keys:
+				continue
+			Tree = os.path.join(Source, Key + ".extracted")
+			if not os.path.isdir(Tree):
+				Conflicts.append("%s: no extracted filesystem" % Key)
+				continue
+			Removed = set()
+			for Operation in Operations:
+				try:
+					Action = self.Check(Key, Tree, Operation, Removed)
+				except ConflictError as e:
+					Conflicts.append("%s:%s: %s" % (Key, Operation["path"], e))
+					continue
+				if Action:
+					Plan.append((Key, Action))
+				else:
+					self.Logger.debug("%s:%s: already applied.", Key, Operation["path"])
+
+		for Conflict in Conflicts:
+			self.Logger.error("Conflict %s", Conflict)
+		if Conflicts:
+			raise ConflictError("%d conflict(s), nothing was changed." % len(Conflicts))
+
+		Changed = []
+		for Key, (Description, Function) in Plan:
+			self.Logger.info("%s %s", "Would apply" if dryRun else "Applying", Description)
+			if not dryRun:
+				Function()
+			if Key not in Changed:
+				Changed.append(Key)
+		if not Plan:
+			self.Logger.info("Patch set is already applied.")
+		return Changed
+
+	################################################################################
+	###
+	### Check(key, tree, operation, removed) - Check one operation against a tree
+	###
+	### Paths in removed (and below them) are removed by earlier operations.
+	###
+	### Returns:      (description, function doing the change), None if the
+	###               operation is already applied, raises ConflictError
+	###
+	def Check(self, key, tree, operation, removed):
+		Op = operation["op"]
+		RelPath = os.path.normpath(operation["path"])
+		Path = checkPath(tree, RelPath)
+		Name = "%s:%s" % (key, RelPath)
+		Parts = RelPath.split(os.sep)
+		Exists = os.path.lexists(Path) and not any(os.sep.join(Parts[:i]) in removed for i in range(1, len(Parts) + 1))
+		Base = operation.get("base")
+
+		if Op == "remove":
+			if not Exists:
+				return None
+			removed.add(RelPath)
+			if Base and os.path.isfile(Path) and not os.path.islink(Path) and sha256(readFile(Path)) != Base:
+				raise ConflictError("file to remove was changed upstream")
+			return ("remove %s" % Name, lambda: self.Remove(tree, RelPath))
+
+		if Op == "mkdir":
+			if Exists and os.path.isdir(Path):
+				return None
+			if Exists:
+				raise ConflictError("exists and is not a directory")
+			return ("mkdir %s" % Name, lambda: self.MakeDirs(tree, RelPath, operation))
+
+		if Op == "chmod":
+			if not Exists:
+				raise ConflictError("does not exist (removed upstream?)")
+			Stat = os.lstat(Path)
+			Mode = int(operation["mode"], 8) if "mode" in operation else stat.S_IMODE(Stat.st_mode)
+			Uid = operation.get("uid", Stat.st_uid)
+			Gid = operation.get("gid", Stat.st_gid)
+			if (Mode, Uid, Gid) == (stat.S_IMODE(Stat.st_mode), Stat.st_uid, Stat.st_gid):
+				return None
+			return ("chmod %s %o %d:%d" % (Name, Mode, Uid, Gid), lambda: self.SetAttributes(checkPath(tree, RelPath), Mode, Uid, Gid))
+
+		if Op == "add" and "target" in operation:
+			if Exists and os.path.islink(Path) and os.readlink(Path) == operation["target"]:
+				return None
+			if Exists and not os.path.islink(Path):
+				raise ConflictError("exists and is not a symlink")
+			return ("symlink %s -> %s" % (Name, operation["target"]), lambda: self.Symlink(tree, RelPath, operation))
+
+		if Op in ("add", "patch", "binary"):
+			if Exists and (not os.path.isfile(Path) or os.path.islink(Path)):
+				raise ConflictError("is not a regular file")
+
+		if Op == "add":
+			Data = readFile(os.path.join(self.PatchSet, "files", key, RelPath))
+			if Exists:
+				Current = sha256(readFile(Path))
+				if Current == sha256(Data):
+					return None
+				if Current != Base:
+					raise ConflictError("exists and was changed upstream" if Base else "already exists upstream")
+			elif Base:
+				raise ConflictError("file to replace was removed upstream")
+			return ("%s %s" % ("replace" if Exists else "add", Name), lambda: self.WriteFile(tree, RelPath, Data, operation))
+
+		if not Exists:
+			raise ConflictError("file to patch does not exist (removed upstream?)")
+		Data = readFile(Path)
+		Changed = Base and sha256(Data) != Base
+
+		if Op == "patch":
+			with open(os.path.join(self.PatchSet, "patches", key, RelPath + ".patch"), "r", encoding="latin-1") as fp:
+				Hunks = parsePatch(fp.read())
+			### A patch which only adds lines would apply again on top of itself
+			if sha256(Data) == operation.get("result") or Changed and applyPatch(Data, Hunks, reverse=True) is not None:
+				return None
+			New = applyPatch(Data, Hunks)
+			if New is None:
+				raise ConflictError("patch does not apply" + (", file was changed upstream" if Changed else ""))
+		elif Op == "binary":
+			New = bytearray(Data)
+			Applied = True
+			for Edit in operation["edits"]:
+				Offset = Edit["offset"]
+				Old = bytes.fromhex(Edit["old"])
+				Replacement = bytes.fromhex(Edit["new"])
+				At = bytes(New[Offset:Offset + len(Old)])
+				if At == Replacement:
+					continue
+				Applied = False
+				if At != Old:
+					raise ConflictError("bytes at %#x differ" % Offset + (", file was changed upstream" if Changed else ""))
+				New[Offset:Offset + len(Old)] = Replacement
+			if Applied:
+				return None
+			New = bytes(New)
+		else:
+			raise ConflictError("unknown operation '%s'" % Op)
+
+		if Changed:
+			self.Logger.warning("%s was changed upstream, %s still applies.", Name, Op)
+		return ("%s %s" % (Op, Name), lambda: self.WriteFile(tree, RelPath, New, operation))
+
+	### The paths are checked again when changing them, earlier operations may
+	### have replaced a parent directory with a symlink
+
+	def Remove(self, tree, relPath):
+		Path = checkPath(tree, relPath)
+		if os.path.isdir(Path) and not os.path.islink(Path):
+			shutil.rmtree(Path)
+		else:
+			os.unlink(Path)
+
+	def MakeDirs(self, tree, relPath, operation):
+		### Missing parent directories are created like mkdir -p, owned by root
+		Path = checkPath(tree, relPath)
+		Parent = os.path.dirname(relPath)
+		if Parent and not os.path.isdir(os.path.join(tree, Parent)):
+			self.MakeDirs(tree, Parent, {})
+		os.mkdir(Path)
+		self.SetAttributes(Path, int(operation.get("mode", "0755"), 8), operation.get("uid", 0), operation.get("gid", 0))
+
+	def Symlink(self, tree, relPath, operation):
+		Path = checkPath(tree, relPath)
+		Parent = os.path.dirname(relPath)
+		if Parent and not os.path.isdir(os.path.join(tree, Parent)):
+			self.MakeDirs(tree, Parent, {})
+		if os.path.lexists(Path):
+			os.unlink(Path)
+		os.symlink(operation["target"], Path)
+		os.lchown(Path, operation.get("uid", 0), operation.get("gid", 0))
+
+	def WriteFile(self, tree, relPath, data, operation):
+		### Replaces the file through a rename, keeps mode and owner of an
+		### existing file unless the operation sets them
+		Path = checkPath(tree, relPath)
+		Parent = os.path.dirname(relPath)
+		if Parent and not os.path.isdir(os.path.join(tree, Parent)):
+			self.MakeDirs(tree, Parent, {})
+		if os.path.exists(Path):
+			Stat = os.lstat(Path)
+			Mode, Uid, Gid = stat.S_IMODE(Stat.st_mode), Stat.st_uid, Stat.st_gid
+		else:
+			Mode, Uid, Gid = 0o644, 0, 0
+		if "mode" in operation:
+			Mode = int(operation["mode"], 8)
+		Uid = operation.get("uid", Uid)
+		Gid = operation.get("gid", Gid)
+
+		fd, TmpPath = tempfile.mkstemp(dir=os.path.dirname(Path), prefix=".overlay.")
+		try:
+			with os.fdopen(fd, "wb") as fp:
+				fp.write(data)
+			os.chown(TmpPath, Uid, Gid)
+			os.chmod(TmpPath, Mode)
+			os.replace(TmpPath, Path)
+		except:
+			os.unlink(TmpPath)
+			raise
+
+	def SetAttributes(self, path, mode, uid, gid):
+		### Files and symlinks hardlinked to a store or the source of a build
+		### are copied first, the store object and other trees keep their
+		### attributes
+		if os.path.islink(path) and os.lstat(path).st_nlink > 1:
+			TmpPath = os.path.join(os.path.dirname(path), ".overlay.%s" % os.path.basename(path))
+			if os.path.lexists(TmpPath):
+				os.unlink(TmpPath)
+			os.symlink(os.readlink(path), TmpPath)
+			os.replace(TmpPath, path)
+		elif os.path.isfile(path) and os.lstat(path).st_nlink > 1:
+			fd, TmpPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".overlay.")
+			os.close(fd)
+			shutil.copyfile(path, TmpPath)
+			os.replace(TmpPath, path)
+		os.chown(path, uid, gid, follow_symlinks=False)
+		if not os.path.islink(path):
+			os.chmod(path, mode)
+
+	################################################################################
+	###
+	### Create(original, modified, dest) - Record the differences of two extracted firmwares
+	###
+	### Every <Key>.extracted tree of the modified firmware is compared with the
+	### original, text files become patches, equal sized binaries with a few
+	### changes become binary edits and other files are stored whole.
+	###
+	def Create(self, original, modified, dest):
+		self.PatchSet = os.path.abspath(dest)
+		if os.path.exists(self.PatchSet):
+			raise Exception("Destination '%s' already exists!" % dest)
+		os.makedirs(self.PatchSet)
+		self.Operations = {}
+
+		for Name in sorted(os.listdir(modified)):
+			if not Name.endswith(".extracted"):
+				continue
+			Key = Name[:-len(".extracted")]
+			Original = os.path.join(original, Name)
+			if not os.path.isdir(Original):
+				self.Logger.warning("'%s' does not exist in the original firmware, skipping.", Name)
+				continue
+			Operations = self.CompareTrees(Key, Original, os.path.join(modified, Name))
+			if Operations:
+				self.Operations[Key] = Operations
+				self.Logger.info("%s: %d operation(s).", Key, len(Operations))
+
+		with open(os.path.join(self.PatchSet, PATCHSET_FILE), "w") as fp:
+			json.dump(self.Operations, fp, indent=1)
+		return self.Operations
+
+	def ListTree(self, tree):
+		Entries = {}
+		for Root, Dirs, Files in os.walk(tree):
+			Dirs.sort()
+			for Name in sorted(Dirs + Files):
+				Path = os.path.join(Root, Name)
+				Entries[os.path.relpath(Path, tree)] = os.lstat(Path)
+		return Entries
+
+	def CompareTrees(self, key, original, modified):
+		Operations = []
+		Old = self.ListTree(original)
+		New = self.ListTree(modified)
+
+		Removed = [Path for Path in Old if Path not in New]
+		for Path in Removed:
+			### A removed directory covers everything in it
+			if os.path.dirname(Path) in Removed:
+				continue
+			Operation = {"op": "remove", "path": Path}
+			if stat.S_ISREG(Old[Path].st_mode):
+				Operation["base"] = Store.hashFile(os.path.join(original, Path))
+			Operations.append(Operation)
+
+		for Path, NewStat in New.items():
+			OldStat = Old.get(Path)
+			Attributes = {"mode": "%04o" % stat.S_IMODE(NewStat.st_mode), "uid": NewStat.st_uid, "gid": NewStat.st_gid}
+			NewPath = os.path.join(modified, Path)
+			if OldStat and stat.S_IFMT(OldStat.st_mode) != stat.S_IFMT(NewStat.st_mode):
+				Operations.append({"op": "remove", "path": Path})
+				OldStat = None
+
+			if stat.S_ISDIR(NewStat.st_mode):
+				if not OldStat:
+					Operations.append(dict({"op": "mkdir", "path": Path}, **Attributes))
+			elif stat.S_ISLNK(NewStat.st_mode):
+				Target = os.readlink(NewPath)
+				if not OldStat or os.readlink(os.path.join(original, Path)) != Target:
+					Operations.append({"op": "add", "path": Path, "target": Target, "uid": NewStat.st_uid, "gid": NewStat.st_gid})
+					continue
+			elif stat.S_ISREG(NewStat.st_mode):
+				NewData = readFile(NewPath)
+				if not OldStat:
+					Operations.append(dict({"op": "add", "path": Path}, **Attributes))
+					self.StoreFile(key, Path, NewData)
+					continue
+				OldData = readFile(os.path.join(original, Path))
+				if OldData != NewData:
+					Operations.append(self.CompareFile(key, Path, OldData, NewData))
+			else:
+				self.Logger.warning("%s:%s: special files are not supported, skipping.", key, Path)
+				continue
+
+			if OldStat and (stat.S_IMODE(OldStat.st_mode), OldStat.st_uid, OldStat.st_gid) != (stat.S_IMODE(NewStat.st_mode), NewStat.st_uid, NewStat.st_gid):
+				Operations.append(dict({"op": "chmod", "path": Path}, **Attributes))
+		return Operations
+
+	def CompareFile(self, key, path, old, new):
+		Base = sha256(old)
+		if isText(old) and isText(new):
+			PatchPath = os.path.join(self.PatchSet, "patches", key, path + ".patch")
+			os.makedirs(os.path.dirname(PatchPath), exist_ok=True)
+			with open(PatchPath, "w", encoding="latin-1") as fp:
+				fp.write(makePatch(old, new, path))
+			return {"op": "patch", "path": path, "base": Base, "result": sha256(new)}
+
+		Ranges = diffRanges(old, new, MAX_BINARY_EDITS) if len(old) == len(new) else None
+		if Ranges is not None:
+			Edits = [{"offset": Offset, "old": old[Offset:Offset + Length].hex(), "new": new[Offset:Offset + Length].hex()}
+				for Offset, Length in Ranges]
+			return {"op": "binary", "path": path, "base": Base, "edits": Edits}
+
+		self.StoreFile(key, path, new)
+		return {"op": "add", "path": path, "base": Base}
+
+	def StoreFile(self, key, path, data):
+		Path = os.path.join(self.PatchSet, "files", key, path)
+		os.makedirs(os.path.dirname(Path), exist_ok=True)
+		with open(Path, "wb") as fp:
+			fp.write(data)
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+	logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+	logging.addLevelName(logging.WARNING, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+	logging.addLevelName(logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+	logging.addLevelName(logging.CRITICAL, "\033[5m\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.CRITICAL))
+
+	parser = argparse.ArgumentParser(description="Create and apply patch sets (overlays) to extracted Dahua firmware images.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-n", "--dry-run", action="store_true", help="Only check the patch set and show what would be changed")
+	subparsers = parser.add_subparsers(dest="command")
+	create = subparsers.add_parser("create", help="Create a patch set from the differences of two extracted firmwares")
+	create.add_argument("original", help="Extracted original firmware")
+	create.add_argument("modified", help="Extracted modified firmware")
+	create.add_argument("patchset", help="Patch set directory to create")
+	apply = subparsers.add_parser("apply", help="Apply a patch set to an extracted firmware")
+	apply.add_argument("patchset", help="Patch set directory")
+	apply.add_argument("source", help="Extracted firmware")
+	args = parser.parse_args()
+
+	Logger = logging.getLogger("main")
+	if not args.command:
+		parser.print_help()
+		sys.exit(1)
+
+	overlay = DahuaOverlay(args.verbose)
+	if args.command == "create":
+		overlay.Create(args.original, args.modified, args.patchset)
+	else:
+		# Need root to change the files of the extracted filesystems.
+		if not args.dry_run and os.geteuid() != 0:
+			Logger.error("Applying a patch set needs root to change the extracted files, please run with sudo.")
+			sys.exit(1)
+		overlay.Load(args.patchset)
+		try:
+			overlay.Apply(args.source, args.dry_run)
+		except ConflictError as e:
+			Logger.error("%s", e)
+			sys.exit(1)
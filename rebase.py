@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import stat
+import json
+import errno
+import shutil
+import hashlib
+import logging
+import Firmware
+import Store
+import extract
+import overlay
+import importlib
+from configs.config import *
+
+################################################################################
+###
+### ImageTree(fs) - Entries of a filesystem read in place
+###
+class ImageTree():
+	def __init__(self, fs):
+		self.FS = fs
+		self.Entries = {}
+		self.Digests = {}
+		for Path, Inode in fs.walk():
+			Entry = {"type": Inode["type"], "mode": Inode["mode"], "uid": Inode["uid"], "gid": Inode["gid"], "inode": Inode}
+			if Inode["type"] == "f":
+				Entry["size"] = Inode["file_size"]
+			elif Inode["type"] == "l":
+				Entry["target"] = Inode["target"]
+			elif Inode["type"] in "bc":
+				Entry["rdev"] = Store.decodeDev(Inode["rdev"])
+			self.Entries[Path] = Entry
+
+	def Content(self, path):
+		return b"".join(self.FS.readFile(self.Entries[path]["inode"]))
+
+	def Digest(self, path):
+		if path not in self.Digests:
+			Digest = hashlib.sha256()
+			for Block in self.FS.readFile(self.Entries[path]["inode"]):
+				Digest.update(Block)
+			self.Digests[path] = Digest.hexdigest()
+		return self.Digests[path]
+
+	def BlockDigest(self, path):
+		return self.FS.blockDigest(self.Entries[path]["inode"])
+
+################################################################################
+###
+### DiskTree(root) - Entries of an extracted filesystem
+###
+class DiskTree():
+	def __init__(self, root):
+		self.Root = root
+		self.Entries = {}
+		self.Digests = {}
+		self.Add(".", root)
+		for Root, Dirs, Files in os.walk(root):
+			for Name in Dirs + Files:
+				Path = os.path.join(Root, Name)
+				self.Add(os.path.relpath(Path, root), Path)
+
+	def Add(self, path, fullPath):
+		Stat = os.lstat(fullPath)
+		Entry = {"type": stat.filemode(Stat.st_mode)[0].replace("-", "f"), "mode": stat.S_IMODE(Stat.st_mode),
+				 "uid": Stat.st_uid, "gid": Stat.st_gid}
+		if stat.S_ISREG(Stat.st_mode):
+			Entry["size"] = Stat.st_size
+		elif stat.S_ISLNK(Stat.st_mode):
+			Entry["target"] = os.readlink(fullPath)
+		elif stat.S_ISBLK(Stat.st_mode) or stat.S_ISCHR(Stat.st_mode):
+			Entry["rdev"] = Stat.st_rdev
+		self.Entries[path] = Entry
+
+	def Content(self, path):
+		return overlay.readFile(os.path.join(self.Root, path))
+
+	def Digest(self, path):
+		if path not in self.Digests:
+			self.Digests[path] = Store.hashFile(os.path.join(self.Root, path))
+		return self.Digests[path]
+
+def sameContent(treeA, pathA, treeB, pathB):
+	### Compares type and content of two entries (None if missing), file
+	### contents are compared by size, stored blocks and SHA-256
+	a = treeA.Entries.get(pathA)
+	b = treeB.Entries.get(pathB)
+	if a is None or b is None:
+		return a is b
+	if a["type"] != b["type"]:
+		return False
+	if a["type"] == "l":
+		return a["target"] == b["target"]
+	if a["type"] in "bc":
+		return a["rdev"] == b["rdev"]
+	if a["type"] != "f":
+		return True
+	if a["size"] != b["size"]:
+		return False
+	if isinstance(treeA, ImageTree) and isinstance(treeB, ImageTree) and treeA.BlockDigest(pathA) == treeB.BlockDigest(pathB):
+		return True
+	return treeA.Digest(pathA) == treeB.Digest(pathB)
+
+def attributes(entry):
+	if entry is None:
+		return None
+	### The mode of symlinks is meaningless
+	return (None if entry["type"] == "l" else entry["mode"], entry["uid"], entry["gid"])
+
+class DahuaRebase():
+	def __init__(self, config, debug, store=None):
+		self.Config = config
+		self.Debug = debug
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+		self.Store = store
+		self.Overlay = overlay.DahuaOverlay(debug)
+		self.Report = []
+		self.ConflictDir = None
+
+	def Record(self, key, path, result, reason):
+		self.Report.append({"partition": key, "path": path, "result": result, "reason": reason})
+		if result == "conflict":
+			self.Logger.warning("Conflict %s:%s: %s", key, path, reason)
+		else:
+			self.Logger.debug("%s %s:%s: %s", result, key, path, reason)
+
+	################################################################################
+	###
+	### Rebase(old, modified, new) - Port the changes of an extracted firmware to a newer one
+	###
+	### Extracts new and does a three-way merge of every filesystem of modified
+	### against its original in old into it. Files are compared by hash, files
+	### which were changed on both sides are merged if they are text, otherwise
+	### the new version is kept, the modified one is saved next to the report.
+	###
+	### Returns:      Number of conflicts
+	###
+	def Rebase(self, old, modified, new):
+		self.Report = []
+		Modified = os.path.abspath(modified)
+		Extractor = extract.DahuaExtractor(self.Config, self.Debug, store=self.Store)
+		Extractor.Extract(new)
+		Dest = os.path.abspath(Extractor.DestDir)
+		self.ConflictDir = Dest + ".rebase"
+		os.makedirs(self.ConflictDir, exist_ok=True)
+
+		OldZip = Firmware.FirmwareZip(old)
+		NewZip = Firmware.FirmwareZip(new)
+		try:
+			for Name in sorted(os.listdir(Modified)):
+				if not Name.endswith(".extracted"):
+					continue
+				Key = Name[:-len(".extracted")]
+				self.Logger.info("Rebasing '%s'.", Key)
+				self.RebasePartition(Key, OldZip, NewZip, os.path.join(Modified, Name), os.path.join(Dest, Name))
+		finally:
+			OldZip.close()
+			NewZip.close()
+
+		with open(os.path.join(self.ConflictDir, "report.json"), "w") as fp:
+			json.dump(self.Report, fp, indent=1)
+
+		Conflicts = sum(1 for Entry in self.Report if Entry["result"] == "conflict")
+		self.Logger.info("Rebased %d change(s) onto '%s', %d conflict(s), report in '%s'.",
+			len(self.Report) - Conflicts, Dest, Conflicts, os.path.join(self.ConflictDir, "report.json"))
+		return Conflicts
+
+	def RebasePartition(self, key, oldZip, newZip, mineDir, resultDir):
+		OldPart = Firmware.openMember(oldZip, key)
+		NewPart = Firmware.openMember(newZip, key)
+		try:
+			if not OldPart or not OldPart["fs"]:
+				self.Record(key, ".", "conflict", "no readable filesystem in the old firmware")
+				return
+			if not NewPart or not os.path.isdir(resultDir):
+				self.Record(key, ".", "conflict", "partition does not exist in the new firmware")
+				return
+			Base = ImageTree(OldPart["fs"])
+			Mine = DiskTree(mineDir)
+			if NewPart["fs"]:
+				New = ImageTree(NewPart["fs"])
+			else:
+				New = DiskTree(resultDir)
+
+			RemovedDirs = []
+			for Path in sorted(set(Base.Entries) | set(Mine.Entries) | set(New.Entries)):
+				try:
+					self.MergePath(key, Path, Base, Mine, New, resultDir, RemovedDirs)
+				except overlay.ConflictError as e:
+					self.Record(key, Path, "conflict", str(e))
+
+			### Directories removed on our side, unless upstream added something to them
+			for Path in sorted(RemovedDirs, reverse=True):
+				try:
+					os.rmdir(overlay.checkPath(resultDir, Path))
+					self.Record(key, Path, "mine", "removed")
+				except OSError as e:
+					if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+						raise
+					self.Record(key, Path, "conflict", "removed directory is not empty in the new firmware")
+				except overlay.ConflictError as e:
+					self.Record(key, Path, "conflict", str(e))
+		finally:
+			for Part in (OldPart, NewPart):
+				if Part:
+					Firmware.closePartition(Part)
+
+	def MergePath(self, key, path, base, mine, new, resultDir, removedDirs):
+		b = base.Entries.get(path)
+		m = mine.Entries.get(path)
+		n = new.Entries.get(path)
+		FullPath = overlay.checkPath(resultDir, path)
+
+		### Attributes, three-way
+		BaseAttributes, MineAttributes, NewAttributes = attributes(b), attributes(m), attributes(n)
+		Attributes = NewAttributes
+		if MineAttributes and MineAttributes not in (BaseAttributes, NewAttributes):
+			if NewAttributes in (None, BaseAttributes):
+				Attributes = MineAttributes
+			else:
+				self.Record(key, path, "conflict", "mode/owner changed on both sides")
+
+		### Content, three-way
+		Content = "new"
+		if sameContent(base, path, mine, path) or sameContent(mine, path, new, path):
+			pass
+		elif sameContent(base, path, new, path):
+			Content = "mine"
+		elif b and m and n and b["type"] == m["type"] == n["type"] == "f":
+			BaseData = base.Content(path)
+			MineData = mine.Content(path)
+			NewData = new.Content(path)
+			Merged = None
+			if overlay.isText(BaseData) and overlay.isText(MineData) and overlay.isText(NewData):
+				Merged = overlay.applyPatch(NewData, overlay.parsePatch(overlay.makePatch(BaseData, MineData, path)))
+			if Merged is None:
+				self.SaveConflict(key, path, BaseData, MineData)
+				self.Record(key, path, "conflict", "changed on both sides")
+				Content = "conflict"
+			else:
+				self.Overlay.WriteFile(resultDir, path, Merged, self.Operation(Attributes))
+				self.Record(key, path, "merged", "changed on both sides")
+				return
+		else:
+			if m and m["type"] == "f":
+				self.SaveConflict(key, path, base.Content(path) if b and b["type"] == "f" else None, mine.Content(path))
+			if not m:
+				Reason = "removed here, changed in the new firmware"
+			elif not n:
+				Reason = "changed here, removed in the new firmware"
+			else:
+				Reason = "changed on both sides"
+			self.Record(key, path, "conflict", Reason)
+			Content = "conflict"
+
+		if Content == "mine":
+			if not m:
+				if n["type"] == "d":
+					removedDirs.append(path)
+				elif os.path.lexists(FullPath):
+					os.unlink(FullPath)
+					self.Record(key, path, "mine", "removed")
+				return
+			self.Replace(resultDir, path, mine, m, n, Attributes)
+			self.Record(key, path, "mine", "added" if not b else "changed")
+			return
+
+		### Keep the new content, with the merged attributes
+		if n and Attributes != NewAttributes and os.path.lexists(FullPath):
+			self.Overlay.SetAttributes(FullPath, Attributes[0], Attributes[1], Attributes[2])
+			self.Record(key, path, "mine", "mode/owner changed")
+
+	def Operation(self, attributes):
+		Operation = {"uid": attributes[1], "gid": attributes[2]}
+		if attributes[0] is not None:
+			Operation["mode"] = "%o" % attributes[0]
+		return Operation
+
+	def Replace(self, resultDir, path, mine, entry, current, attributes):
+		FullPath = overlay.checkPath(resultDir, path)
+		if current and current["type"] != entry["type"]:
+			if current["type"] == "d":
+				shutil.rmtree(FullPath)
+			else:
+				os.unlink(FullPath)
+
+		Type = entry["type"]
+		if Type == "f":
+			self.Overlay.WriteFile(resultDir, path, mine.Content(path), self.Operation(attributes))
+		elif Type == "l":
+			self.Overlay.Symlink(resultDir, path, {"target": entry["target"], "uid": attributes[1], "gid": attributes[2]})
+		elif Type == "d":
+			if not os.path.isdir(FullPath):
+				self.Overlay.MakeDirs(resultDir, path, self.Operation(attributes))
+			else:
+				self.Overlay.SetAttributes(FullPath, attributes[0], attributes[1], attributes[2])
+		else:
+			if os.path.lexists(FullPath):
+				os.unlink(FullPath)
+			if Type == "p":
+				os.mkfifo(FullPath)
+			else:
+				os.mknod(FullPath, (stat.S_IFBLK if Type == "b" else stat.S_IFCHR), entry["rdev"])
+			self.Overlay.SetAttributes(FullPath, attributes[0], attributes[1], attributes[2])
+
+	def SaveConflict(self, key, path, base, mine):
+		### Keeps our version (and the original) next to the report
+		Path = os.path.join(self.ConflictDir, key, path)
+		os.makedirs(os.path.dirname(Path), exist_ok=True)
+		for Suffix, Data in ((".base", base), (".mine", mine)):
+			if Data is not None:
+				with open(Path + Suffix, "wb") as fp:
+					fp.write(Data)
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+	logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+	logging.addLevelName(logging.WARNING, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+	logging.addLevelName(logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+	logging.addLevelName(logging.CRITICAL, "\033[5m\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.CRITICAL))
+
+	parser = argparse.ArgumentParser(description="Port the changes of an extracted Dahua firmware image to a newer firmware image.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-c", "--config", default="auto", help="Configuration to use. (Default: auto)")
+	parser.add_argument("-s", "--store", metavar="DIR", help="Extract the new firmware through the object store in DIR")
+	parser.add_argument("old", help="Original firmware image the modified directory was extracted from")
+	parser.add_argument("modified", help="Modified extracted directory")
+	parser.add_argument("new", help="New firmware image")
+	args = parser.parse_args()
+
+	Logger = logging.getLogger("main")
+	if args.verbose:
+		Logger.setLevel(logging.DEBUG)
+	else:
+		Logger.setLevel(logging.INFO)
+
+	for Source in (args.old, args.new):
+		if not os.path.isfile(Source):
+			Logger.error("No such file: '%s'", Source)
+			sys.exit(1)
+	if not os.path.isdir(args.modified):
+		Logger.error("No such directory: '%s'", args.modified)
+		sys.exit(1)
+
+	Found = None
+	if args.config == "auto":
+		Name = os.path.basename(os.path.abspath(args.new)).lower()
+		for Config in DAHUA_CONFIGS:
+			if Config.lower() in Name:
+				Logger.warn("Autodetected config: %s", Config)
+				Found = Config
+				break
+
+		if not Found:
+			Logger.error("Could not autodetect config!")
+	else:
+		ArgConfig = args.config.lower()
+		for Config in DAHUA_CONFIGS:
+			if Config.lower() == ArgConfig:
+				Logger.warn("Found config: %s", Config)
+				Found = Config
+				break
+
+		if not Found:
+			Logger.error("Invalid config specified! (Add to configs/config.py DAHUA_CONFIGS if you made a new one)")
+
+	if not Found:
+		Logger.info("Please use -c to select the correct config from the following list:")
+		for Config in DAHUA_CONFIGS:
+			Logger.info("\t" + Config)
+		sys.exit(1)
+
+	Config = importlib.import_module("configs." + Found)
+
+	store = None
+	if args.store:
+		store = Store.Store(args.store)
+
+	rebase = DahuaRebase(Config, args.verbose, store)
+	if rebase.Rebase(args.old, args.modified, args.new):
+		sys.exit(1)
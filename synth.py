@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import time
+import random
+import distutils.spawn
+import logging
+import zipfile
+import subprocess
+import tempfile
+import shutil
+import uImage
+import importlib
+from configs.config import *
+
+WORDS = ["camera", "stream", "channel", "record", "motion", "alarm", "network", "config", "video", "audio",
+		 "encode", "decode", "storage", "device", "user", "login", "password", "onvif", "rtsp", "http",
+		 "snapshot", "event", "ptz", "preset", "zoom", "focus", "iris", "exposure", "gain", "white"]
+
+class DahuaSynthesizer():
+	DEPENDENCIES = []
+	def __init__(self, config, debug, fill=0.5, compressible=0.7, seed=0):
+		self.Config = config
+		self.Debug = debug
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+		# Fraction of a partitions size to fill with file data
+		self.Fill = fill
+		# Fraction of file data which is text (compressible) instead of random bytes
+		self.Compressible = compressible
+		self.Random = random.Random(seed)
+		self.WorkDir = None
+		self.DahuaFiles = self.Config.DAHUA_FILES
+
+	def CheckDependencies(self):
+		Ret = 0
+		Dependencies = list(self.DEPENDENCIES)
+		for Key, Value in self.DahuaFiles.items():
+			if Value["type"] & DAHUA_TYPE.SquashFS and "mksquashfs" not in Dependencies:
+				Dependencies.append("mksquashfs")
+			if Value["type"] & DAHUA_TYPE.CramFS and "mkcramfs" not in Dependencies:
+				Dependencies.append("mkcramfs")
+
+		for dependency in Dependencies:
+			if self.CheckDependency(dependency):
+				Ret = 1
+		return Ret
+
+	def CheckDependency(self, dependency):
+		if not distutils.spawn.find_executable(dependency):
+			self.Logger.critical("Missing dependency: '%s'", dependency)
+			return 1
+
+	def Synthesize(self, dest, size=None):
+		DestPath = os.path.abspath(dest)
+		self.WorkDir = tempfile.mkdtemp(prefix="synth.", dir=os.path.dirname(DestPath))
+		try:
+			ZipFileList = []
+			for Key, Value in self.DahuaFiles.items():
+				Budget = size if size else Value.get("size", 0x00100000)
+				Budget = int(Budget * self.Fill)
+				Path = os.path.join(self.WorkDir, Key)
+				self.Logger.info("Generating '%s'.", Key)
+
+				if Value["type"] & DAHUA_TYPE.SquashFS or Value["type"] & DAHUA_TYPE.CramFS:
+					Tree = os.path.join(self.WorkDir, Key + ".tree")
+					self.GenerateTree(Tree, Budget)
+					DataPath = Path + ".raw"
+					if Value["type"] & DAHUA_TYPE.SquashFS:
+						Result = self.Run(["mksquashfs", Tree, DataPath, "-noappend", "-all-root", "-comp", "xz"])
+					else:
+						Result = self.Run(["mkcramfs", Tree, DataPath])
+					if Result != 0:
+						self.Logger.error("Failed to create filesystem for file: '%s'", Key)
+						raise Exception("Filesystem creation failed!")
+				else:
+					DataPath = Path + ".raw" if Value["type"] & DAHUA_TYPE.uImage else Path
+					if Key.startswith("Install"):
+						self.GenerateInstall(DataPath)
+					elif Key == "hwid":
+						with open(DataPath, "w") as fp:
+							fp.write("SYNTH-%s\n" % self.Config.__name__.split(".")[-1])
+					else:
+						self.GenerateBlob(DataPath, Budget)
+
+				if Value["type"] & DAHUA_TYPE.uImage:
+					self.Wrap_uImage(DataPath, Path, Key)
+
+				ZipFileList.append((Path, Key))
+
+			self.Logger.info("Writing '%s'.", DestPath)
+			with open(DestPath, "w+b") as DestFile:
+				with zipfile.ZipFile(DestFile, mode='w', compression=zipfile.ZIP_DEFLATED) as ZipFile:
+					for Item in ZipFileList:
+						ZipFile.write(Item[0], Item[1])
+				DestFile.seek(0)
+				DestFile.write(b"DH")
+		finally:
+			shutil.rmtree(self.WorkDir)
+			self.WorkDir = None
+
+	def Run(self, args):
+		if self.Debug:
+			self.Logger.debug(' '.join(args))
+			return subprocess.call(args)
+		return subprocess.call(args, stdout=subprocess.DEVNULL)
+
+	def GenerateText(self, size):
+		Lines = []
+		Length = 0
+		while Length < size:
+			Line = ' '.join(self.Random.choice(WORDS) for i in range(self.Random.randint(3, 12))) + "\n"
+			Lines.append(Line)
+			Length += len(Line)
+		return ''.join(Lines).encode("ascii")[:size]
+
+	def GenerateBlob(self, path, size):
+		with open(path, "wb") as fp:
+			Compressible = int(size * self.Compressible)
+			fp.write(self.GenerateText(Compressible))
+			fp.write(self.Random.getrandbits(8 * (size - Compressible)).to_bytes(size - Compressible, "little"))
+
+	def GenerateInstall(self, path):
+		with open(path, "w") as fp:
+			for Key in self.DahuaFiles:
+				if not Key.startswith("Install"):
+					fp.write("-- upgrade %s\n" % Key)
+
+	################################################################################
+	###
+	### GenerateTree(path, size) - Create a directory tree of roughly size bytes
+	###
+	### File sizes are log-uniform between 64 bytes and 256 KiB, a fraction of
+	### them is text and the rest random data. Adds a few symlinks and empty dirs.
+	###
+	def GenerateTree(self, path, size):
+		Dirs = [path]
+		os.makedirs(path)
+		for Name in ("bin", "etc", "lib", "usr", "www", "www/lang", "var/empty"):
+			os.makedirs(os.path.join(path, Name))
+			Dirs.append(os.path.join(path, Name))
+
+		Written = 0
+		Index = 0
+		while Written < size:
+			Length = min(int(2 ** self.Random.uniform(6, 18)), size - Written)
+			Dir = self.Random.choice(Dirs)
+			if self.Random.random() < self.Compressible:
+				Name = os.path.join(Dir, "file%d.txt" % Index)
+				Data = self.GenerateText(Length)
+			else:
+				Name = os.path.join(Dir, "file%d.bin" % Index)
+				Data = self.Random.getrandbits(8 * Length).to_bytes(Length, "little") if Length else b""
+			with open(Name, "wb") as fp:
+				fp.write(Data)
+			if Index % 16 == 0:
+				os.symlink(os.path.basename(Name), Name + ".link")
+			Written += max(Length, 1)
+			Index += 1
+
+	def Wrap_uImage(self, dataPath, destPath, key):
+		Header = {
+			"magic": uImage.HEADER_MAGIC, "time": int(time.time()), "size": os.path.getsize(dataPath),
+			"loadAddr": 0, "entryAddr": 0,
+			"osType": uImage.searchTable(uImage.osType, "linux"),
+			"arch": uImage.searchTable(uImage.archType, "arm"),
+			"imageType": uImage.searchTable(uImage.imageType, "standalone"),
+			"compression": uImage.searchTable(uImage.compressType, "none"),
+			"name": key.encode("ascii")
+		}
+		with open(dataPath, "rb") as fp:
+			Header["dataCrc"] = uImage.crc32File(fp)
+
+		with open(destPath, "wb") as fp:
+			fp.write(uImage.packHeader(Header))
+			with open(dataPath, "rb") as DataFile:
+				uImage.copyData(DataFile, fp)
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+	logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+	logging.addLevelName(logging.WARNING, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+	logging.addLevelName(logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+	logging.addLevelName(logging.CRITICAL, "\033[5m\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.CRITICAL))
+
+	parser = argparse.ArgumentParser(description="Generate synthetic Dahua firmware images for testing and benchmarking.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-c", "--config", required=True, help="Configuration to generate an image for.")
+	parser.add_argument("-f", "--fill", type=float, default=0.5, help="Fraction of each partition size to fill with files. (Default: 0.5)")
+	parser.add_argument("-s", "--size", type=int, help="Use this content size (bytes) for every partition instead of the configured size")
+	parser.add_argument("-m", "--compressible", type=float, default=0.7, help="Fraction of text (compressible) content. (Default: 0.7)")
+	parser.add_argument("--seed", type=int, default=0, help="Random seed. (Default: 0)")
+	parser.add_argument("dest", help="Destination File (name it so the config can be autodetected, e.g. <config>.bin)")
+	args = parser.parse_args()
+
+	Logger = logging.getLogger("main")
+
+	Found = None
+	ArgConfig = args.config.lower()
+	for Config in DAHUA_CONFIGS:
+		if Config.lower() == ArgConfig:
+			Found = Config
+			break
+
+	if not Found:
+		Logger.error("Invalid config specified! Choose from: %s", ", ".join(DAHUA_CONFIGS))
+		sys.exit(1)
+
+	Config = importlib.import_module("configs." + Found)
+
+	synthesizer = DahuaSynthesizer(Config, args.verbose, args.fill, args.compressible, args.seed)
+	if synthesizer.CheckDependencies():
+		sys.exit(1)
+	synthesizer.Synthesize(args.dest, args.size)
@@ -33,7 +33,6 @@
 
 import os, time, zlib
 from struct import pack, unpack, calcsize
-from os import fstat
 from optparse import OptionParser, OptionGroup
 
 ### 64-byte header structure:
@@ -53,6 +52,10 @@ HEADER_FORMAT = '!7L4B32s'    ### (Big-endian, 7 ULONGS, 4 UCHARs, 32-byte strin
 HEADER_SIZE = calcsize(HEADER_FORMAT)    ### Should be 64-bytes
 HEADER_MAGIC = 0x27051956
 
+### All data is streamed through buffers of this size, no matter how large the
+### image is, so memory usage stays bounded.
+BLOCKSIZE = 1024*512
+
 ### Image types, from 0 to 14
 imageType = [['INVALID', ''],
         ['Standalone', 'standalone'],
@@ -209,37 +212,77 @@ def calculateHeaderCrc(hd):
         hd['arch'], hd['imageType'], hd['compression'], hd['name'])
     return (zlib.crc32(header) & 0xffffffff)
 
+################################################################################
+###
+### packHeader(hd) - Packs a header dictionary, calculating the header crc
+###
+### Parameters:   hd:      Dictionary of header (headerCrc is ignored)
+###
+### Returns:      HEADER_SIZE bytes
+###
+def packHeader(hd):
+    return pack(HEADER_FORMAT, hd['magic'], calculateHeaderCrc(hd), hd['time'],
+        hd['size'], hd['loadAddr'], hd['entryAddr'], hd['dataCrc'], hd['osType'],
+        hd['arch'], hd['imageType'], hd['compression'], hd['name'])
+
 ################################################################################
 ###
 ### crc32File(fh, start, length) - Calculates crc of data segment in a file
 ###
 ### Parameters:   fh:      file handle
 ###               start:   start position (optional)
-###               length:  length of segment (optional)
+###               length:  length of segment (optional, default: until EOF)
+###               crc32:   crc to continue from (optional)
 ###
-def crc32File(fh, start=0, length=float('inf')):
-    BLOCKSIZE = 1024*512
-    crc32 = 0
-    byteCount = 0
+def crc32File(fh, start=0, length=None, crc32=0):
+    buf = bytearray(BLOCKSIZE)
+    view = memoryview(buf)
     ### Save current position and seek to start position
     startpos = fh.tell()
     fh.seek(start)
 
-    block = fh.read(BLOCKSIZE)
-    while block != "":
-        byteCount += len(block)
-        if byteCount > length:
-            extra = byteCount - length
-            block = block[:-extra]
-            crc32 = zlib.crc32(block, crc32)
-            if byteCount >= length:
-                break;
-        block = fh.read(BLOCKSIZE)
+    while length is None or length > 0:
+        count = fh.readinto(buf)
+        if not count:
+            break
+        if length is not None:
+            count = min(count, length)
+            length -= count
+        crc32 = zlib.crc32(view[:count], crc32)
 
     ### Restore saved file position
     fh.seek(startpos)
     return (crc32 & 0xffffffff)
 
+################################################################################
+###
+### copyData(fh, df, length, crc32) - Copies data from fh to df, calculating crc
+###
+### Parameters:   fh:      source file handle (at current position)
+###               df:      destination file handle
+###               length:  bytes to copy (optional, default: until EOF)
+###               crc32:   crc to continue from (optional)
+###
+### Returns:      (bytes copied, crc32)
+###
+def copyData(fh, df, length=None, crc32=0):
+    buf = bytearray(BLOCKSIZE)
+    view = memoryview(buf)
+    copied = 0
+
+    while length is None or copied < length:
+        if length is None:
+            count = fh.readinto(buf)
+        else:
+            count = fh.readinto(view[:min(BLOCKSIZE, length - copied)])
+        if not count:
+            break
+        df.write(view[:count])
+        crc32 = zlib.crc32(view[:count], crc32)
+        copied += count
+
+    return (copied, crc32 & 0xffffffff)
+
 ################################################################################
 ###
 ### getMultiFileLengths(fh) - returns list of file lengths in multi-file image
@@ -254,7 +297,7 @@ def getMultiFileLengths(fh, offset=HEADER_SIZE):
     fh.seek(offset)
 
     block = fh.read(4)
-    while block != "":
+    while len(block) == 4:
         length = unpack('!L', block)[0]
         if length == 0:
             break
@@ -265,6 +308,24 @@ def getMultiFileLengths(fh, offset=HEADER_SIZE):
     fh.seek(startpos)
     return lengthList
 
+################################################################################
+###
+### getMultiFileOffsets(hd, offset) - returns list of (offset, length) of the
+###                                    images in a multi-file image
+###
+### Parameters:   hd:      header dictionary (with 'files')
+###               offset:  location of the header within the file (optional)
+###
+### Images follow the zero terminated length table, each padded to 4 bytes.
+###
+def getMultiFileOffsets(hd, offset=0):
+    offsets = []
+    pos = offset + HEADER_SIZE + 4 * (len(hd['files']) + 1)
+    for length in hd['files']:
+        offsets.append((pos, length))
+        pos += (length + 3) & ~3
+    return offsets
+
 ################################################################################
 ###
 ### dumpHeader(hd) - Dumps header in text form to stdout
@@ -293,7 +354,7 @@ def dumpHeader(hd):
     if hd['headerCrc'] == calculateHeaderCrc(hd):
         print("OK")
     else:
-        print("Mismatch!  Calculated CRC: %#08x" % str(calculatedHeadedCrc(hd)))
+        print("Mismatch!  Calculated CRC: %#08x" % calculateHeaderCrc(hd))
 
     print("Data CRC:\t%#08x" % hd['dataCrc']) ###,
 
@@ -316,24 +377,29 @@ def dumpHeader(hd):
 ###               length:   Length of segment to copy
 ###               filename: Name of new file to write contents to
 ###
+### Raises EOFError if fh ends before the segment does.
+###
 def dumpToFile(fh, offset, length, filename):
-    ### Save current position and seek to start location
-    startpos = fh.tell()
-    fh.seek(offset)
-    BLOCKSIZE = 1024*512
     df = open(filename, "wb")
-    while True:
-        if BLOCKSIZE > length:
-            BLOCKSIZE = length
-        block = fh.read(BLOCKSIZE)
-        df.write(block)
-        length -= BLOCKSIZE
-        if block == "":
-            break;
-
+    copied = 0
+    try:
+        ### Let the kernel copy the segment without passing it through userspace
+        while copied < length:
+            count = os.copy_file_range(fh.fileno(), df.fileno(), length - copied, offset + copied)
+            if not count:
+                break
+            copied += count
+    except (AttributeError, OSError):
+        ### Not supported by platform, filesystem or file object, copy through a buffer
+        startpos = fh.tell()
+        fh.seek(offset + copied)
+        count, crc32 = copyData(fh, df, length - copied)
+        copied += count
+        ### Restore saved file position
+        fh.seek(startpos)
     df.close()
-    ### Restore saved file position
-    fh.seek(startpos)
+    if copied != length:
+        raise EOFError("%s truncated, %u of %u bytes" % (filename, copied, length))
     return
 
 ################################################################################
@@ -365,22 +431,28 @@ def imageList(image):
     d=parseHeader(f)
 
     dumpHeader(d)
+    if d['magic'] != HEADER_MAGIC:
+        f.close()
+        return
+
+    ### Verify Data CRC
+    dcrc = crc32File(f, HEADER_SIZE, d['size'])
+    if dcrc == d['dataCrc']:
+        print("Data CRC:\tOK")
+    else:
+        print("Data CRC:\tMismatch!  Calculated CRC: %#08x" % dcrc)
 
     ### Dump multi-file headers as well
     if d['imageType'] == 4:
-        ### Next image begins after multi-file table
-        f.seek(HEADER_SIZE+4+(4*len(d['files'])))
-        for index, length in enumerate(d['files']):
+        for index, (offset, length) in enumerate(getMultiFileOffsets(d)):
             print()
-            print("Multi-File Image %u: Header" % (index))
-            print("--------------------------")
-            mfd = parseHeader(f, f.tell())
-            dumpHeader(mfd)
-            ### Dump child uImage file
-            #dumpToFile(f, f.tell(), length, mfd['name'].rstrip('\0')+".uImage")
-            ### Dump payload from child uImage
-            #dumpToFile(f, f.tell()+HEADER_SIZE, mfd['size'], mfd['name'].rstrip('\0'))
-            f.seek(length,1)
+            print("Multi-File Image %u: %u bytes at %#x" % (index, length, offset))
+            ### Images may be uImages themselves
+            if length >= HEADER_SIZE:
+                mfd = parseHeader(f, offset)
+                if mfd['magic'] == HEADER_MAGIC:
+                    print("--------------------------")
+                    dumpHeader(mfd)
     f.close()
 
 
@@ -415,14 +487,14 @@ def imageExtract(image):
 
     ### Check for multi-file image
     if d['imageType'] == 4:
-        ### Next image begins after multi-file table
-        f.seek(HEADER_SIZE+4+(4*len(d['files'])))
         filenames = []
-        for index, length in enumerate(d['files']):
-            mfd = parseHeader(f, f.tell())
-            filename = mfd['name'].rstrip('\0')
+        for index, (offset, length) in enumerate(getMultiFileOffsets(d)):
+            ### Images may be uImages themselves
+            mfd = parseHeader(f, offset) if length >= HEADER_SIZE else {'magic': 0}
+            nested = mfd['magic'] == HEADER_MAGIC
+            filename = mfd['name'].decode("ascii", errors="ignore").rstrip('\0') if nested else ""
             if filename == "":
-                filename = "image"+index
+                filename = "image" + str(index)
             ### Prevent overwriting files with the same name
             if filename in filenames:
                 suffix = 1
@@ -430,18 +502,21 @@ def imageExtract(image):
                     suffix += 1
                 filename = filename + "_" + str(suffix)
             filenames.append(filename)
-            ### Dump child uImage file
-            print(filename+".uImage")
-            dumpToFile(f, f.tell(), length, filename+".uImage")
-            ### Dump payload from child uImage
-            print(filename)
-            dumpToFile(f, f.tell()+HEADER_SIZE, mfd['size'], filename)
-            f.seek(length,1)
+            if nested:
+                ### Dump child uImage file
+                print(filename+".uImage")
+                dumpToFile(f, offset, length, filename+".uImage")
+                ### Dump payload from child uImage
+                print(filename)
+                dumpToFile(f, offset+HEADER_SIZE, mfd['size'], filename)
+            else:
+                print(filename)
+                dumpToFile(f, offset, length, filename)
     else:
-        filename = d['name'].rstrip('\0')
+        filename = d['name'].decode("ascii", errors="ignore").rstrip('\0')
         if filename == "":
             filename = "image0"
-        print(d['name'].rstrip('\0'))
+        print(filename)
         dumpToFile(f, HEADER_SIZE, d['size'], filename)
     f.close()
 
@@ -453,44 +528,50 @@ def imageExtract(image):
 ###                options: uImage header options from command-line
 ###
 def imageCreate(options, image):
-    ifh = open(image, 'w+b')
-    os = searchTable(osType, options.osType)
-    arch = searchTable(archType, options.architecture)
-    it = searchTable(imageType, options.imageType)
-    le = int(options.loadaddr, 0)
-    ep = int(options.entryaddr, 0)
-    comp = searchTable(compressType, options.compression)
-    dcrc = 0
-    hcrc = 0
-    size = 0
-    data = str()
-    ### unix timestamp (or set to 0 to be like Palm)
-    ctime = int(time.time())
+    hd = {
+        'magic': HEADER_MAGIC,
+        ### unix timestamp (or set to 0 to be like Palm)
+        'time': int(time.time()),
+        'loadAddr': int(options.loadaddr, 0),
+        'entryAddr': int(options.entryaddr, 0),
+        'osType': searchTable(osType, options.osType),
+        'arch': searchTable(archType, options.architecture),
+        'imageType': searchTable(imageType, options.imageType),
+        'compression': searchTable(compressType, options.compression),
+        'name': options.imagename.encode("ascii")
+    }
 
     ### Check if multi-image
-    if it == 4:
-        lenTable = []
-        for filename in options.filespec.split(":"):
-            dfh = open(filename, 'rb')
-            lenTable.append(fstat(dfh.fileno()).st_size)
-            data += dfh.read()
-            dfh.close()
+    filenames = options.filespec.split(":") if hd['imageType'] == 4 else [options.filespec]
+    table = b""
+    if hd['imageType'] == 4:
+        lenTable = [os.path.getsize(filename) for filename in filenames]
         lenTable.append(0)
         fmt = "!" + str(len(lenTable)) + "L"
-        data = pack(fmt, *lenTable) + data
-    else:
-        dfh = open(options.filespec, 'rb')
-        data = dfh.read()
+        table = pack(fmt, *lenTable)
+
+    ### Stream the data behind a placeholder header, then write the real header
+    ifh = open(image, 'w+b')
+    ifh.write(bytes(HEADER_SIZE))
+    ifh.write(table)
+    size = len(table)
+    dcrc = zlib.crc32(table)
+    for index, filename in enumerate(filenames):
+        dfh = open(filename, 'rb')
+        copied, dcrc = copyData(dfh, ifh, crc32=dcrc)
         dfh.close()
-    size = len(data)
-    dcrc = zlib.crc32(data) & 0xFFFFFFFF
-    header = pack(HEADER_FORMAT, HEADER_MAGIC, 0, ctime, size,
-        le, ep, dcrc, os, arch, it, comp, options.imagename)
-    hcrc = zlib.crc32(header) & 0xFFFFFFFF
-    header = pack(HEADER_FORMAT, HEADER_MAGIC, hcrc, ctime, size,
-        le, ep, dcrc, os, arch, it, comp, options.imagename)
-    ifh.write(header)
-    ifh.write(data)
+        size += copied
+        ### Pad all but the last image of a multi-file image to 4 bytes
+        if table and index != len(filenames) - 1 and copied % 4:
+            pad = bytes(4 - copied % 4)
+            ifh.write(pad)
+            dcrc = zlib.crc32(pad, dcrc)
+            size += len(pad)
+
+    hd['size'] = size
+    hd['dataCrc'] = dcrc
+    ifh.seek(0)
+    ifh.write(packHeader(hd))
     ifh.close()
     imageList(image)
 
@@ -539,7 +620,11 @@ def main():
     elif options.imageExtract:
         if options.imageList or options.imageCreate:
             parser.error("-l, -c, and -x are mutually exclusive")
-        imageExtract(image)
+        try:
+            imageExtract(image)
+        except EOFError as e:
+            print(e)
+            exit(1)
     elif options.imageCreate:
         if options.imageList or options.imageExtract:
             parser.error("-l, -c, and -x are mutually exclusive")
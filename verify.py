@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import io
+import sys
+import time
+import zlib
+import logging
+import zipfile
+import uImage
+import SquashFS
+import CramFS
+import Firmware
+import importlib
+from configs.config import *
+
+class DahuaVerifier():
+	BLOCKSIZE = 1024*512
+	# Enough to hold any SquashFS superblock plus compression options
+	PEEKSIZE = 4096
+	def __init__(self, config, debug):
+		self.Config = config
+		self.Debug = debug
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+		self.ZipFile = None
+		self.Errors = 0
+		self.DahuaFiles = self.Config.DAHUA_FILES
+
+	def Error(self, msg, *args):
+		self.Logger.error(msg, *args)
+		self.Errors += 1
+
+	def Verify(self, source):
+		self.Errors = 0
+		Start = time.perf_counter()
+		Bytes = 0
+
+		with open(source, "rb") as fp:
+			if fp.read(2) != Firmware.HEADER_MAGIC:
+				self.Error("Image does not start with 'DH' header!")
+
+		self.ZipFile = Firmware.FirmwareZip(source)
+		try:
+			Names = self.ZipFile.namelist()
+			for Key, Value in self.DahuaFiles.items():
+				if Value["required"] and Key not in Names:
+					self.Error("Required file '%s' is missing!", Key)
+
+			for Info in self.ZipFile.infolist():
+				if Info.filename not in self.DahuaFiles:
+					self.Logger.warning("Unrecognized file: '%s'.", Info.filename)
+					continue
+				self.VerifyMember(Info)
+				Bytes += Info.file_size
+		finally:
+			self.ZipFile.close()
+			self.ZipFile = None
+
+		Seconds = time.perf_counter() - Start
+		self.Logger.info("Verified %d bytes in %.2fs (%.1f MiB/s), %d error(s).",
+			Bytes, Seconds, Bytes / Seconds / 1048576 if Seconds else 0, self.Errors)
+		return self.Errors
+
+	################################################################################
+	###
+	### VerifyMember(info) - Check one zip member in a single streaming pass
+	###
+	### The ZIP CRC is checked by zipfile at the end of the stream, the uImage data
+	### CRC is computed on the fly and the filesystem superblock is checked from
+	### the first block of the payload.
+	###
+	def VerifyMember(self, info):
+		Key = info.filename
+		Value = self.DahuaFiles[Key]
+		self.Logger.debug("Verifying '%s'.", Key)
+		ErrorsBefore = self.Errors
+
+		if "size" in Value:
+			Size = Value["size"]
+			if Value["type"] & DAHUA_TYPE.uImage:
+				Size += uImage.HEADER_SIZE
+			if info.file_size > Size:
+				self.Error("'%s' exceedes maximum allowed filesize! (%d > %d)", Key, info.file_size, Size)
+
+		Header = None
+		Block = b""
+		DataCrc = 0
+		Peek = b""
+		Buffer = bytearray(self.BLOCKSIZE)
+		View = memoryview(Buffer)
+		try:
+			with self.ZipFile.open(info) as fp:
+				if Value["type"] & DAHUA_TYPE.uImage:
+					Block = fp.read(uImage.HEADER_SIZE)
+					if len(Block) < uImage.HEADER_SIZE:
+						self.Error("'%s' is too small to be an uImage!", Key)
+						return
+
+				while True:
+					Length = fp.readinto(Buffer)
+					if not Length:
+						break
+					if len(Peek) < self.PEEKSIZE:
+						Peek += bytes(View[:min(Length, self.PEEKSIZE - len(Peek))])
+					if Block:
+						DataCrc = zlib.crc32(View[:Length], DataCrc)
+		except (zipfile.BadZipFile, zlib.error) as e:
+			self.Error("'%s': %s", Key, e)
+			return
+
+		PayloadSize = info.file_size
+		if Block:
+			# Multi-file length table follows the header
+			Header = uImage.parseHeader(io.BytesIO(Block + Peek))
+			PayloadSize -= uImage.HEADER_SIZE
+			if Header["magic"] != uImage.HEADER_MAGIC:
+				self.Error("'%s': Invalid uImage magic number!", Key)
+				return
+			if Header["headerCrc"] != uImage.calculateHeaderCrc(Header):
+				self.Error("'%s': uImage header CRC mismatch!", Key)
+			if Header["size"] != PayloadSize:
+				self.Error("'%s': uImage data size %d does not match payload size %d!", Key, Header["size"], PayloadSize)
+			if Header["dataCrc"] != DataCrc & 0xffffffff:
+				self.Error("'%s': uImage data CRC mismatch! (%#08x != %#08x)", Key, Header["dataCrc"], DataCrc & 0xffffffff)
+
+			# Images of multi-file images are checked by the uImage CRC only
+			if Header["imageType"] == uImage.searchTable(uImage.imageType, "multi"):
+				Offsets = uImage.getMultiFileOffsets(Header)
+				End = Offsets[-1][0] + Offsets[-1][1] if Offsets else 0
+				if End > info.file_size:
+					self.Error("'%s': Multi-file length table exceeds payload size!", Key)
+				if self.Errors == ErrorsBefore:
+					self.Logger.debug("'%s' OK.", Key)
+				return
+
+		if Value["type"] & DAHUA_TYPE.SquashFS:
+			if len(Peek) < SquashFS.HEADER_SIZE:
+				self.Error("'%s' is too small to be a SquashFS image!", Key)
+				return
+			Super = SquashFS.parseHeader(io.BytesIO(Peek))
+			if Super["s_magic"] != SquashFS.HEADER_MAGIC:
+				self.Error("'%s': Invalid SquashFS magic number!", Key)
+			elif Super["bytes_used"] > PayloadSize:
+				self.Error("'%s': SquashFS bytes_used %d exceeds payload size %d!", Key, Super["bytes_used"], PayloadSize)
+			else:
+				# A shorter payload is truncated, a longer one has something appended
+				Padded = -(-Super["bytes_used"] // SquashFS.PAD_SIZE) * SquashFS.PAD_SIZE
+				if PayloadSize not in (Super["bytes_used"], Padded):
+					self.Error("'%s': SquashFS bytes_used %d (%d padded) does not match payload size %d!", Key,
+							   Super["bytes_used"], Padded, PayloadSize)
+
+		if Value["type"] & DAHUA_TYPE.CramFS:
+			Super = CramFS.parseHeader(io.BytesIO(Peek))
+			if Super["magic"] != CramFS.HEADER_MAGIC:
+				self.Error("'%s': Invalid CramFS magic number!", Key)
+			elif Super["size"] > PayloadSize:
+				self.Error("'%s': CramFS size %d exceeds payload size %d!", Key, Super["size"], PayloadSize)
+
+		if self.Errors == ErrorsBefore:
+			self.Logger.debug("'%s' OK.", Key)
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+	logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+	logging.addLevelName(logging.WARNING, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+	logging.addLevelName(logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+	logging.addLevelName(logging.CRITICAL, "\033[5m\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.CRITICAL))
+
+	parser = argparse.ArgumentParser(description="Verify Dahua firmware images.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-c", "--config", default="auto", help="Configuration to use. (Default: auto)")
+	parser.add_argument("source", help="Source File")
+	args = parser.parse_args()
+
+	Logger = logging.getLogger("main")
+	if args.verbose:
+		Logger.setLevel(logging.DEBUG)
+	else:
+		Logger.setLevel(logging.INFO)
+
+	if not os.path.isfile(args.source):
+		Logger.error("No such file: '%s'", args.source)
+		sys.exit(1)
+
+	Found = None
+	if args.config == "auto":
+		Name = os.path.basename(os.path.abspath(args.source)).lower()
+		for Config in DAHUA_CONFIGS:
+			if Config.lower() in Name:
+				Logger.warn("Autodetected config: %s", Config)
+				Found = Config
+				break
+
+		if not Found:
+			Logger.error("Could not autodetect config!")
+	else:
+		ArgConfig = args.config.lower()
+		for Config in DAHUA_CONFIGS:
+			if Config.lower() == ArgConfig:
+				Logger.warn("Found config: %s", Config)
+				Found = Config
+				break
+
+		if not Found:
+			Logger.error("Invalid config specified! (Add to configs/config.py DAHUA_CONFIGS if you made a new one)")
+
+	if not Found:
+		Logger.info("Please use -c to select the correct config from the following list:")
+		for Config in DAHUA_CONFIGS:
+			Logger.info("\t" + Config)
+		sys.exit(1)
+
+	Config = importlib.import_module("configs." + Found)
+
+	verifier = DahuaVerifier(Config, args.verbose)
+	if verifier.Verify(args.source):
+		sys.exit(1)
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import re
+import sys
+import stat
+import zlib
+import struct
+import shutil
+import logging
+import subprocess
+import concurrent.futures
+import Store
+import Staging
+import Firmware
+
+### <Key>.webopt next to <Key>.extracted holds the originals and the mapping
+BACKUP_SUFFIX = ".webopt"
+
+TEXT_TYPES = {
+	".js": "js",
+	".css": "css",
+	".htm": "html",
+	".html": "html"
+}
+IMAGE_TYPES = {
+	".png": "png",
+	".jpg": "jpeg",
+	".jpeg": "jpeg"
+}
+
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+### Chunks which do not change how a PNG looks
+PNG_DROP = {b"tEXt", b"zTXt", b"iTXt", b"tIME"}
+
+### Strings (kept) or comments (removed) in CSS
+CSS_STRING = r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\''
+CSS_TOKENS = re.compile(r"(%s)|/\*.*?\*/" % CSS_STRING, re.S)
+CSS_STRINGS = re.compile(r"(%s)" % CSS_STRING)
+CSS_SPACE = re.compile(r"\s*([{};,])\s*")
+### Elements whose content is not plain markup
+HTML_BLOCKS = re.compile(r"(<(script|style|pre|textarea)\b[^>]*>)(.*?)(</\2\s*>)", re.S | re.I)
+HTML_COMMENT = re.compile(r"<!--(?!\[if|<!\[endif).*?-->", re.S)
+
+################################################################################
+###
+### minifyJs(text) - Conservative, line based JavaScript minification
+###
+### Only indentation, trailing whitespace, empty lines and comments that
+### fill whole lines are removed, line breaks stay so automatic semicolon
+### insertion is not affected. Files with template literals or strings
+### continued on the next line are left alone, their lines may start with
+### anything.
+###
+def minifyJs(text):
+	if "`" in text or re.search(r"\\\r?\n", text):
+		return text
+	lines = []
+	comment = False
+	for line in text.split("\n"):
+		line = line.strip()
+		if comment:
+			if line.endswith("*/") and "*/" not in line[:-2]:
+				comment = False
+				continue
+			if "*/" in line:
+				### Code after the comment, keep everything
+				return text
+			continue
+		if line.startswith("//"):
+			continue
+		if line.startswith("/*") and not line.startswith("/*!"):
+			end = line.find("*/", 2)
+			if end < 0:
+				comment = True
+				continue
+			if end == len(line) - 2:
+				continue
+		if line:
+			lines.append(line)
+	if comment:
+		return text
+	return "\n".join(lines) + "\n"
+
+def minifyCss(text):
+	### A comment separates tokens like whitespace does
+	text = CSS_TOKENS.sub(lambda match: match.group(1) or " ", text)
+	parts = CSS_STRINGS.split(text)
+	for index in range(0, len(parts), 2):
+		part = re.sub(r"\s+", " ", parts[index])
+		parts[index] = CSS_SPACE.sub(r"\1", part).replace(";}", "}")
+	return "".join(parts).strip() + "\n"
+
+def minifyHtml(text):
+	out = []
+	pos = 0
+	for match in HTML_BLOCKS.finditer(text):
+		out.append(minifyMarkup(text[pos:match.start()]))
+		tag = match.group(2).lower()
+		content = match.group(3)
+		if tag == "script" and content.strip() and "<!--" not in content:
+			minified = minifyJs(content)
+			if minified is not content:
+				content = "\n" + minified
+		elif tag == "style" and "<!--" not in content:
+			content = minifyCss(content)
+		out.append(match.group(1) + content + match.group(4))
+		pos = match.end()
+	out.append(minifyMarkup(text[pos:]))
+	return "".join(out)
+
+def minifyMarkup(text):
+	text = HTML_COMMENT.sub("", text)
+	lines = [line.strip() for line in text.split("\n")]
+	### Keep a line break at the ends, they may separate inline elements
+	head = "\n" if text.startswith(("\n", " ", "\t", "\r")) else ""
+	tail = "\n" if text.endswith(("\n", " ", "\t", "\r")) else ""
+	body = "\n".join(line for line in lines if line)
+	return head + body + tail if body else head or tail
+
+################################################################################
+###
+### recompressPng(data) - Recompress the image data of a PNG with zlib level 9
+###
+### Metadata chunks (text, time) are dropped, the pixels are not changed.
+###
+### Returns:      new PNG or None if it is not a PNG
+###
+def recompressPng(data):
+	if not data.startswith(PNG_MAGIC):
+		return None
+	chunks = []
+	idat = []
+	pos = len(PNG_MAGIC)
+	while pos + 12 <= len(data):
+		length, name = struct.unpack_from(">I4s", data, pos)
+		body = data[pos + 8:pos + 8 + length]
+		if len(body) != length:
+			return None
+		pos += 12 + length
+		if name == b"IDAT":
+			if not idat:
+				chunks.append((name, None))
+			idat.append(body)
+		elif name not in PNG_DROP:
+			chunks.append((name, body))
+		if name == b"IEND":
+			break
+	if not idat:
+		return None
+	try:
+		raw = zlib.decompress(b"".join(idat))
+	except zlib.error:
+		return None
+
+	best = None
+	for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+		compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS, 9, strategy)
+		packed = compressor.compress(raw) + compressor.flush()
+		if best is None or len(packed) < len(best):
+			best = packed
+
+	out = [PNG_MAGIC]
+	for name, body in chunks:
+		if body is None:
+			body = best
+		out.append(struct.pack(">I4s", len(body), name) + body + struct.pack(">I", zlib.crc32(name + body)))
+	return b"".join(out)
+
+def recompressJpeg(path):
+	### Lossless Huffman table optimization, needs jpegtran
+	if not shutil.which("jpegtran"):
+		return None
+	result = subprocess.run(["jpegtran", "-copy", "none", "-optimize", path], stdout=subprocess.PIPE,
+							stderr=subprocess.DEVNULL, timeout=60)
+	return result.stdout if result.returncode == 0 and result.stdout else None
+
+################################################################################
+###
+### optimizeFile(path, kind) - Optimize one asset (runs in a worker process)
+###
+### Returns:      (path, optimized data) or (path, None) if it did not get smaller
+###
+def optimizeFile(path, kind):
+	with open(path, "rb") as fp:
+		data = fp.read()
+	try:
+		if kind in ("js", "css", "html"):
+			### latin-1 maps every byte to itself, UTF-8/GBK text passes unchanged
+			text = data.decode("latin-1")
+			text = {"js": minifyJs, "css": minifyCss, "html": minifyHtml}[kind](text)
+			new = text.encode("latin-1")
+		elif kind == "png":
+			new = recompressPng(data)
+		else:
+			new = recompressJpeg(path)
+	except (ValueError, OSError, subprocess.SubprocessError):
+		new = None
+	if new is None or len(new) >= len(data):
+		return path, None
+	return path, new
+
+class DahuaWebOptimizer():
+	def __init__(self, debug, jobs=None):
+		self.Debug = debug
+		self.Jobs = jobs if jobs else os.cpu_count()
+		self.Logger = logging.getLogger(__class__.__name__)
+		if self.Debug:
+			self.Logger.setLevel(logging.DEBUG)
+		else:
+			self.Logger.setLevel(logging.INFO)
+
+	################################################################################
+	###
+	### Optimize(source, keys, budgets, dryRun) - Shrink the web partitions of an
+	###                                           extracted firmware in place
+	###
+	### Parameters:   keys:     partitions to optimize (Default: every web*
+	###                         partition with an .extracted tree)
+	###               budgets:  partition key -> size, for the report
+	###
+	### Text assets are minified and images recompressed on a process pool,
+	### files with equal content, mode and owner become hardlinks of each other.
+	### Originals are kept in <Key>.webopt with a mapping for Revert().
+	###
+	### Returns:      partition key -> bytes saved by minifying/recompressing
+	###
+	def Optimize(self, source, keys=None, budgets=None, dryRun=False):
+		Source = os.path.abspath(source)
+		Saved = {}
+		for Key in self.WebKeys(Source, keys):
+			Tree = os.path.join(Source, Key + ".extracted")
+			Backup = os.path.join(Source, Key + BACKUP_SUFFIX)
+			Mapping = Staging.loadMapping(Backup)
+
+			Saved[Key] = self.Minify(Tree, Backup, Mapping, dryRun)
+			Linked, LinkedBytes = self.Deduplicate(Tree, Mapping, dryRun)
+			if not dryRun:
+				Staging.writeMapping(Backup, Mapping)
+			if Linked:
+				# mksquashfs/mkcramfs store equal files once anyway, this only saves inodes
+				self.Logger.info("'%s': %d duplicate file(s) (%d bytes) %s.", Key, Linked, LinkedBytes,
+								 "would be hardlinked" if dryRun else "hardlinked")
+
+			Budget = (budgets or {}).get(Key)
+			if Budget:
+				self.Logger.info("'%s': %s %d bytes (%.1f%% of the %d byte partition).", Key,
+								 "would save" if dryRun else "saved", Saved[Key], Saved[Key] * 100.0 / Budget, Budget)
+			else:
+				self.Logger.info("'%s': %s %d bytes.", Key, "would save" if dryRun else "saved", Saved[Key])
+		return Saved
+
+	def WebKeys(self, source, keys):
+		if keys is None:
+			keys = [Name[:-len(".extracted")] for Name in sorted(os.listdir(source)) if Name.endswith(".extracted")]
+		return [Key for Key in keys if Firmware.isWebKey(Key) and os.path.isdir(os.path.join(source, Key + ".extracted"))]
+
+	def Minify(self, tree, backup, mapping, dryRun):
+		Jobs = []
+		for Root, Dirs, Files in os.walk(tree):
+			for Name in Files:
+				Path = os.path.join(Root, Name)
+				Kind = TEXT_TYPES.get(os.path.splitext(Name)[1].lower()) or IMAGE_TYPES.get(os.path.splitext(Name)[1].lower())
+				if Kind and os.path.isfile(Path) and not os.path.islink(Path):
+					Jobs.append((Path, Kind))
+
+		Saved = 0
+		with concurrent.futures.ProcessPoolExecutor(self.Jobs) as Executor:
+			for Path, New in Executor.map(optimizeFile, *zip(*Jobs), chunksize=16) if Jobs else []:
+				if New is None:
+					continue
+				RelPath = os.path.relpath(Path, tree)
+				Size = os.path.getsize(Path)
+				Saved += Size - len(New)
+				self.Logger.debug("%s: %d -> %d bytes", RelPath, Size, len(New))
+				if dryRun:
+					continue
+
+				Entry = mapping["files"].get(RelPath)
+				if not Entry:
+					### Keep the first original only
+					BackupPath = os.path.join(backup, "files", RelPath)
+					os.makedirs(os.path.dirname(BackupPath), exist_ok=True)
+					shutil.copyfile(Path, BackupPath)
+					Entry = mapping["files"][RelPath] = {"original": Store.hashFile(Path), "size": Size}
+				Entry["optimized"] = Store.sha256(New)
+				Staging.replaceFile(Path, New)
+		return Saved
+
+	def Deduplicate(self, tree, mapping, dryRun):
+		Groups = {}
+		for Root, Dirs, Files in os.walk(tree):
+			for Name in sorted(Files):
+				Path = os.path.join(Root, Name)
+				Stat = os.lstat(Path)
+				if not stat.S_ISREG(Stat.st_mode) or not Stat.st_size:
+					continue
+				Groups.setdefault((Stat.st_size, Stat.st_mode, Stat.st_uid, Stat.st_gid), []).append((Path, Stat))
+
+		Linked = 0
+		Saved = 0
+		for (Size, Mode, Uid, Gid), Entries in Groups.items():
+			if len(Entries) < 2:
+				continue
+			ByHash = {}
+			for Path, Stat in Entries:
+				ByHash.setdefault(Store.hashFile(Path), []).append((Path, Stat))
+			for Digest, Same in ByHash.items():
+				First, FirstStat = Same[0]
+				for Path, Stat in Same[1:]:
+					if (Stat.st_dev, Stat.st_ino) == (FirstStat.st_dev, FirstStat.st_ino):
+						continue
+					RelPath = os.path.relpath(Path, tree)
+					self.Logger.debug("%s: same as %s", RelPath, os.path.relpath(First, tree))
+					Linked += 1
+					Saved += Size
+					if dryRun:
+						continue
+					mapping["links"][RelPath] = os.path.relpath(First, tree)
+					Staging.linkFile(First, Path)
+		return Linked, Saved
+
+	################################################################################
+	###
+	### Revert(source, keys) - Undo Optimize() using the mapping
+	###
+	### Files changed after they were optimized are left as they are.
+	###
+	def Revert(self, source, keys=None):
+		Source = os.path.abspath(source)
+		if keys is None:
+			keys = [Name[:-len(BACKUP_SUFFIX)] for Name in sorted(os.listdir(Source)) if Name.endswith(BACKUP_SUFFIX)]
+		for Key in keys:
+			Tree = os.path.join(Source, Key + ".extracted")
+			Backup = os.path.join(Source, Key + BACKUP_SUFFIX)
+			if not os.path.isfile(os.path.join(Backup, Staging.MAPPING_FILE)):
+				continue
+			Mapping = Staging.loadMapping(Backup)
+			Kept = 0
+
+			for RelPath, Target in Mapping["links"].items():
+				Path = os.path.join(Tree, RelPath)
+				if os.path.isfile(Path) and os.lstat(Path).st_nlink > 1:
+					### Give it back an inode of its own
+					with open(Path, "rb") as fp:
+						Staging.replaceFile(Path, fp)
+
+			for RelPath, Entry in Mapping["files"].items():
+				Path = os.path.join(Tree, RelPath)
+				if not os.path.isfile(Path) or Store.hashFile(Path) != Entry["optimized"]:
+					self.Logger.warning("'%s': '%s' was changed after it was optimized, keeping it.", Key, RelPath)
+					Kept += 1
+					continue
+				with open(os.path.join(Backup, "files", RelPath), "rb") as fp:
+					Staging.replaceFile(Path, fp)
+
+			if not Kept:
+				shutil.rmtree(Backup)
+			self.Logger.info("'%s': restored %d file(s) and %d duplicate(s).", Key, len(Mapping["files"]) - Kept, len(Mapping["links"]))
+
+
+if __name__ == "__main__":
+	logging.basicConfig(format="%(levelname)s\t%(message)s")
+	logging.addLevelName(logging.DEBUG, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+	logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+	logging.addLevelName(logging.WARNING, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+	logging.addLevelName(logging.ERROR, "\033[1;41m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+	logging.addLevelName(logging.CRITICAL, "\033[5m\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.CRITICAL))
+
+	parser = argparse.ArgumentParser(description="Shrink the web partitions of an extracted Dahua firmware image.")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Turn on verbose (debugging) output")
+	parser.add_argument("-n", "--dry-run", action="store_true", help="Only show how many bytes would be saved")
+	parser.add_argument("-j", "--jobs", type=int, help="Number of worker processes. (Default: number of CPUs)")
+	parser.add_argument("-k", "--key", action="append", help="Partition to optimize/revert, may be repeated (Default: all web partitions)")
+	parser.add_argument("command", choices=["optimize", "revert"], help="optimize: minify/recompress/deduplicate in place, revert: restore the originals")
+	parser.add_argument("source", help="Extracted firmware")
+	args = parser.parse_args()
+
+	# Need root to replace the extracted files.
+	if not args.dry_run and os.geteuid() != 0:
+		logging.getLogger("main").error("Replacing the extracted files needs root, please run with sudo.")
+		sys.exit(1)
+
+	optimizer = DahuaWebOptimizer(args.verbose, args.jobs)
+	if args.command == "optimize":
+		optimizer.Optimize(args.source, args.key, dryRun=args.dry_run)
+	else:
+		optimizer.Revert(args.source, args.key)